@@ -1,12 +1,12 @@
 import traceback
-from fastapi import APIRouter, HTTPException, Depends, Path, Query
-from fastapi.concurrency import run_in_threadpool
+from fastapi import APIRouter, HTTPException, Depends, Path, Query, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 from app.schemas.query_request import QueryRequest
 from app.schemas.query_get_response import QueryGetResponse
 from app.schemas.query_post_response import QueryPostResponse
 from app.schemas.vote_request import VoteRequest
 from app.schemas.chat_list_response import ChatListResponse
+from app.schemas.chat_list_page_response import ChatListPageResponse
 from app.services.query.post import query_post, query_post_streaming
 from app.services.chat.get import chat_get
 from app.services.vote.put import vote_put
@@ -14,7 +14,14 @@ from app.services.chat.list import chat_list
 from app.services.chat.delete import chat_delete
 from app.db.conn import get_db_client
 from app.utils.auth_utils import verify_token, verify_token_or_anonymous
-from typing import Optional, List
+from app.utils.embedding_cache import embedding_cache
+from app.utils.semantic_cache import semantic_cache
+from app.mcp.pool import mcp_pool
+from app.db.pipeline_cache import pipeline_cache
+from app.db.write_buffer import write_buffer
+from app.db.persistence import persistence_queue
+from app.utils.cancellation import cancellation_stats
+from typing import Optional, List, Union
 
 
 router = APIRouter()
@@ -25,6 +32,19 @@ async def root():
     return {"message": "Healthy"}
 
 
+@router.get("/metrics")
+async def api_get_metrics():
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "mcp_pool": mcp_pool.stats(),
+        "pipeline_cache": pipeline_cache.stats(),
+        "write_buffer": write_buffer.stats(),
+        "persistence_queue": persistence_queue.stats(),
+        "cancellation": cancellation_stats.stats(),
+    }
+
+
 @router.post("/queries", response_model=QueryPostResponse)
 async def api_post_user_query(
     query: QueryRequest,
@@ -42,16 +62,24 @@ async def api_post_user_query(
 @router.post("/queries/stream")
 async def api_post_user_query_streaming(
     query: QueryRequest,
+    request: Request,
     db_conn=Depends(get_db_client),
     username: str = Depends(verify_token),
 ):
     """
     Stream the query response for NOSQL routes.
     Returns Server-Sent Events (SSE) format for real-time streaming.
+    The query is cancelled if the client disconnects before the answer is complete.
     """
     try:
         return StreamingResponse(
-            query_post_streaming(db_conn, query.query, username, query.chat_id),
+            query_post_streaming(
+                db_conn,
+                query.query,
+                username,
+                query.chat_id,
+                is_disconnected=request.is_disconnected,
+            ),
             media_type="text/event-stream",
         )
     except:
@@ -66,8 +94,7 @@ async def api_put_vote(
     username: str = Depends(verify_token),
 ):
     try:
-        await run_in_threadpool(
-            vote_put,
+        await vote_put(
             db_conn,
             vote_request.query_id,
             vote_request.vote,
@@ -89,7 +116,7 @@ async def api_get_chat(
     chat_id: str = Path(description="The ID of the chat"),
 ):
     try:
-        response = await run_in_threadpool(chat_get, db_conn, chat_id, username)
+        response = await chat_get(db_conn, chat_id, username)
         return response
     except HTTPException as e:
         raise e
@@ -98,14 +125,22 @@ async def api_get_chat(
         raise HTTPException(status_code=500)
 
 
-@router.get("/chats", response_model=List[ChatListResponse])
+@router.get(
+    "/chats", response_model=Union[ChatListPageResponse, List[ChatListResponse]]
+)
 async def api_list_chat(
     db_conn=Depends(get_db_client),
     username: str = Depends(verify_token),
-    page: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(
+        None,
+        description="The next_cursor of the previous page, or an empty string for the first page",
+    ),
+    page: int = Query(
+        0, ge=0, deprecated=True, description="Only used when no cursor is given"
+    ),
 ):
     try:
-        response = await run_in_threadpool(chat_list, db_conn, username, page)
+        response = await chat_list(db_conn, username, page, cursor)
         return response
     except HTTPException as e:
         raise e
@@ -121,7 +156,7 @@ async def api_delete_chat(
     chat_id: str = Path(description="The ID of the chat"),
 ):
     try:
-        deleted_queries_count = await run_in_threadpool(chat_delete, db_conn, chat_id)
+        deleted_queries_count = await chat_delete(db_conn, chat_id)
         return JSONResponse(
             status_code=200,
             content={
@@ -0,0 +1,146 @@
+"""
+Chat Summary Collection
+
+GET /chats lists the chats of a user with the first query of each. Rebuilding this from the query
+collection grows with the user's whole history, so a "chat_summary" document is kept for every
+(chat, user) pair instead:
+- insert_query_document upserts it, setting the first query and created time on its first message
+  and bumping the last activity and message count on every message
+- delete_chat_by_id removes the summaries of the chat
+
+When CHAT_SUMMARY_ENABLED=true, GET /chats reads the summaries with a single indexed range read.
+Run `python -m app.db.chat_summary` once to build the summaries of existing chats before enabling it.
+"""
+
+import os
+from bson import ObjectId
+from typing import Optional
+from dotenv import load_dotenv
+from pymongo import DESCENDING, UpdateOne
+from app.db.conn import MongoDBConnection
+from app.db.indexes import ensure_indexes
+
+load_dotenv()
+
+CHAT_SUMMARY_ENABLED = os.environ.get("CHAT_SUMMARY_ENABLED", "false").lower() == "true"
+CHAT_SUMMARY_COLLECTION = "chat_summary"
+
+
+def get_chat_summary_update(query_doc: dict) -> UpdateOne:
+    """The upsert that counts a new query document towards the summary of its chat."""
+    return UpdateOne(
+        {"chat_id": query_doc["chat_id"], "username": query_doc["username"]},
+        {
+            "$setOnInsert": {
+                "query": query_doc["query"],
+                "created_utc": query_doc["created_utc"],
+            },
+            "$max": {"last_activity_utc": query_doc["created_utc"]},
+            "$inc": {"message_count": 1},
+        },
+        upsert=True,
+    )
+
+
+async def upsert_chat_summaries(db_conn: MongoDBConnection, query_docs: list[dict]):
+    """Count new query documents towards the summaries of their chats, creating summaries if needed."""
+    summary_collection = db_conn.get_async_collection(CHAT_SUMMARY_COLLECTION)
+    # ordered, so that the earliest query of a new chat becomes its first query
+    await summary_collection.bulk_write(
+        [get_chat_summary_update(query_doc) for query_doc in query_docs]
+    )
+
+
+async def delete_chat_summaries(db_conn: MongoDBConnection, chat_id: ObjectId) -> int:
+    summary_collection = db_conn.get_async_collection(CHAT_SUMMARY_COLLECTION)
+    result = await summary_collection.delete_many({"chat_id": chat_id})
+    return result.deleted_count
+
+
+async def get_chat_summaries(
+    db_conn: MongoDBConnection,
+    username: str,
+    limit: int,
+    skip: int = 0,
+    after: Optional[dict] = None,
+) -> list[dict]:
+    """
+    Return the summaries of a user's chats, newest first.
+    `after` is a filter that only matches the chats after a position in the list (see get_after_chat_filter).
+    """
+    summary_collection = db_conn.get_async_collection(CHAT_SUMMARY_COLLECTION)
+    return (
+        await summary_collection.find(
+            {"username": username, **(after or {})},
+            {"_id": 0, "chat_id": 1, "query": 1, "created_utc": 1},
+        )
+        .sort([("created_utc", DESCENDING), ("chat_id", DESCENDING)])
+        .skip(skip)
+        .limit(limit)
+        .to_list()
+    )
+
+
+async def backfill_chat_summaries(db_conn: MongoDBConnection):
+    """
+    Rebuild the summaries of every chat from the query collection.
+    Messages sent while this runs may be missing from the message count of their chat.
+    """
+    query_collection = db_conn.get_async_collection("query")
+    pipeline = [
+        {"$match": {"is_deleted": False}},
+        # this sort ensures that $first in the stage below retrieves the earliest query of each chat
+        {"$sort": {"created_utc": 1}},
+        {
+            "$group": {
+                "_id": {"chat_id": "$chat_id", "username": "$username"},
+                "query": {"$first": "$query"},
+                "created_utc": {"$first": "$created_utc"},
+                "last_activity_utc": {"$max": "$created_utc"},
+                "message_count": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "chat_id": "$_id.chat_id",
+                "username": "$_id.username",
+                "query": 1,
+                "created_utc": 1,
+                "last_activity_utc": 1,
+                "message_count": 1,
+            }
+        },
+        # requires the unique index on (chat_id, username) from the index manifest
+        {
+            "$merge": {
+                "into": CHAT_SUMMARY_COLLECTION,
+                "on": ["chat_id", "username"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+    cursor = await query_collection.aggregate(pipeline, allowDiskUse=True)
+    await cursor.to_list()
+
+
+async def _main():
+    db_conn = MongoDBConnection()
+    try:
+        # the backfill relies on the is_deleted backfill and the chat_summary indexes
+        await ensure_indexes(db_conn)
+        await backfill_chat_summaries(db_conn)
+        count = await db_conn.get_async_collection(
+            CHAT_SUMMARY_COLLECTION
+        ).count_documents({})
+        print(f"Chat summaries rebuilt ({count} chats)")
+    finally:
+        await db_conn.close_async()
+        db_conn.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(_main())
@@ -1,6 +1,7 @@
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
 from pymongo.collection import Collection
+from pymongo.asynchronous.collection import AsyncCollection
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
@@ -18,12 +19,21 @@ class MongoDBConnection:
             mongo_db_name = os.environ.get("MONGO_DB_NAME")
             cls._instance.client = MongoClient(uri, maxPoolSize=10, minPoolSize=5)
             cls._instance.db = cls._instance.client[mongo_db_name]
+            # the asyncio client is used by the request path, while the synchronous client is kept
+            # for scripts and other callers that do not run inside an event loop
+            cls._instance.async_client = AsyncMongoClient(
+                uri, maxPoolSize=50, minPoolSize=5
+            )
+            cls._instance.async_db = cls._instance.async_client[mongo_db_name]
             print(f"MongoDB connection created.")
         return cls._instance
 
     def get_collection(self, collection_name) -> Collection:
         return self.db[collection_name]
 
+    def get_async_collection(self, collection_name) -> AsyncCollection:
+        return self.async_db[collection_name]
+
     def get_active_connections(self):
         try:
             server_status = self.db.command("serverStatus")
@@ -51,6 +61,11 @@ class MongoDBConnection:
             self.client.close()
             print("MongoDB connection closed.")
 
+    async def close_async(self):
+        if self.async_client:
+            await self.async_client.close()
+            print("Async MongoDB connection closed.")
+
 
 db_conn = None
 
@@ -62,7 +77,8 @@ async def lifespan(app: FastAPI):
     db_conn = MongoDBConnection()
     db_conn.print_connection_info()
     yield
-    # close the database client when the app stops
+    # close the database clients when the app stops
+    await db_conn.close_async()
     db_conn.close()
 
 
@@ -1,27 +1,75 @@
 from app.db.conn import MongoDBConnection
+from app.db.indexes import is_deleted_backfill
+from app.db.chat_summary import CHAT_SUMMARY_ENABLED, get_chat_summaries
+from app.db.pipeline_cache import prepare_pipeline, run_cached_pipeline_async
 from bson import ObjectId
+from datetime import datetime, timezone
 from typing import Optional, List
 from app.schemas.role import Role
 from app.schemas.message import Message
 from app.schemas.chat_list_response import ChatListResponse
-from pymongo.collection import Collection
+from pymongo.asynchronous.collection import AsyncCollection
 
+CHATS_PER_PAGE = 25
 
-def get_user_chats(
+
+async def get_user_chats(
     db_conn: MongoDBConnection,
     username: str,
     page: int = 0,
+    after: Optional[tuple[int, ObjectId]] = None,
+    limit: int = CHATS_PER_PAGE,
 ) -> List[ChatListResponse]:
     """
-    Return the first query document of each unique chat by this user.
-    Paginates the results, returning at most 25 chats per page.
+    Return the first query document of each unique chat by this user, newest first.
+    Returns at most `limit` chats, starting after the (created_utc, chat_id) position `after`,
+    or (deprecated, as $skip gets slower for deeper pages) at the 0-indexed `page` of 25 chats.
     """
-    query_collection: Collection = db_conn.get_collection("query")
-    LIMIT = 25
+    after_filter = get_after_chat_filter(*after) if after is not None else None
+    skip = 0 if after is not None else page * CHATS_PER_PAGE
 
-    pipeline = [
+    if CHAT_SUMMARY_ENABLED:
+        # a single indexed range read over the chat_summary collection
+        return await get_chat_summaries(
+            db_conn, username, limit=limit, skip=skip, after=after_filter
+        )
+
+    query_collection: AsyncCollection = db_conn.get_async_collection("query")
+    pipeline = get_user_chats_pipeline(username, page, after_filter, limit)
+
+    cursor = await query_collection.aggregate(pipeline)
+    first_queries = await cursor.to_list()
+
+    return first_queries
+
+
+def get_after_chat_filter(created_utc: int, chat_id: ObjectId) -> dict:
+    """Match the chats that come after a position in the chat list, which is sorted by (created_utc, chat_id) descending."""
+    return {
+        "$or": [
+            {"created_utc": {"$lt": created_utc}},
+            {"created_utc": created_utc, "chat_id": {"$lt": chat_id}},
+        ]
+    }
+
+
+def get_user_chats_pipeline(
+    username: str,
+    page: int = 0,
+    after_filter: Optional[dict] = None,
+    limit: int = CHATS_PER_PAGE,
+) -> list:
+    if after_filter is not None:
+        # continue after the last chat of the previous page instead of skipping
+        position_stages = [{"$match": after_filter}]
+    else:
+        position_stages = [{"$skip": page * CHATS_PER_PAGE}]
+
+    return [
         # find all chats that are created by the user and NOT deleted
-        {"$match": {"username": username, "is_deleted": {"$ne": True}}},
+        # once every document has is_deleted, it is matched by equality so that the partial index
+        # on username can be used
+        {"$match": {"username": username, **is_deleted_backfill.not_deleted_filter()}},
         # this sort ensures that $first in the stage below retrieves the earliest query of each chat
         {"$sort": {"created_utc": 1}},
         {
@@ -33,18 +81,17 @@ def get_user_chats(
         },
         {"$project": {"_id": 0, "chat_id": "$_id", "query": 1, "created_utc": 1}},
         # this sort ensures that the list of chats retrieved are sorted in descending order
-        {"$sort": {"created_utc": -1}},
-        {"$skip": page * LIMIT},
-        {"$limit": LIMIT},
+        # (chat_id orders chats created in the same second, so that cursors are stable)
+        {"$sort": {"created_utc": -1, "chat_id": -1}},
+        *position_stages,
+        {"$limit": limit},
     ]
 
-    first_queries = list(query_collection.aggregate(pipeline))
 
-    return first_queries
-
-
-def get_chat_by_id(db_conn: MongoDBConnection, chat_id: str, username: Optional[str]):
-    query_collection = db_conn.get_collection("query")
+async def get_chat_by_id(
+    db_conn: MongoDBConnection, chat_id: str, username: Optional[str]
+):
+    query_collection = db_conn.get_async_collection("query")
 
     try:
         object_id = ObjectId(chat_id)
@@ -64,17 +111,18 @@ def get_chat_by_id(db_conn: MongoDBConnection, chat_id: str, username: Optional[
     if username is not None:
         fields[f"votes.{username}"] = 1
 
-    existing_docs = list(
-        query_collection.find(
+    existing_docs = (
+        await query_collection.find(
             {
                 "chat_id": object_id,
-                # this will match documents where
-                # (A) "is_deleted" does not exist
-                # (B) "is_deleted" exists and is False
-                "is_deleted": {"$ne": True},
+                # see IsDeletedBackfill, matching is_deleted by equality allows the partial
+                # index on chat_id to be used
+                **is_deleted_backfill.not_deleted_filter(),
             },
             fields,
-        ).sort("created_utc", 1)
+        )
+        .sort("created_utc", 1)
+        .to_list()
     )
 
     if existing_docs:
@@ -97,38 +145,78 @@ def get_chat_by_id(db_conn: MongoDBConnection, chat_id: str, username: Optional[
     return None
 
 
-def get_response_from_pipeline(
+async def get_response_from_pipeline(
     db_conn: MongoDBConnection, collection_name: str, pipeline: list
 ):
     print(f"[INFO] Getting MongoDB pipeline response...")
-    collection = db_conn.get_collection(collection_name)
+    collection = db_conn.get_async_collection(collection_name)
 
-    if collection_name == "thread":
-        # add a $project stage to exclude selftext_embedding at the beginning of the pipeline
-        pipeline.insert(0, {"$project": {"selftext_embedding": 0, "_id": 0}})
+    # scope the pipeline to the subreddit, exclude thread embeddings and cap $limit to 10
+    pipeline = prepare_pipeline(collection_name, pipeline)
+    documents = await run_cached_pipeline_async(collection, pipeline)
+
+    return documents
 
-    # TODO: make subreddit a parameter
-    pipeline.insert(0, {"$match": {"subreddit": "sgexams"}})
 
-    # check if $limit stage exists in the pipeline
-    limit_index = next(
-        (i for i, stage in enumerate(pipeline) if "$limit" in stage), None
+async def get_query_cached_from(
+    db_conn: MongoDBConnection, query_id: str
+) -> Optional[ObjectId]:
+    """Return the id of the query whose cached answer was served for this query, if any."""
+    query_collection = db_conn.get_async_collection("query")
+    query_doc = await query_collection.find_one(
+        {"_id": ObjectId(query_id)}, {"_id": 0, "cached_from": 1}
     )
+    return query_doc.get("cached_from") if query_doc is not None else None
 
-    if limit_index is not None:
-        # if $limit exists, update it to be at most 10
-        original_limit = pipeline[limit_index]["$limit"]
-        pipeline[limit_index]["$limit"] = min(10, original_limit)
-    else:
-        # if $limit doesn't exist, add it to the end of the pipeline
-        pipeline.append({"$limit": 10})
 
-    # a strength of 1 ignores case and diacritics
-    documents = list(
-        collection.aggregate(pipeline, collation={"locale": "en", "strength": 1})
-    )
+async def get_semantic_cache_match(
+    db_conn: MongoDBConnection,
+    query_embedding: list[float],
+    routes: List[str],
+    min_score: float,
+) -> Optional[dict]:
+    """
+    Return the closest unexpired cached answer for one of the given routes, or None.
+    Requires an Atlas vector search index named "semantic_cache_vector_index" on the "embedding" field.
+    """
+    cache_collection = db_conn.get_async_collection("semantic_cache")
 
-    return documents
+    pipeline = [
+        {
+            "$vectorSearch": {
+                "index": "semantic_cache_vector_index",
+                "queryVector": query_embedding,
+                "path": "embedding",
+                "numCandidates": 50,
+                # fetch a few candidates as some may be expired or belong to a disabled route
+                "limit": 5,
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "query_id": 1,
+                "route": 1,
+                "response": 1,
+                "expires_at": 1,
+                "score": {"$meta": "vectorSearchScore"},
+            }
+        },
+        {
+            "$match": {
+                "score": {"$gte": min_score},
+                "route": {"$in": routes},
+                # the TTL monitor only runs every minute, so expired entries may still exist
+                "expires_at": {"$gt": datetime.now(timezone.utc)},
+            }
+        },
+        {"$sort": {"score": -1}},
+        {"$limit": 1},
+    ]
+
+    cursor = await cache_collection.aggregate(pipeline)
+    matches = await cursor.to_list()
+    return matches[0] if matches else None
 
 
 def get_thread_metadata_and_top_comments(
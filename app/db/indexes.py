@@ -0,0 +1,366 @@
+"""
+Index Manifest and Advisor
+
+Declares the indexes that the read paths rely on and applies them idempotently, at startup (when
+DB_ENSURE_INDEXES=true) or with `python -m app.db.indexes apply`.
+
+The query collection is read through partial indexes that only contain documents that are not
+deleted. A partial index is only used when the query implies its filter, so chats are read with
+{"is_deleted": False} once every query document carries the field. Older documents are backfilled
+by ensure_indexes, which records the backfill in the "migration" collection. Until the app has seen
+that record (checked at startup), chats are read with {"is_deleted": {"$ne": True}}, which also
+matches the documents without the field.
+
+The advisor (`python -m app.db.indexes advise`) reads the pipelines stored in query documents and
+reports the recurring filters and sorts that no existing index supports.
+"""
+
+import os
+import time
+import argparse
+from collections import Counter
+from typing import Optional
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collation import Collation
+from pymongo.errors import OperationFailure
+from app.db.conn import MongoDBConnection
+from app.db.pipeline_cache import prepare_pipeline
+
+load_dotenv()
+
+DB_ENSURE_INDEXES = os.environ.get("DB_ENSURE_INDEXES", "true").lower() == "true"
+
+# matches the query documents that are not deleted, once every query document has is_deleted
+NOT_DELETED = {"is_deleted": False}
+# also matches the query documents written before is_deleted was set on insert
+NOT_DELETED_LEGACY = {"is_deleted": {"$ne": True}}
+MIGRATION_COLLECTION = "migration"
+IS_DELETED_BACKFILL_ID = "is_deleted_backfill"
+# agent pipelines run with this collation, and an index is only used for string comparisons
+# (e.g. the subreddit $match and $lookup joins) when its collation is the same
+AGENT_COLLATION = Collation(locale="en", strength=1)
+
+INDEX_MANIFEST: dict[str, list[IndexModel]] = {
+    "query": [
+        # get_user_chats
+        IndexModel(
+            [("username", ASCENDING), ("created_utc", ASCENDING)],
+            name="username_created_utc_not_deleted",
+            partialFilterExpression=NOT_DELETED,
+        ),
+        # get_chat_by_id
+        IndexModel(
+            [("chat_id", ASCENDING), ("created_utc", ASCENDING)],
+            name="chat_id_created_utc_not_deleted",
+            partialFilterExpression=NOT_DELETED,
+        ),
+    ],
+    "chat_summary": [
+        # upserts by insert_query_document and the $merge of the backfill
+        IndexModel(
+            [("chat_id", ASCENDING), ("username", ASCENDING)],
+            name="chat_id_username",
+            unique=True,
+        ),
+        # get_chat_summaries, where chat_id orders chats created in the same second
+        IndexModel(
+            [
+                ("username", ASCENDING),
+                ("created_utc", DESCENDING),
+                ("chat_id", DESCENDING),
+            ],
+            name="username_created_utc_chat_id",
+        ),
+    ],
+    "thread": [
+        IndexModel(
+            [("subreddit", ASCENDING), ("score", DESCENDING)],
+            name="subreddit_score",
+            collation=AGENT_COLLATION,
+        ),
+        IndexModel(
+            [("subreddit", ASCENDING), ("created_utc", DESCENDING)],
+            name="subreddit_created_utc",
+            collation=AGENT_COLLATION,
+        ),
+        IndexModel(
+            [("subreddit", ASCENDING), ("topic", ASCENDING), ("score", DESCENDING)],
+            name="subreddit_topic_score",
+            collation=AGENT_COLLATION,
+        ),
+        # $lookup from comments (comment.link_id == thread.name)
+        IndexModel([("name", ASCENDING)], name="name", collation=AGENT_COLLATION),
+    ],
+    "comment": [
+        # $lookup from threads, and filters on the comments of a thread
+        IndexModel(
+            [("link_id", ASCENDING), ("score", DESCENDING)],
+            name="link_id_score",
+            collation=AGENT_COLLATION,
+        ),
+        IndexModel(
+            [("subreddit", ASCENDING), ("author", ASCENDING)],
+            name="subreddit_author",
+            collation=AGENT_COLLATION,
+        ),
+        IndexModel(
+            [("subreddit", ASCENDING), ("score", DESCENDING)],
+            name="subreddit_score",
+            collation=AGENT_COLLATION,
+        ),
+    ],
+}
+
+
+class IsDeletedBackfill:
+    """Whether every query document is known to have is_deleted, which decides how chats are read."""
+
+    def __init__(self):
+        self.is_confirmed = False
+
+    def not_deleted_filter(self) -> dict:
+        """The filter that matches the query documents that are not deleted."""
+        return NOT_DELETED if self.is_confirmed else NOT_DELETED_LEGACY
+
+    async def load(self, db_conn: MongoDBConnection) -> bool:
+        """Check whether the backfill has completed, e.g. in another process."""
+        migration_collection = db_conn.get_async_collection(MIGRATION_COLLECTION)
+        marker = await migration_collection.find_one({"_id": IS_DELETED_BACKFILL_ID})
+        self.is_confirmed = marker is not None
+        return self.is_confirmed
+
+    async def run(self, db_conn: MongoDBConnection) -> int:
+        """
+        Set is_deleted to False on query documents without it, so that the partial indexes include
+        them, then record that the backfill has completed. Running it again is harmless.
+        """
+        query_collection = db_conn.get_async_collection("query")
+        result = await query_collection.update_many(
+            {"is_deleted": {"$exists": False}}, {"$set": NOT_DELETED}
+        )
+        migration_collection = db_conn.get_async_collection(MIGRATION_COLLECTION)
+        await migration_collection.update_one(
+            {"_id": IS_DELETED_BACKFILL_ID},
+            {"$setOnInsert": {"completed_utc": int(time.time())}},
+            upsert=True,
+        )
+        self.is_confirmed = True
+        return result.modified_count
+
+
+is_deleted_backfill = IsDeletedBackfill()
+
+
+async def ensure_indexes(db_conn: MongoDBConnection) -> dict[str, list[str]]:
+    """
+    Create the indexes of the manifest that do not exist yet and return their names by collection.
+    Existing indexes are left alone, so this is cheap once every index exists.
+    Query documents are backfilled with is_deleted first, unless that has completed before. A
+    failed backfill raises, and chats are then still read with NOT_DELETED_LEGACY.
+    """
+    if not await is_deleted_backfill.load(db_conn):
+        backfilled = await is_deleted_backfill.run(db_conn)
+        print(f"[INFO] Backfilled is_deleted on {backfilled} query documents")
+
+    created = {}
+    for collection_name, indexes in INDEX_MANIFEST.items():
+        collection = db_conn.get_async_collection(collection_name)
+        existing = await collection.index_information()
+        missing = [index for index in indexes if index.document["name"] not in existing]
+        if not missing:
+            continue
+
+        try:
+            created[collection_name] = await collection.create_indexes(missing)
+        except OperationFailure as e:
+            # e.g. an index with the same keys but other options was created by hand
+            print(f"[WARNING] Failed to create indexes on {collection_name}: {e}")
+            continue
+        print(
+            f"[INFO] Created indexes on {collection_name}: {created[collection_name]}"
+        )
+    return created
+
+
+def get_access_pattern(collection_name: str, pipeline: list) -> Optional[dict]:
+    """
+    Return the fields that a pipeline filters on with equality, filters on with a range and sorts on
+    before its first stage that cannot use an index, or None if the pipeline is malformed.
+    """
+    try:
+        pipeline = prepare_pipeline(collection_name, pipeline)
+    except (TypeError, KeyError, AttributeError):
+        return None
+
+    equality, ranges, sort = set(), set(), []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            return None
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            # MongoDB coalesces consecutive $match stages
+            _add_match_fields(spec, equality, ranges)
+        elif name == "$project" and all(value in (0, False) for value in spec.values()):
+            # an exclusion projection does not stop the stages after it from using an index
+            continue
+        else:
+            if name == "$sort":
+                sort = list(spec.items())
+            break
+    return {"equality": equality, "ranges": ranges - equality, "sort": sort}
+
+
+def _add_match_fields(query: dict, equality: set, ranges: set):
+    for field, condition in query.items():
+        if field == "$and":
+            for clause in condition:
+                _add_match_fields(clause, equality, ranges)
+        elif field.startswith("$"):
+            # $or, $expr and $text need differently shaped indexes, so they are not advised on
+            continue
+        elif isinstance(condition, dict) and any(
+            key.startswith("$") for key in condition
+        ):
+            if set(condition) <= {"$eq", "$in"}:
+                equality.add(field)
+            else:
+                ranges.add(field)
+        else:
+            equality.add(field)
+
+
+def is_supported(index_fields: list[str], pattern: dict) -> bool:
+    """
+    Whether an index serves a pattern following the equality, sort, range rule: its leading fields
+    are the equality fields, followed by the sort fields or, without a sort, a range field.
+    """
+    equality = pattern["equality"]
+    if set(index_fields[: len(equality)]) != equality:
+        return False
+    rest = index_fields[len(equality) :]
+    if pattern["sort"]:
+        sort_fields = [field for field, _ in pattern["sort"]]
+        return rest[: len(sort_fields)] == sort_fields
+    if pattern["ranges"]:
+        return bool(rest) and rest[0] in pattern["ranges"]
+    return True
+
+
+def suggest_index(pattern: dict) -> list[tuple[str, int]]:
+    """The index keys that would serve a pattern, with subreddit first as every pipeline filters on it."""
+    equality = sorted(
+        pattern["equality"], key=lambda field: (field != "subreddit", field)
+    )
+    sort_fields = {field for field, _ in pattern["sort"]}
+    return (
+        [(field, ASCENDING) for field in equality]
+        + list(pattern["sort"])
+        + [
+            (field, ASCENDING)
+            for field in sorted(pattern["ranges"])
+            if field not in sort_fields
+        ]
+    )
+
+
+async def advise(
+    db_conn: MongoDBConnection, limit: int = 1000, min_count: int = 2
+) -> list[dict]:
+    """
+    Report the access patterns of the last `limit` stored pipelines that occur at least `min_count`
+    times and that no existing index supports, most frequent first.
+    """
+    query_collection = db_conn.get_async_collection("query")
+    query_docs = (
+        await query_collection.find(
+            {"pipeline": {"$exists": True}, "collection_name": {"$exists": True}},
+            {"pipeline": 1, "collection_name": 1},
+        )
+        .sort("created_utc", DESCENDING)
+        .limit(limit)
+        .to_list()
+    )
+
+    patterns = Counter()
+    for query_doc in query_docs:
+        pattern = get_access_pattern(
+            query_doc["collection_name"], query_doc["pipeline"]
+        )
+        if pattern is None or not (pattern["equality"] or pattern["sort"]):
+            continue
+        key = (
+            query_doc["collection_name"],
+            tuple(sorted(pattern["equality"])),
+            tuple(sorted(pattern["ranges"])),
+            tuple(pattern["sort"]),
+        )
+        patterns[key] += 1
+
+    index_fields = {}
+    report = []
+    for (collection_name, equality, ranges, sort), count in patterns.most_common():
+        if count < min_count:
+            break
+        if collection_name not in index_fields:
+            indexes = await db_conn.get_async_collection(
+                collection_name
+            ).index_information()
+            index_fields[collection_name] = [
+                [field for field, _ in index["key"]] for index in indexes.values()
+            ]
+        pattern = {"equality": set(equality), "ranges": set(ranges), "sort": list(sort)}
+        if any(
+            is_supported(fields, pattern) for fields in index_fields[collection_name]
+        ):
+            continue
+        report.append(
+            {
+                "collection": collection_name,
+                "count": count,
+                "equality": list(equality),
+                "ranges": list(ranges),
+                "sort": list(sort),
+                "suggested_index": suggest_index(pattern),
+            }
+        )
+    return report
+
+
+async def _main(args):
+    db_conn = MongoDBConnection()
+    try:
+        if args.command == "apply":
+            created = await ensure_indexes(db_conn)
+            if not created:
+                print("All indexes already exist")
+        else:
+            report = await advise(db_conn, limit=args.limit, min_count=args.min_count)
+            if not report:
+                print("Every recurring filter and sort is supported by an index")
+            for entry in report:
+                print(
+                    f"{entry['count']:>5}x {entry['collection']}: equality={entry['equality']} "
+                    f"ranges={entry['ranges']} sort={entry['sort']}\n"
+                    f"       suggested index: {entry['suggested_index']}"
+                )
+    finally:
+        await db_conn.close_async()
+        db_conn.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="Apply or advise on MongoDB indexes")
+    parser.add_argument("command", choices=["apply", "advise"])
+    parser.add_argument(
+        "--limit", type=int, default=1000, help="number of recent pipelines to read"
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=2,
+        help="only report patterns that occur at least this often",
+    )
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,217 @@
+"""
+Query Document Persistence Queue
+
+Without it, POST /queries waits for the query document to be inserted before it returns, and the
+streaming endpoint holds the connection open until the insert finishes. When
+PERSISTENCE_QUEUE_ENABLED=true, the request path only enqueues the document instead:
+- a worker task takes up to PERSISTENCE_BATCH_SIZE documents at a time from a queue bounded by
+  PERSISTENCE_QUEUE_MAX_SIZE (requests wait for space when it is full), inserts them with one
+  insert_many and then updates their chat summaries
+- transient errors are retried up to PERSISTENCE_MAX_RETRIES times with a backoff. Documents that
+  still cannot be written are appended to the journal at PERSISTENCE_JOURNAL_PATH
+- on shutdown, the queue is drained before the database clients close
+- on startup, the journal is replayed. Inserts ignore documents that already exist, so a batch may
+  be written again safely
+"""
+
+import os
+import asyncio
+from typing import Optional
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo.errors import (
+    BulkWriteError,
+    ConnectionFailure,
+    PyMongoError,
+)
+from app.db.conn import MongoDBConnection
+from app.db.chat_summary import upsert_chat_summaries
+
+load_dotenv()
+
+PERSISTENCE_QUEUE_ENABLED = (
+    os.environ.get("PERSISTENCE_QUEUE_ENABLED", "false").lower() == "true"
+)
+PERSISTENCE_QUEUE_MAX_SIZE = int(os.environ.get("PERSISTENCE_QUEUE_MAX_SIZE", 1000))
+PERSISTENCE_BATCH_SIZE = int(os.environ.get("PERSISTENCE_BATCH_SIZE", 50))
+PERSISTENCE_MAX_RETRIES = int(os.environ.get("PERSISTENCE_MAX_RETRIES", 3))
+PERSISTENCE_JOURNAL_PATH = os.environ.get(
+    "PERSISTENCE_JOURNAL_PATH", "query_journal.jsonl"
+)
+# delay before the first retry, doubled for every further retry
+PERSISTENCE_RETRY_DELAY = 0.5
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+
+def is_transient_error(e: PyMongoError) -> bool:
+    """Whether a write may succeed when it is retried, e.g. after a network error or a failover."""
+    return isinstance(e, ConnectionFailure) or e.has_error_label("RetryableWriteError")
+
+
+class QueryPersistenceQueue:
+    def __init__(
+        self,
+        enabled: bool = PERSISTENCE_QUEUE_ENABLED,
+        max_size: int = PERSISTENCE_QUEUE_MAX_SIZE,
+        batch_size: int = PERSISTENCE_BATCH_SIZE,
+        max_retries: int = PERSISTENCE_MAX_RETRIES,
+        journal_path: str = PERSISTENCE_JOURNAL_PATH,
+    ):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.batch_size = max(1, batch_size)
+        self.max_retries = max_retries
+        self.journal_path = journal_path
+        self._queue: Optional[asyncio.Queue] = None
+        self._db_conn: Optional[MongoDBConnection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._is_closing = False
+        self._stats = {
+            "enqueued": 0,
+            "inserted": 0,
+            "batches": 0,
+            "retries": 0,
+            "journaled": 0,
+            "replayed": 0,
+        }
+
+    @property
+    def is_running(self) -> bool:
+        """Whether documents should be enqueued, i.e. the queue is enabled and its worker runs."""
+        return self._task is not None and not self._is_closing
+
+    def start(self, db_conn: MongoDBConnection):
+        if not self.enabled or self._task is not None:
+            return
+        self._db_conn = db_conn
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._task = asyncio.create_task(self._run())
+        print(
+            f"[INFO] Query persistence queue started (batches of up to {self.batch_size})"
+        )
+        self._replay_journal()
+
+    async def close(self):
+        """Write every queued document, then stop the worker."""
+        if self._task is None:
+            return
+        # documents enqueued before this point are written before the sentinel is reached
+        self._is_closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        print("[INFO] Query persistence queue drained")
+
+    async def enqueue(self, query_doc: dict):
+        """Queue a query document for insertion, waiting for space if the queue is full."""
+        await self._queue.put(query_doc)
+        self._stats["enqueued"] += 1
+
+    async def _run(self):
+        while True:
+            query_doc = await self._queue.get()
+            batch = []
+            is_closed = query_doc is None
+            if not is_closed:
+                batch.append(query_doc)
+            while not is_closed and len(batch) < self.batch_size:
+                try:
+                    query_doc = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if query_doc is None:
+                    is_closed = True
+                else:
+                    batch.append(query_doc)
+
+            if batch:
+                try:
+                    await self._write_batch(batch)
+                except Exception as e:
+                    # never lose a document because of an unexpected error
+                    print(
+                        f"[WARNING] Failed to persist {len(batch)} query documents: {e}"
+                    )
+                    self._write_journal(batch)
+            if is_closed:
+                return
+
+    async def _write_batch(self, batch: list[dict]):
+        """Insert a batch and update its chat summaries, retrying transient errors."""
+        pending = batch
+        summarised = False
+        for attempt in range(self.max_retries + 1):
+            try:
+                if pending:
+                    await self._insert(pending)
+                    pending = []
+                if not summarised:
+                    await upsert_chat_summaries(self._db_conn, batch)
+                    summarised = True
+                self._stats["batches"] += 1
+                return
+            except PyMongoError as e:
+                if not is_transient_error(e) or attempt == self.max_retries:
+                    print(
+                        f"[WARNING] Failed to persist {len(batch)} query documents, "
+                        f"writing them to {self.journal_path}: {e}"
+                    )
+                    # on replay, inserted documents are skipped, but their summaries are updated
+                    # again (so a summary that was updated before the error is counted twice)
+                    self._write_journal(batch)
+                    return
+                self._stats["retries"] += 1
+                await asyncio.sleep(PERSISTENCE_RETRY_DELAY * 2**attempt)
+
+    async def _insert(self, query_docs: list[dict]):
+        query_collection = self._db_conn.get_async_collection("query")
+        try:
+            result = await query_collection.insert_many(query_docs, ordered=False)
+            self._stats["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            # documents that were inserted by an earlier attempt (or before a replay) are fine
+            if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in errors):
+                raise
+            self._stats["inserted"] += e.details.get("nInserted", 0)
+
+    def _write_journal(self, query_docs: list[dict]):
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            for query_doc in query_docs:
+                # extended JSON keeps ObjectIds and other BSON types
+                journal.write(json_util.dumps(query_doc) + "\n")
+        self._stats["journaled"] += len(query_docs)
+
+    def _replay_journal(self):
+        """Queue the documents of the journal left by an earlier run."""
+        if not os.path.exists(self.journal_path):
+            return
+        # claim the journal, so that other workers of the app do not replay it as well
+        replay_path = f"{self.journal_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.journal_path, replay_path)
+        except FileNotFoundError:
+            return
+
+        with open(replay_path, encoding="utf-8") as journal:
+            query_docs = [json_util.loads(line) for line in journal if line.strip()]
+        for i, query_doc in enumerate(query_docs):
+            try:
+                self._queue.put_nowait(query_doc)
+            except asyncio.QueueFull:
+                # keep the rest for the next start
+                self._write_journal(query_docs[i:])
+                break
+            self._stats["replayed"] += 1
+        os.remove(replay_path)
+        print(f"[INFO] Replaying {self._stats['replayed']} journaled query documents")
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "enabled": self.enabled,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+persistence_queue = QueryPersistenceQueue()
@@ -0,0 +1,345 @@
+"""
+Pipeline Result Cache
+
+Caches the documents returned by aggregation pipelines, keyed on the collection and a canonical
+serialisation of the final pipeline (i.e. after prepare_pipeline has applied the subreddit match,
+projection and $limit rewrites). Both get_response_from_pipeline and the MCP server use it.
+
+Thread and comment data only changes when new data is ingested, so entries live for hours.
+Pipelines whose result changes over time without new data (e.g. "threads from the last 7 days",
+which uses $$NOW) or on every run ($rand, $sample) are never cached.
+After an ingestion, run `python -m app.db.pipeline_cache` to bump the version marker in MongoDB.
+Every cache (the app's and each MCP server's) checks the marker periodically and clears itself
+when it changes.
+"""
+
+import os
+import copy
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import PyMongoError
+from app.db.conn import MongoDBConnection
+from app.db.pipeline_guard import (
+    aggregate_options,
+    guard_pipeline,
+    guard_pipeline_async,
+    to_cost_error,
+)
+from app.db.pipeline_optimiser import optimise_pipeline
+
+load_dotenv()
+
+PIPELINE_CACHE_ENABLED = (
+    os.environ.get("PIPELINE_CACHE_ENABLED", "false").lower() == "true"
+)
+PIPELINE_CACHE_TTL_SECONDS = int(
+    os.environ.get("PIPELINE_CACHE_TTL_SECONDS", 6 * 60 * 60)
+)
+PIPELINE_CACHE_MAX_ENTRIES = int(os.environ.get("PIPELINE_CACHE_MAX_ENTRIES", 512))
+# only collections that change through ingestion are cached, e.g. not the "query" collection
+PIPELINE_CACHE_COLLECTIONS = [
+    collection.strip()
+    for collection in os.environ.get(
+        "PIPELINE_CACHE_COLLECTIONS", "thread,comment"
+    ).split(",")
+    if collection.strip()
+]
+# how often the version marker is read to find out whether new data has been ingested
+PIPELINE_CACHE_VERSION_CHECK_SECONDS = 30
+PIPELINE_CACHE_VERSION_COLLECTION = "cache_version"
+PIPELINE_CACHE_VERSION_ID = "pipeline_cache"
+# variables and operators that make a pipeline's result depend on when (or how often) it runs
+VOLATILE_PIPELINE_TOKENS = ['"$$NOW', '"$$CLUSTER_TIME', '"$rand"', '"$sample"']
+
+# keys whose object values are orders, e.g. {"$sort": {"score": -1, "created_utc": -1}} or the
+# sortBy of $setWindowFields, $topN, $bottomN, $firstN, $lastN and $sortArray
+ORDER_SENSITIVE_KEYS = {"$sort", "sortBy"}
+
+# the subreddit that every pipeline is scoped to
+SUBREDDIT = "sgexams"
+MAX_PIPELINE_LIMIT = 10
+
+
+def prepare_pipeline(collection_name: str, pipeline: list) -> list:
+    """
+    Return an optimised copy of the pipeline that is scoped to the subreddit, excludes the
+    embedding of threads and returns at most MAX_PIPELINE_LIMIT documents.
+    """
+    pipeline = copy.deepcopy(pipeline)
+
+    if collection_name == "thread":
+        # exclude selftext_embedding (and _id) at the beginning of the pipeline
+        pipeline.insert(0, {"$project": {"selftext_embedding": 0, "_id": 0}})
+
+    # TODO: make subreddit a parameter
+    pipeline.insert(0, {"$match": {"subreddit": SUBREDDIT}})
+
+    # check if $limit stage exists in the pipeline
+    limit_index = next(
+        (i for i, stage in enumerate(pipeline) if "$limit" in stage), None
+    )
+
+    if limit_index is not None:
+        # if $limit exists, update it to be at most MAX_PIPELINE_LIMIT
+        original_limit = pipeline[limit_index]["$limit"]
+        pipeline[limit_index]["$limit"] = min(MAX_PIPELINE_LIMIT, original_limit)
+    else:
+        # if $limit doesn't exist, add it to the end of the pipeline
+        pipeline.append({"$limit": MAX_PIPELINE_LIMIT})
+
+    # e.g. filter and limit before joining, and keep embeddings out of joined threads
+    return optimise_pipeline(pipeline)
+
+
+def canonicalise(value, keep_order: bool = False) -> str:
+    """
+    Serialise a pipeline so that equivalent pipelines produce the same string.
+    Object keys are sorted, except inside $sort and sortBy where their order changes the result.
+    """
+    if isinstance(value, dict):
+        items = value.items() if keep_order else sorted(value.items())
+        fields = [
+            f"{json.dumps(key)}:{canonicalise(item, keep_order=key in ORDER_SENSITIVE_KEYS)}"
+            for key, item in items
+        ]
+        return "{" + ",".join(fields) + "}"
+    if isinstance(value, list):
+        return "[" + ",".join(canonicalise(item) for item in value) + "]"
+    return json.dumps(value, default=str)
+
+
+def is_volatile(pipeline: list) -> bool:
+    """Whether a pipeline's result depends on the current time or on randomness."""
+    canonical = canonicalise(pipeline)
+    return any(token in canonical for token in VOLATILE_PIPELINE_TOKENS)
+
+
+class PipelineCache:
+    """An in-memory LRU of pipeline results with a TTL, safe to use from several threads."""
+
+    def __init__(
+        self,
+        enabled: bool = PIPELINE_CACHE_ENABLED,
+        ttl_seconds: int = PIPELINE_CACHE_TTL_SECONDS,
+        max_entries: int = PIPELINE_CACHE_MAX_ENTRIES,
+        collections: list[str] = PIPELINE_CACHE_COLLECTIONS,
+    ):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.collections = collections
+        # key -> (expires_at, documents)
+        self._entries: OrderedDict[str, tuple[float, list]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._version_checked_at = 0.0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "volatile": 0,
+        }
+
+    def is_cacheable(self, collection_name: str, pipeline: list) -> bool:
+        if not self.enabled or collection_name not in self.collections:
+            return False
+        if is_volatile(pipeline):
+            self._stats["volatile"] += 1
+            return False
+        return True
+
+    @staticmethod
+    def make_key(collection_name: str, pipeline: list) -> str:
+        digest = hashlib.sha256(canonicalise(pipeline).encode("utf-8")).hexdigest()
+        return f"{collection_name}:{digest}"
+
+    def get(self, collection_name: str, pipeline: list) -> Optional[list]:
+        """
+        Return the cached documents of a pipeline, or None.
+        The documents are shared with the cache and must not be modified.
+        """
+        key = self.make_key(collection_name, pipeline)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return list(entry[1])
+
+    def set(self, collection_name: str, pipeline: list, documents: list):
+        key = self.make_key(collection_name, pipeline)
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, list(documents))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self) -> int:
+        with self._lock:
+            cleared = len(self._entries)
+            self._entries.clear()
+            self._stats["invalidations"] += cleared
+            return cleared
+
+    def is_version_check_due(self) -> bool:
+        return (
+            time.time() - self._version_checked_at
+            >= PIPELINE_CACHE_VERSION_CHECK_SECONDS
+        )
+
+    def apply_version(self, marker: Optional[dict]):
+        """Clear the cache if the version marker changed since the last check."""
+        version = marker["version"] if marker else 0
+        self._version_checked_at = time.time()
+        if self._version is not None and version != self._version:
+            cleared = self.clear()
+            print(
+                f"[INFO] Pipeline cache invalidated (version {self._version} -> {version}), "
+                f"cleared {cleared} entries"
+            )
+        self._version = version
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "version": self._version,
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+        }
+
+
+pipeline_cache = PipelineCache()
+
+
+def _version_filter() -> dict:
+    return {"_id": PIPELINE_CACHE_VERSION_ID}
+
+
+def run_cached_pipeline(
+    collection: Collection, pipeline: list, comment: Optional[str] = None
+) -> list:
+    """
+    Run a prepared pipeline on a synchronous collection, serving repeated pipelines from the cache.
+    Raises PipelineTooExpensiveError if the pipeline is rejected or exceeds its budget.
+    The comment tags the aggregation, e.g. so that it can be killed if its query is cancelled.
+    """
+    is_cacheable = pipeline_cache.is_cacheable(collection.name, pipeline)
+    if is_cacheable:
+        if pipeline_cache.is_version_check_due():
+            version_collection = collection.database[PIPELINE_CACHE_VERSION_COLLECTION]
+            pipeline_cache.apply_version(version_collection.find_one(_version_filter()))
+
+        documents = pipeline_cache.get(collection.name, pipeline)
+        if documents is not None:
+            return documents
+
+    guard_pipeline(collection, pipeline)
+    try:
+        # a strength of 1 ignores case and diacritics
+        documents = list(
+            collection.aggregate(
+                pipeline,
+                collation={"locale": "en", "strength": 1},
+                comment=comment,
+                **aggregate_options(),
+            )
+        )
+    except PyMongoError as e:
+        cost_error = to_cost_error(e)
+        if cost_error is None:
+            raise
+        raise cost_error from e
+
+    if is_cacheable:
+        pipeline_cache.set(collection.name, pipeline, documents)
+    return documents
+
+
+async def run_cached_pipeline_async(
+    collection: AsyncCollection, pipeline: list, comment: Optional[str] = None
+) -> list:
+    """
+    Run a prepared pipeline on an asyncio collection, serving repeated pipelines from the cache.
+    Raises PipelineTooExpensiveError if the pipeline is rejected or exceeds its budget.
+    The comment tags the aggregation, e.g. so that it can be killed if its query is cancelled.
+    """
+    is_cacheable = pipeline_cache.is_cacheable(collection.name, pipeline)
+    if is_cacheable:
+        if pipeline_cache.is_version_check_due():
+            version_collection = collection.database[PIPELINE_CACHE_VERSION_COLLECTION]
+            pipeline_cache.apply_version(
+                await version_collection.find_one(_version_filter())
+            )
+
+        documents = pipeline_cache.get(collection.name, pipeline)
+        if documents is not None:
+            return documents
+
+    await guard_pipeline_async(collection, pipeline)
+    try:
+        # a strength of 1 ignores case and diacritics
+        cursor = await collection.aggregate(
+            pipeline,
+            collation={"locale": "en", "strength": 1},
+            comment=comment,
+            **aggregate_options(),
+        )
+        documents = await cursor.to_list()
+    except PyMongoError as e:
+        cost_error = to_cost_error(e)
+        if cost_error is None:
+            raise
+        raise cost_error from e
+
+    if is_cacheable:
+        pipeline_cache.set(collection.name, pipeline, documents)
+    return documents
+
+
+async def invalidate(db_conn: MongoDBConnection) -> int:
+    """Bump the version marker so that every pipeline cache clears itself on its next check."""
+    version_collection = db_conn.get_async_collection(PIPELINE_CACHE_VERSION_COLLECTION)
+    marker = await version_collection.find_one_and_update(
+        _version_filter(),
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    pipeline_cache.clear()
+    return marker["version"]
+
+
+async def _main():
+    db_conn = MongoDBConnection()
+    try:
+        version = await invalidate(db_conn)
+        print(f"Pipeline caches will be invalidated (version {version})")
+    finally:
+        await db_conn.close_async()
+        db_conn.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(_main())
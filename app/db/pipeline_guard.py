@@ -0,0 +1,226 @@
+"""
+Pipeline Cost Guard
+
+Keeps LLM-generated pipelines from tying up the database:
+- every pipeline runs with a time budget (maxTimeMS) and without spilling to disk, so a stage that
+  needs more than MongoDB's 100MB in-memory limit fails instead of running for a long time
+- optionally, the query plan is explained first, and pipelines that would scan more than
+  PIPELINE_MAX_UNINDEXED_DOCS documents without an index are rejected before they run
+
+A rejected or aborted pipeline raises PipelineTooExpensiveError, which the MCP server returns to the
+agent as a structured error so that it can retry with a cheaper pipeline.
+"""
+
+import os
+import time
+from typing import Optional
+from dotenv import load_dotenv
+from pymongo.collection import Collection
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import ExecutionTimeout, OperationFailure, PyMongoError
+
+load_dotenv()
+
+PIPELINE_MAX_TIME_MS = int(os.environ.get("PIPELINE_MAX_TIME_MS", 10000))
+# allowing disk use lifts the 100MB memory limit of blocking stages such as $group and $sort
+PIPELINE_ALLOW_DISK_USE = (
+    os.environ.get("PIPELINE_ALLOW_DISK_USE", "false").lower() == "true"
+)
+# explain every pipeline before running it (one extra round-trip on each cache miss)
+PIPELINE_EXPLAIN_ENABLED = (
+    os.environ.get("PIPELINE_EXPLAIN_ENABLED", "false").lower() == "true"
+)
+PIPELINE_MAX_UNINDEXED_DOCS = int(os.environ.get("PIPELINE_MAX_UNINDEXED_DOCS", 50000))
+# how long collection sizes and index lists used by the explain check are reused
+COLLECTION_INFO_TTL_SECONDS = 300
+# MongoDB error code of a blocking stage that exceeded its memory limit without allowDiskUse
+MEMORY_LIMIT_EXCEEDED_CODE = 292
+
+REFINE_SUGGESTION = (
+    "Refine your query: add a $match on a selective field (e.g. created_utc, score, author, "
+    "topic) and a $limit as early as possible, and avoid $lookup or $group over whole collections."
+)
+
+
+class PipelineTooExpensiveError(Exception):
+    """Raised when a pipeline is rejected or aborted because it would cost too much."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+    def to_dict(self) -> dict:
+        return {
+            "error": "Query too expensive",
+            "reason": self.reason,
+            "suggestion": REFINE_SUGGESTION,
+        }
+
+
+def aggregate_options() -> dict:
+    """The per-call time and memory budget of a pipeline."""
+    return {"maxTimeMS": PIPELINE_MAX_TIME_MS, "allowDiskUse": PIPELINE_ALLOW_DISK_USE}
+
+
+def to_cost_error(e: PyMongoError) -> Optional[PipelineTooExpensiveError]:
+    """Translate a MongoDB error caused by a budget into PipelineTooExpensiveError, or return None."""
+    if isinstance(e, ExecutionTimeout):
+        return PipelineTooExpensiveError(
+            f"The query exceeded its time budget of {PIPELINE_MAX_TIME_MS}ms"
+        )
+    if isinstance(e, OperationFailure) and e.code == MEMORY_LIMIT_EXCEEDED_CODE:
+        return PipelineTooExpensiveError(
+            "The query exceeded its memory budget, e.g. by grouping or sorting too many documents"
+        )
+    return None
+
+
+def has_collection_scan(plan) -> bool:
+    """Whether an explain output contains a COLLSCAN stage anywhere in its plans."""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(has_collection_scan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(has_collection_scan(item) for item in plan)
+    return False
+
+
+def get_lookups(pipeline: list) -> list[tuple[str, str]]:
+    """The (foreign collection, foreign field) of every top-level equality $lookup."""
+    return [
+        (stage["$lookup"]["from"], stage["$lookup"]["foreignField"])
+        for stage in pipeline
+        if "$lookup" in stage
+        and "from" in stage["$lookup"]
+        and "foreignField" in stage["$lookup"]
+    ]
+
+
+def has_index_on(index_information: dict, field: str) -> bool:
+    """Whether an index can serve equality lookups on a field, i.e. the field is its first key."""
+    return any(index["key"][0][0] == field for index in index_information.values())
+
+
+def check_cost(
+    collection_name: str,
+    is_collection_scan: bool,
+    document_count: int,
+    lookups: list[tuple[str, str, bool, int]],
+):
+    """
+    Reject a pipeline that would scan more than PIPELINE_MAX_UNINDEXED_DOCS documents without an index.
+    Each lookup is (foreign collection, foreign field, whether the field is indexed, foreign count).
+    """
+    if is_collection_scan and document_count > PIPELINE_MAX_UNINDEXED_DOCS:
+        raise PipelineTooExpensiveError(
+            f"The query scans the whole '{collection_name}' collection ({document_count} documents) "
+            "because no index matches its first $match"
+        )
+    for foreign_collection, foreign_field, is_indexed, foreign_count in lookups:
+        if not is_indexed and foreign_count > PIPELINE_MAX_UNINDEXED_DOCS:
+            raise PipelineTooExpensiveError(
+                f"The $lookup on '{foreign_collection}.{foreign_field}' scans all {foreign_count} "
+                f"documents of '{foreign_collection}' for every joined document because the field is not indexed"
+            )
+
+
+# (database, collection, kind) -> (loaded_at, value)
+_collection_info: dict[tuple[str, str, str], tuple[float, object]] = {}
+
+
+def _get_cached_info(database_name: str, collection_name: str, kind: str):
+    entry = _collection_info.get((database_name, collection_name, kind))
+    if entry is not None and time.time() - entry[0] < COLLECTION_INFO_TTL_SECONDS:
+        return entry[1]
+    return None
+
+
+def _set_cached_info(database_name: str, collection_name: str, kind: str, value):
+    _collection_info[(database_name, collection_name, kind)] = (time.time(), value)
+
+
+def _explain_command(collection_name: str, pipeline: list) -> dict:
+    return {
+        "aggregate": collection_name,
+        "pipeline": pipeline,
+        "cursor": {},
+        "collation": {"locale": "en", "strength": 1},
+    }
+
+
+def guard_pipeline(collection: Collection, pipeline: list):
+    """Explain a pipeline on a synchronous collection and raise if it is too expensive."""
+    if not PIPELINE_EXPLAIN_ENABLED:
+        return
+    database = collection.database
+
+    def get_info(collection_name: str, kind: str):
+        value = _get_cached_info(database.name, collection_name, kind)
+        if value is None:
+            if kind == "count":
+                value = database[collection_name].estimated_document_count()
+            else:
+                value = database[collection_name].index_information()
+            _set_cached_info(database.name, collection_name, kind, value)
+        return value
+
+    explain = database.command(
+        "explain",
+        _explain_command(collection.name, pipeline),
+        verbosity="queryPlanner",
+    )
+    check_cost(
+        collection.name,
+        has_collection_scan(explain),
+        get_info(collection.name, "count"),
+        [
+            (
+                foreign_collection,
+                foreign_field,
+                has_index_on(get_info(foreign_collection, "indexes"), foreign_field),
+                get_info(foreign_collection, "count"),
+            )
+            for foreign_collection, foreign_field in get_lookups(pipeline)
+        ],
+    )
+
+
+async def guard_pipeline_async(collection: AsyncCollection, pipeline: list):
+    """Explain a pipeline on an asyncio collection and raise if it is too expensive."""
+    if not PIPELINE_EXPLAIN_ENABLED:
+        return
+    database = collection.database
+
+    async def get_info(collection_name: str, kind: str):
+        value = _get_cached_info(database.name, collection_name, kind)
+        if value is None:
+            if kind == "count":
+                value = await database[collection_name].estimated_document_count()
+            else:
+                value = await database[collection_name].index_information()
+            _set_cached_info(database.name, collection_name, kind, value)
+        return value
+
+    explain = await database.command(
+        "explain",
+        _explain_command(collection.name, pipeline),
+        verbosity="queryPlanner",
+    )
+    lookups = []
+    for foreign_collection, foreign_field in get_lookups(pipeline):
+        index_information = await get_info(foreign_collection, "indexes")
+        lookups.append(
+            (
+                foreign_collection,
+                foreign_field,
+                has_index_on(index_information, foreign_field),
+                await get_info(foreign_collection, "count"),
+            )
+        )
+    check_cost(
+        collection.name,
+        has_collection_scan(explain),
+        await get_info(collection.name, "count"),
+        lookups,
+    )
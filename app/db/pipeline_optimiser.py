@@ -0,0 +1,298 @@
+"""
+Aggregation Pipeline Optimiser
+
+Rewrites LLM-generated aggregation pipelines into cheaper pipelines that return the same documents:
+- $match stages move before $lookup, $unwind, $addFields/$set, $unset and $sort stages that do not
+  produce the fields they filter on
+- $limit stages (and $sort + $limit pairs) move before stages that neither add nor remove documents,
+  such as $lookup, so that those stages run on fewer documents
+- $lookup stages on the thread collection never return selftext_embedding
+- $lookup stages whose joined array is only read through $slice, $first or $arrayElemAt are bounded
+  with a $limit inside the lookup
+"""
+
+import copy
+from typing import Iterable, Optional
+
+# stages that output exactly one document for every input document, in the same order
+ONE_TO_ONE_STAGES = {"$lookup", "$addFields", "$set", "$unset", "$project"}
+# collections whose documents carry embedding arrays that should never be joined into results
+EMBEDDING_FIELDS = {"thread": "selftext_embedding"}
+# stands for every field of a document, e.g. when an expression reads "$$ROOT"
+ALL_FIELDS = "*"
+
+
+def optimise_pipeline(pipeline: list) -> list:
+    """Return an equivalent, cheaper copy of the pipeline."""
+    pipeline = copy.deepcopy(pipeline)
+    if any(_stage_name(stage) is None for stage in pipeline):
+        # leave malformed stages for MongoDB to report
+        return pipeline
+    pipeline = [
+        _optimise_lookup(stage, pipeline[i + 1 :]) for i, stage in enumerate(pipeline)
+    ]
+    pipeline = _push_down_matches(pipeline)
+    pipeline = _push_down_limits(pipeline)
+    return pipeline
+
+
+def _stage_name(stage: dict) -> Optional[str]:
+    return next(iter(stage)) if len(stage) == 1 else None
+
+
+def _overlaps(path: str, other: str) -> bool:
+    """Whether two dotted field paths refer to the same field or one contains the other."""
+    if ALL_FIELDS in (path, other):
+        return True
+    return path == other or path.startswith(other + ".") or other.startswith(path + ".")
+
+
+def _referenced_fields(value) -> set[str]:
+    """
+    Collect the field paths that a query or expression reads, i.e. non-operator keys and "$field"
+    strings. This over-approximates, which only makes the optimiser more conservative.
+    """
+    fields = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not key.startswith("$"):
+                fields.add(key)
+            fields |= _referenced_fields(item)
+    elif isinstance(value, list):
+        for item in value:
+            fields |= _referenced_fields(item)
+    elif isinstance(value, str) and value.startswith(("$$ROOT", "$$CURRENT")):
+        # e.g. "$$ROOT.score" reads score, while "$$ROOT" reads every field
+        _, _, path = value.partition(".")
+        fields.add(path or ALL_FIELDS)
+    elif (
+        isinstance(value, str) and value.startswith("$") and not value.startswith("$$")
+    ):
+        fields.add(value[1:])
+    return fields
+
+
+def _written_fields(stage: dict) -> Optional[set[str]]:
+    """
+    The fields that a one-to-one stage adds, replaces or removes, or None if it may change
+    fields that it does not name (e.g. an inclusion $project drops every field it omits).
+    """
+    name = _stage_name(stage)
+    spec = stage[name]
+    if name == "$lookup":
+        return {spec["as"]}
+    if name == "$project":
+        # an exclusion projection only removes the fields it names
+        return None if _is_inclusion_projection(spec) else set(spec.keys())
+    if name in ("$addFields", "$set"):
+        return set(spec.keys())
+    if name == "$unset":
+        return {spec} if isinstance(spec, str) else set(spec)
+    if name == "$unwind":
+        path = spec if isinstance(spec, str) else spec["path"]
+        written = {path.lstrip("$")}
+        if isinstance(spec, dict) and "includeArrayIndex" in spec:
+            written.add(spec["includeArrayIndex"])
+        return written
+    return None
+
+
+def _is_untouched(fields: Iterable[str], stage: dict) -> bool:
+    written = _written_fields(stage)
+    if written is None:
+        return False
+    return not any(_overlaps(field, other) for field in fields for other in written)
+
+
+def _push_down_matches(pipeline: list) -> list:
+    """Move every $match as early as possible."""
+    for i in range(1, len(pipeline)):
+        j = i
+        while j > 0 and _stage_name(pipeline[j]) == "$match":
+            previous = pipeline[j - 1]
+            name = _stage_name(previous)
+            fields = _referenced_fields(pipeline[j]["$match"])
+            # $text must stay the first stage of the pipeline
+            if "$text" in pipeline[j]["$match"]:
+                break
+            # filtering commutes with sorting, and with stages that do not write the filtered fields
+            if name == "$sort" or (
+                name
+                in ("$lookup", "$addFields", "$set", "$unset", "$unwind", "$project")
+                and _is_untouched(fields, previous)
+            ):
+                pipeline[j - 1], pipeline[j] = pipeline[j], pipeline[j - 1]
+                j -= 1
+            else:
+                break
+    return pipeline
+
+
+def _push_down_limits(pipeline: list) -> list:
+    """Move $limit (and $sort + $limit pairs) before stages that do not change the number of documents."""
+    i = 0
+    while i < len(pipeline):
+        name = _stage_name(pipeline[i])
+        if name == "$limit":
+            start, end = i, i + 1
+        elif (
+            name == "$sort"
+            and i + 1 < len(pipeline)
+            and _stage_name(pipeline[i + 1]) == "$limit"
+        ):
+            start, end = i, i + 2
+        else:
+            i += 1
+            continue
+
+        block = pipeline[start:end]
+        sort_fields = set(block[0]["$sort"]) if len(block) == 2 else set()
+        while start > 0:
+            previous = pipeline[start - 1]
+            if _stage_name(previous) not in ONE_TO_ONE_STAGES:
+                break
+            # a one-to-one stage must not write the fields that the block sorts on
+            if sort_fields and not _is_untouched(sort_fields, previous):
+                break
+            pipeline[start - 1 : end] = [*block, previous]
+            start, end = start - 1, end - 1
+        i = end
+    return pipeline
+
+
+def _optimise_lookup(stage: dict, later_stages: list) -> dict:
+    """Keep embeddings out of joined documents and bound the join when only a prefix of it is read."""
+    if _stage_name(stage) != "$lookup":
+        return stage
+    spec = stage["$lookup"]
+    extra_stages = []
+
+    embedding_field = EMBEDDING_FIELDS.get(spec.get("from"))
+    if embedding_field is not None:
+        extra_stages.append({"$project": {embedding_field: 0}})
+
+    bound = _lookup_bound(spec["as"], later_stages)
+    if bound is not None:
+        extra_stages.append({"$limit": bound})
+
+    if extra_stages:
+        # localField/foreignField may be combined with a sub-pipeline since MongoDB 5.0
+        spec["pipeline"] = [*spec.get("pipeline", []), *extra_stages]
+    return stage
+
+
+def _lookup_bound(field: str, later_stages: list) -> Optional[int]:
+    """
+    Return how many joined documents the rest of the pipeline reads, or None if it may read all of them.
+    This is only the case when every reference to the joined array is a $slice, $first or
+    $arrayElemAt with a constant, non-negative position, and the raw array never reaches the output.
+    """
+    bound = 1
+    for stage in later_stages:
+        name = _stage_name(stage)
+        if name is None:
+            return None
+        spec = stage[name]
+
+        if name in ("$project", "$addFields", "$set"):
+            for expression in spec.values():
+                expression_bound = _expression_bound(field, expression)
+                if expression_bound is None:
+                    return None
+                bound = max(bound, expression_bound)
+
+            written = [key for key in spec if _overlaps(key, field)]
+            if name == "$project" and _is_inclusion_projection(spec):
+                # the raw array survives only if it (or part of each element) is included as is
+                if any(spec[key] in (1, True) for key in written):
+                    return None
+                return bound
+            if field in spec:
+                # the raw array is excluded or replaced by a bounded expression
+                return bound
+            if written:
+                return None
+        elif name == "$unset":
+            unset_fields = {spec} if isinstance(spec, str) else set(spec)
+            if field in unset_fields:
+                return bound
+            if any(_overlaps(field, other) for other in unset_fields):
+                return None
+        elif name == "$group":
+            expressions = [spec.get("_id")] + [
+                # e.g. {"$push": <expression>}, where $first is an accumulator rather than the array operator
+                next(iter(accumulator.values()))
+                for key, accumulator in spec.items()
+                if key != "_id"
+                and isinstance(accumulator, dict)
+                and len(accumulator) == 1
+            ]
+            if len(expressions) != len(spec):
+                return None
+            for expression in expressions:
+                expression_bound = _expression_bound(field, expression)
+                if expression_bound is None:
+                    return None
+                bound = max(bound, expression_bound)
+            # every field that $group does not aggregate is dropped
+            return bound
+        else:
+            referenced = _referenced_fields(spec)
+            if name == "$lookup":
+                # localField is a plain field path rather than a "$field" expression
+                referenced.add(spec.get("localField", ""))
+            if any(_overlaps(field, other) for other in referenced):
+                return None
+    # the raw array is part of the output
+    return None
+
+
+def _expression_bound(field: str, expression) -> Optional[int]:
+    """
+    How many leading elements of the joined array an expression reads: 0 if it does not read the
+    array, or None if it may read all of it.
+    """
+    reference = f"${field}"
+    if isinstance(expression, str):
+        if expression == reference or expression.startswith(reference + "."):
+            return None
+        if expression.startswith(("$$ROOT", "$$CURRENT")):
+            # e.g. "$$ROOT" or "$$CURRENT.<field>" reads the whole array
+            _, _, path = expression.partition(".")
+            return None if _overlaps(path or ALL_FIELDS, field) else 0
+        return 0
+    if isinstance(expression, list):
+        bounds = [_expression_bound(field, item) for item in expression]
+        return None if None in bounds else max(bounds, default=0)
+    if not isinstance(expression, dict):
+        return 0
+
+    if len(expression) == 1:
+        operator, arguments = next(iter(expression.items()))
+        if operator == "$first" and arguments == reference:
+            return 1
+        if (
+            operator in ("$slice", "$arrayElemAt")
+            and isinstance(arguments, list)
+            and arguments[:1] == [reference]
+        ):
+            positions = arguments[1:]
+            if not positions or not all(
+                isinstance(position, int) and position >= 0 for position in positions
+            ):
+                return None
+            if operator == "$arrayElemAt":
+                return positions[0] + 1
+            # [array, n] or [array, position, n]
+            return sum(positions)
+
+    bounds = [_expression_bound(field, item) for item in expression.values()]
+    return None if None in bounds else max(bounds, default=0)
+
+
+def _is_inclusion_projection(spec: dict) -> bool:
+    """Whether a projection drops the fields it does not name, e.g. {"title": 1} or {"_id": 1}."""
+    fields = [value for key, value in spec.items() if key != "_id"] or list(
+        spec.values()
+    )
+    return any(value not in (0, False) for value in fields)
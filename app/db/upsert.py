@@ -1,35 +1,58 @@
 import time
 from app.db.conn import MongoDBConnection
+from app.db.chat_summary import delete_chat_summaries, upsert_chat_summaries
+from app.db.persistence import persistence_queue
+from app.db.write_buffer import write_buffer
 from bson import ObjectId
 from typing import Optional
+from pymongo.errors import PyMongoError
+from pymongo.operations import SearchIndexModel
 
+SEMANTIC_CACHE_VECTOR_INDEX = "semantic_cache_vector_index"
 
-def insert_query_document(db_conn: MongoDBConnection, query_doc: dict, username: str):
-    query_collection = db_conn.get_collection("query")
+
+async def insert_query_document(
+    db_conn: MongoDBConnection, query_doc: dict, username: str
+):
+    query_collection = db_conn.get_async_collection("query")
     updated_utc = query_doc["updated_utc"]
     query_doc["username"] = username
     query_doc["created_utc"] = updated_utc
     query_doc["query_count"] = 1
-    query_collection.insert_one(query_doc)
+    # the partial indexes of the query collection only contain documents with is_deleted False
+    query_doc["is_deleted"] = False
+
+    if persistence_queue.is_running:
+        # inserted in the background, off the response path
+        await persistence_queue.enqueue(query_doc)
+        return
 
+    await query_collection.insert_one(query_doc)
+    await upsert_chat_summaries(db_conn, [query_doc])
 
-def update_query_vote(
+
+async def update_query_vote(
     db_conn: MongoDBConnection, query_id: str, vote: int, username: str
 ):
-    query_collection = db_conn.get_collection("query")
+    query_collection = db_conn.get_async_collection("query")
     updated_utc = int(time.time())
 
     update_data = {
         "$set": {"updated_utc": updated_utc, f"votes.{username}": vote},
     }
 
-    result = query_collection.update_one({"_id": ObjectId(query_id)}, update_data)
+    if write_buffer.is_running:
+        # written by the next flush, together with other updates of this query
+        write_buffer.add("query", ObjectId(query_id), update_data)
+        return None
+
+    result = await query_collection.update_one({"_id": ObjectId(query_id)}, update_data)
 
     return result
 
 
-def update_query_count(db_conn: MongoDBConnection, query_id: str):
-    query_collection = db_conn.get_collection("query")
+async def update_query_count(db_conn: MongoDBConnection, query_id: str):
+    query_collection = db_conn.get_async_collection("query")
     updated_utc = int(time.time())
 
     update_data = {
@@ -37,13 +60,65 @@ def update_query_count(db_conn: MongoDBConnection, query_id: str):
         "$inc": {"query_count": 1},
     }
 
-    result = query_collection.update_one({"_id": ObjectId(query_id)}, update_data)
+    if write_buffer.is_running:
+        # views of a hot chat are summed into one $inc per flush
+        write_buffer.add("query", ObjectId(query_id), update_data)
+        return None
+
+    result = await query_collection.update_one({"_id": ObjectId(query_id)}, update_data)
 
     return result
 
 
-def delete_chat_by_id(db_conn: MongoDBConnection, chat_id: str) -> Optional[int]:
-    query_collection = db_conn.get_collection("query")
+async def create_semantic_cache_index(db_conn: MongoDBConnection):
+    cache_collection = db_conn.get_async_collection("semantic_cache")
+    # documents are removed by the TTL monitor once "expires_at" has passed
+    # this is a no-op if the index already exists
+    await cache_collection.create_index("expires_at", expireAfterSeconds=0)
+
+    # the vector search index of get_semantic_cache_match, which only Atlas supports
+    try:
+        cursor = await cache_collection.list_search_indexes(SEMANTIC_CACHE_VECTOR_INDEX)
+        if not await cursor.to_list():
+            await cache_collection.create_search_index(
+                SearchIndexModel(
+                    name=SEMANTIC_CACHE_VECTOR_INDEX,
+                    type="vectorSearch",
+                    definition={
+                        "fields": [
+                            {
+                                "type": "vector",
+                                "path": "embedding",
+                                "numDimensions": 1536,
+                                "similarity": "cosine",
+                            }
+                        ]
+                    },
+                )
+            )
+            print(f"[INFO] Created search index {SEMANTIC_CACHE_VECTOR_INDEX}")
+    except PyMongoError as e:
+        print(
+            f"[WARNING] Failed to create search index {SEMANTIC_CACHE_VECTOR_INDEX}, "
+            f"create it as described in the README: {e}"
+        )
+
+
+async def insert_semantic_cache_entry(db_conn: MongoDBConnection, entry: dict):
+    cache_collection = db_conn.get_async_collection("semantic_cache")
+    await cache_collection.insert_one(entry)
+
+
+async def delete_semantic_cache_entries(
+    db_conn: MongoDBConnection, filter: dict
+) -> int:
+    cache_collection = db_conn.get_async_collection("semantic_cache")
+    result = await cache_collection.delete_many(filter)
+    return result.deleted_count
+
+
+async def delete_chat_by_id(db_conn: MongoDBConnection, chat_id: str) -> Optional[int]:
+    query_collection = db_conn.get_async_collection("query")
 
     try:
         object_id = ObjectId(chat_id)
@@ -52,9 +127,10 @@ def delete_chat_by_id(db_conn: MongoDBConnection, chat_id: str) -> Optional[int]
         # invalid id
         return None
 
-    result = query_collection.update_many(
+    result = await query_collection.update_many(
         {"chat_id": object_id}, {"$set": {"is_deleted": True}}
     )
+    await delete_chat_summaries(db_conn, object_id)
     # result.modified_count is how many docs got the new field or had it flipped to True
     # in other words, the number of queries that got deleted
     return result.modified_count
@@ -0,0 +1,185 @@
+"""
+Write-Behind Buffer
+
+Chat views ($inc of query_count) and votes ($set of votes.<username>) used to cost one write on the
+request path each. When WRITE_BUFFER_ENABLED=true, they are queued here instead:
+- updates of the same document are coalesced, i.e. $inc amounts are summed and the last $set of
+  each field wins
+- the pending updates are flushed as one unordered bulk_write per collection every
+  WRITE_BUFFER_FLUSH_INTERVAL seconds, or as soon as WRITE_BUFFER_MAX_PENDING documents are pending
+- the buffer is drained when the app shuts down
+
+Reads may lag behind buffered updates by up to one flush interval.
+"""
+
+import os
+import time
+import asyncio
+from typing import Optional
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from app.db.conn import MongoDBConnection
+
+load_dotenv()
+
+WRITE_BUFFER_ENABLED = os.environ.get("WRITE_BUFFER_ENABLED", "false").lower() == "true"
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.environ.get("WRITE_BUFFER_FLUSH_INTERVAL", 1.0))
+WRITE_BUFFER_MAX_PENDING = int(os.environ.get("WRITE_BUFFER_MAX_PENDING", 500))
+# update operators that can be coalesced
+SUPPORTED_OPERATORS = {"$set", "$inc"}
+
+
+class WriteBehindBuffer:
+    """Coalesces $set and $inc updates per document and writes them in batches from one event loop."""
+
+    def __init__(
+        self,
+        enabled: bool = WRITE_BUFFER_ENABLED,
+        flush_interval: float = WRITE_BUFFER_FLUSH_INTERVAL,
+        max_pending: int = WRITE_BUFFER_MAX_PENDING,
+    ):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (collection, _id) -> {"$set": {...}, "$inc": {...}}
+        self._pending: dict[tuple[str, object], dict[str, dict]] = {}
+        self._db_conn: Optional[MongoDBConnection] = None
+        self._flush_requested = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._is_closing = False
+        self._stats = {
+            "queued": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "writes": 0,
+            "failed": 0,
+            "flush_s_max": 0.0,
+        }
+
+    @property
+    def is_running(self) -> bool:
+        """Whether updates should be queued, i.e. the buffer is enabled and its flush loop runs."""
+        return self._task is not None and not self._is_closing
+
+    def start(self, db_conn: MongoDBConnection):
+        if not self.enabled or self._task is not None:
+            return
+        self._db_conn = db_conn
+        self._task = asyncio.create_task(self._run())
+        print(
+            f"[INFO] Write-behind buffer started (flush every {self.flush_interval}s "
+            f"or {self.max_pending} documents)"
+        )
+
+    async def close(self):
+        """Stop the flush loop and write everything that is still pending."""
+        if self._task is None:
+            return
+        # not cancelled, as that could drop the updates of a flush that is in progress
+        self._is_closing = True
+        self._flush_requested.set()
+        await self._task
+        self._task = None
+        # e.g. updates that failed with the last flush of the loop
+        await self.flush()
+        print("[INFO] Write-behind buffer drained")
+
+    def add(self, collection_name: str, document_id, update: dict):
+        """Queue an update of one document, merging it into the updates already pending for it."""
+        unsupported = set(update) - SUPPORTED_OPERATORS
+        if unsupported:
+            raise ValueError(f"Unsupported update operators: {unsupported}")
+
+        key = (collection_name, document_id)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = {}
+        else:
+            self._stats["coalesced"] += 1
+        self._merge(pending, update)
+        self._stats["queued"] += 1
+
+        if len(self._pending) >= self.max_pending:
+            self._flush_requested.set()
+
+    @staticmethod
+    def _merge(pending: dict, update: dict):
+        for field, value in update.get("$set", {}).items():
+            pending.setdefault("$set", {})[field] = value
+        for field, amount in update.get("$inc", {}).items():
+            increments = pending.setdefault("$inc", {})
+            increments[field] = increments.get(field, 0) + amount
+
+    async def flush(self):
+        """Write every pending update with one bulk_write per collection."""
+        if not self._pending or self._db_conn is None:
+            return
+        # swap the pending updates out, so that updates queued during the flush go to the next one
+        pending, self._pending = self._pending, {}
+        start = time.time()
+
+        by_collection: dict[str, list[tuple[object, dict]]] = {}
+        for (collection_name, document_id), update in pending.items():
+            by_collection.setdefault(collection_name, []).append((document_id, update))
+
+        for collection_name, updates in by_collection.items():
+            collection = self._db_conn.get_async_collection(collection_name)
+            requests = [
+                UpdateOne({"_id": document_id}, update)
+                for document_id, update in updates
+            ]
+            try:
+                await collection.bulk_write(requests, ordered=False)
+                self._stats["writes"] += len(requests)
+            except BulkWriteError as e:
+                failed = e.details.get("writeErrors", [])
+                self._stats["writes"] += len(requests) - len(failed)
+                self._stats["failed"] += len(failed)
+                print(
+                    f"[WARNING] {len(failed)} buffered updates of {collection_name} failed: "
+                    f"{failed[:1]}"
+                )
+            except PyMongoError as e:
+                # e.g. the connection dropped, so retry with the next flush
+                # (an increment may be applied twice if part of the batch was written)
+                print(
+                    f"[WARNING] Failed to flush {len(requests)} buffered updates of "
+                    f"{collection_name}, retrying with the next flush: {e}"
+                )
+                for document_id, update in updates:
+                    # updates queued during the flush are newer, so their $set values win
+                    key = (collection_name, document_id)
+                    newer = self._pending.pop(key, None)
+                    if newer is not None:
+                        self._merge(update, newer)
+                    self._pending[key] = update
+
+        self._stats["flushes"] += 1
+        self._stats["flush_s_max"] = max(
+            self._stats["flush_s_max"], time.time() - start
+        )
+
+    async def _run(self):
+        while not self._is_closing:
+            try:
+                await asyncio.wait_for(
+                    self._flush_requested.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[WARNING] Write-behind flush failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+        }
+
+
+write_buffer = WriteBehindBuffer()
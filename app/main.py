@@ -3,8 +3,12 @@ import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from app.db.conn import lifespan as db_lifespan
+from app.db.conn import lifespan as db_lifespan, get_db_client
+from app.db.indexes import DB_ENSURE_INDEXES, ensure_indexes, is_deleted_backfill
+from app.db.write_buffer import write_buffer
+from app.db.persistence import persistence_queue
 from app.mcp.lifespan import mcp_lifespan
+from app.services.query.post import wait_for_query_tasks
 from app.api.routes import router
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -16,8 +20,35 @@ from slowapi.errors import RateLimitExceeded
 async def combined_lifespan(app: FastAPI):
     """Combine database and MCP lifespan managers."""
     async with db_lifespan(app):
-        async with mcp_lifespan(app):
-            yield
+        if DB_ENSURE_INDEXES:
+            try:
+                await ensure_indexes(get_db_client())
+            except Exception as e:
+                print(f"[WARNING] Failed to ensure indexes during startup: {e}")
+        else:
+            try:
+                await is_deleted_backfill.load(get_db_client())
+            except Exception as e:
+                print(f"[WARNING] Failed to check the is_deleted backfill: {e}")
+        if not is_deleted_backfill.is_confirmed:
+            print(
+                "[WARNING] Query documents have not been backfilled with is_deleted, so chats "
+                "are read without the partial indexes. Run `python -m app.db.indexes apply`"
+            )
+        write_buffer.start(get_db_client())
+        persistence_queue.start(get_db_client())
+        try:
+            async with mcp_lifespan(app):
+                try:
+                    yield
+                finally:
+                    # queries that outlived their stream may still be using MCP and persisting
+                    await wait_for_query_tasks()
+        finally:
+            # write the queued query documents, then the buffered views and votes of them,
+            # before the database clients close
+            await persistence_queue.close()
+            await write_buffer.close()
 
 
 # create a limiter instance
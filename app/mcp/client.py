@@ -8,30 +8,59 @@ to autonomously decide which database operations to perform.
 import json
 import os
 import pathlib
+from datetime import timedelta
 from typing import Optional, Union
 from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
 from mcp.client.session import ClientSession
 from mcp.client.stdio import StdioServerParameters, stdio_client
+from mcp.shared.memory import create_connected_server_and_client_session
+from mcp.shared.session import RequestResponder
+from mcp.shared.exceptions import McpError
+import mcp.types as types
+from mcp.types import CONNECTION_CLOSED
 from dotenv import load_dotenv
+from app.db.conn import MongoDBConnection
+from app.mcp import mongodb_server
+from app.mcp.tools.result_encoder import OMITTED_DOCUMENTS_KEY
 from app.schemas.message import Message
+from app.utils.deadline import Deadline, DeadlineExceededError, with_deadline
+from app.utils.openai_utils import closing_stream
+import app.constants as constants
+import anyio
 import asyncio
 
 load_dotenv()
 
-# Global singleton instance
-_global_client: Optional["MCPMongoClient"] = None
-_client_lock = asyncio.Lock()
+# "stdio" runs the MCP server in a subprocess for isolation,
+# "inprocess" runs it in the app's event loop and shares the app's MongoDB connection pool
+MCP_TRANSPORT = os.environ.get("MCP_TRANSPORT", "stdio").lower()
+
+# Shared by every query, which copies it and appends its own user turns
+_MESSAGE_PRELUDE = ({"role": "system", "content": constants.SYSTEM_PROMPT_MCP},)
+# Used when the server humanises timestamps itself and no longer offers the datetime tool
+_MESSAGE_PRELUDE_HUMANISED_TIMESTAMPS = (
+    {
+        "role": "system",
+        "content": constants.SYSTEM_PROMPT_MCP_HUMANISED_TIMESTAMPS,
+    },
+)
 
 
 class MCPMongoClient:
     """Client for interacting with MongoDB through MCP using OpenAI."""
 
-    def __init__(self):
+    def __init__(self, transport: str = MCP_TRANSPORT):
+        self.transport = transport
         self.openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.session: Optional[ClientSession] = None
         self._stdio_context = None
         self._session_context = None
         self._initialized = False
+        # MCP tools converted to the OpenAI function calling format, or None if they must be (re)listed
+        self._openai_tools: Optional[list[dict]] = None
+        self._message_prelude = _MESSAGE_PRELUDE
 
     async def __aenter__(self):
         """Start the MCP server and create session."""
@@ -41,6 +70,25 @@ class MCPMongoClient:
 
     async def _initialize(self):
         """Initialize the MCP server connection."""
+        if self.transport == "inprocess":
+            await self._initialize_inprocess()
+        else:
+            await self._initialize_stdio()
+        await self.refresh_tools()
+        self._initialized = True
+
+    async def _initialize_inprocess(self):
+        """Connect to the MCP server through in-memory streams instead of a subprocess."""
+        mongodb_server.use_database(MongoDBConnection().db)
+
+        # The server runs in a task group owned by this context, and the session is already initialized
+        self._session_context = create_connected_server_and_client_session(
+            mongodb_server.app, message_handler=self._handle_message
+        )
+        self.session = await self._session_context.__aenter__()
+
+    async def _initialize_stdio(self):
+        """Start the MCP server subprocess and connect to it over stdio."""
         # Get the absolute path to the server script
         server_script = pathlib.Path(__file__).parent / "mongodb_server.py"
 
@@ -57,10 +105,61 @@ class MCPMongoClient:
         read_stream, write_stream = await self._stdio_context.__aenter__()
 
         # Create and initialize session
-        self._session_context = ClientSession(read_stream, write_stream)
+        self._session_context = ClientSession(
+            read_stream, write_stream, message_handler=self._handle_message
+        )
         self.session = await self._session_context.__aenter__()
         await self.session.initialize()
-        self._initialized = True
+
+    async def _handle_message(
+        self,
+        message: (
+            RequestResponder[types.ServerRequest, types.ClientResult]
+            | types.ServerNotification
+            | Exception
+        ),
+    ):
+        """Drop the cached tool catalog when the server reports that its tools have changed."""
+        if isinstance(message, types.ServerNotification) and isinstance(
+            message.root, types.ToolListChangedNotification
+        ):
+            # Only mark the catalog as stale, since sending a request from the
+            # message handler would block the session's receive loop
+            print("[MCP] Server tool list changed")
+            self._openai_tools = None
+
+    async def refresh_tools(self) -> list[dict]:
+        """List the server's tools and convert them to the OpenAI function calling format."""
+        print("[MCP] Listing available tools...")
+        tools_list = await self.session.list_tools()
+        print(f"[MCP] Found {len(tools_list.tools)} tools")
+
+        self._openai_tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": tool.inputSchema,
+                },
+            }
+            for tool in tools_list.tools
+        ]
+
+        # Only ask the model to convert timestamps if the server offers the tool to do so
+        tool_names = {tool.name for tool in tools_list.tools}
+        self._message_prelude = (
+            _MESSAGE_PRELUDE
+            if "get_human_readable_datetime" in tool_names
+            else _MESSAGE_PRELUDE_HUMANISED_TIMESTAMPS
+        )
+        return self._openai_tools
+
+    async def get_openai_tools(self) -> list[dict]:
+        """Return the cached tool catalog, listing the tools again only if it is stale."""
+        if self._openai_tools is None:
+            return await self.refresh_tools()
+        return self._openai_tools
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Clean up session and server."""
@@ -70,8 +169,160 @@ class MCPMongoClient:
         if self._stdio_context:
             await self._stdio_context.__aexit__(exc_type, exc_val, exc_tb)
 
+    async def _call_tool(
+        self,
+        tool_call: dict,
+        deadline: Optional[Deadline] = None,
+        comment: Optional[str] = None,
+    ) -> str:
+        """
+        Run a single MCP tool call and return its text result.
+        Errors are returned as a JSON error object so that the model can see which call failed.
+        A call that is still running when only the deadline's margin is left fails with a timeout.
+        The comment is sent to the server to tag the MongoDB operations of the call.
+        """
+        if tool_call["error"] is not None:
+            return json.dumps({"error": tool_call["error"]})
+
+        print(f"[MCP] Calling tool: {tool_call['name']}")
+        print(f"[MCP] Arguments: {json.dumps(tool_call['args'], indent=2)}")
+
+        remaining = (
+            deadline.remaining(deadline.margin) if deadline is not None else None
+        )
+        read_timeout = (
+            timedelta(seconds=max(0.0, remaining)) if remaining is not None else None
+        )
+        try:
+            result = await self.session.call_tool(
+                tool_call["name"],
+                tool_call["args"],
+                read_timeout_seconds=read_timeout,
+                meta={"comment": comment} if comment is not None else None,
+            )
+        except Exception as e:
+            if is_connection_error(e):
+                # let the pool respawn the server instead of handing the error to the model
+                raise
+            print(f"[MCP ERROR] Tool {tool_call['name']} failed: {str(e)}")
+            return json.dumps({"error": str(e), "type": type(e).__name__})
+
+        # Extract text content from result
+        return result.content[0].text if result.content else "{}"
+
+    async def _call_tools(
+        self,
+        tool_calls: list[dict],
+        deadline: Optional[Deadline] = None,
+        comment: Optional[str] = None,
+    ) -> list[str]:
+        """Run the tool calls of one model turn concurrently, returning results in the same order."""
+        if len(tool_calls) > 1:
+            print(f"[MCP] Running {len(tool_calls)} tool calls concurrently")
+        return await asyncio.gather(
+            *(self._call_tool(tool_call, deadline, comment) for tool_call in tool_calls)
+        )
+
+    async def _create_agent_completion(
+        self,
+        messages: list,
+        openai_tools: list[dict],
+        deadline: Optional[Deadline] = None,
+        stream: bool = False,
+    ):
+        """
+        Ask the model for its next step (as a stream of deltas if `stream`), or return None if the
+        call does not start answering before only the deadline's margin is left.
+        """
+        try:
+            return await with_deadline(
+                self.openai_client.chat.completions.create(
+                    model=os.getenv("OPENAI_MODEL_MINI"),
+                    messages=messages,
+                    tools=openai_tools,
+                    tool_choice="auto",
+                    stream=stream,
+                ),
+                deadline,
+                reserve=deadline.margin if deadline is not None else 0.0,
+            )
+        except DeadlineExceededError:
+            return None
+
+    def _get_synthesis_messages(self, messages: list, pipeline_info: dict) -> list:
+        """
+        The conversation that asks the model to answer from the data gathered so far, once the agent
+        has run out of time to query the database.
+        Raises DeadlineExceededError if no query returned data, so that the caller can fall back to
+        another route.
+        """
+        if pipeline_info["pipeline"] is None:
+            raise DeadlineExceededError(
+                "MCP agent ran out of time before retrieving any data"
+            )
+        print(
+            f"[MCP] Deadline nearly reached after {pipeline_info['tool_calls']} tool calls, "
+            "answering from the data gathered so far"
+        )
+        pipeline_info["degraded"] = "agent_cut_short"
+        return [
+            *messages,
+            {"role": "system", "content": constants.SYSTEM_PROMPT_MCP_DEADLINE},
+        ]
+
+    async def _synthesise(
+        self,
+        messages: list,
+        openai_tools: list[dict],
+        pipeline_info: dict,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """Answer from the data gathered so far (see _get_synthesis_messages)."""
+        # the tools are still listed, as the conversation refers to them, but may not be called
+        response = await with_deadline(
+            self.openai_client.chat.completions.create(
+                model=os.getenv("OPENAI_MODEL_MINI"),
+                messages=self._get_synthesis_messages(messages, pipeline_info),
+                tools=openai_tools,
+                tool_choice="none",
+            ),
+            deadline,
+        )
+        return response.choices[0].message.content or "No response generated"
+
+    async def _synthesise_streaming(
+        self,
+        messages: list,
+        openai_tools: list[dict],
+        pipeline_info: dict,
+        deadline: Optional[Deadline] = None,
+    ):
+        """Stream an answer from the data gathered so far (see _get_synthesis_messages)."""
+        stream = await with_deadline(
+            self.openai_client.chat.completions.create(
+                model=os.getenv("OPENAI_MODEL_MINI"),
+                messages=self._get_synthesis_messages(messages, pipeline_info),
+                tools=openai_tools,
+                tool_choice="none",
+                stream=True,
+            ),
+            deadline,
+        )
+        has_content = False
+        async with closing_stream(stream):
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    has_content = True
+                    yield chunk.choices[0].delta.content
+        if not has_content:
+            yield "No response generated"
+
     async def query_with_mcp(
-        self, user_query: Union[str, list[Message]], max_iterations: int = 10
+        self,
+        user_query: Union[str, list[Message]],
+        max_iterations: int = 10,
+        deadline: Optional[Deadline] = None,
+        comment: Optional[str] = None,
     ) -> dict:
         """
         Query MongoDB using MCP and OpenAI function calling.
@@ -79,6 +330,9 @@ class MCPMongoClient:
         Args:
             user_query: The user's natural language query (string) or full chat context (list of Messages)
             max_iterations: Maximum number of tool call iterations to prevent infinite loops
+            deadline: When only its margin is left, the loop stops and the model answers from the
+                data gathered so far
+            comment: Tags the MongoDB operations of the tool calls, e.g. "query:<query_id>"
 
         Returns:
             A dictionary containing:
@@ -86,6 +340,10 @@ class MCPMongoClient:
             - pipeline: The MongoDB aggregation pipeline used (if any)
             - collection_name: The collection that was queried (if any)
             - reason: The reasoning behind the query approach
+            - documents: The documents returned by the last successful data-bearing tool call
+            - iterations: The number of LLM calls made by the agent
+            - tool_calls: The number of tool calls made by the agent
+            - degraded: "agent_cut_short" if the deadline cut the loop short
         """
         # Track pipeline information
         pipeline_info = {
@@ -93,68 +351,33 @@ class MCPMongoClient:
             "pipeline": None,
             "collection_name": None,
             "reason": "",
+            "documents": [],
+            "iterations": 0,
+            "tool_calls": 0,
         }
 
         try:
-            # List available tools from MCP server
-            print("[MCP] Listing available tools...")
-            tools_list = await self.session.list_tools()
-            print(f"[MCP] Found {len(tools_list.tools)} tools")
-
-            # Convert MCP tools to OpenAI function calling format
-            openai_tools = []
-            for tool in tools_list.tools:
-                openai_tools.append(
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": tool.name,
-                            "description": tool.description,
-                            "parameters": tool.inputSchema,
-                        },
-                    }
-                )
-
-            # Initialize conversation with system prompt
-            messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a helpful assistant with access to a MongoDB database. "
-                        "The database contains Reddit data including threads, queries, and other collections. "
-                        "Use the available tools to explore and query the database:\n"
-                        "1. Start by listing collections if you're unsure what data is available\n"
-                        "2. Get the schema of a collection to understand its structure\n"
-                        "3. Use aggregation or find operations to query the data\n"
-                        "4. IMPORTANT: Whenever you find documents with a 'created_utc' field, use the 'get_human_readable_datetime' tool to convert the timestamp to a human-readable format\n"
-                        "When presenting results, format them in a clear, readable way. "
-                        "If you find relevant data, include key details and summarize findings. "
-                        "Always convert UTC timestamps to human-readable dates for better user experience."
-                    ),
-                },
-            ]
+            openai_tools = await self.get_openai_tools()
 
-            # Add user query - either as a string or convert Message list to OpenAI format
-            if isinstance(user_query, str):
-                messages.append({"role": "user", "content": user_query})
-            else:
-                # Convert Message objects to OpenAI message format
-                for msg in user_query:
-                    messages.append({"role": msg.role.value, "content": msg.content})
+            # Start from the prebuilt system prompt and only append the user turns
+            messages = _build_messages(user_query, self._message_prelude)
 
             # Agentic loop - let OpenAI decide which tools to use
             iteration = 0
             while iteration < max_iterations:
                 iteration += 1
+                pipeline_info["iterations"] = iteration
 
                 print(f"[MCP] Iteration {iteration}/{max_iterations}")
 
-                response = await self.openai_client.chat.completions.create(
-                    model=os.getenv("OPENAI_MODEL_MINI"),
-                    messages=messages,
-                    tools=openai_tools,
-                    tool_choice="auto",
+                response = await self._create_agent_completion(
+                    messages, openai_tools, deadline
                 )
+                if response is None:
+                    pipeline_info["response"] = await self._synthesise(
+                        messages, openai_tools, pipeline_info, deadline
+                    )
+                    return pipeline_info
 
                 response_message = response.choices[0].message
 
@@ -163,52 +386,24 @@ class MCPMongoClient:
                     # Add assistant's message to conversation
                     messages.append(response_message)
 
-                    # Execute each tool call
-                    for tool_call in response_message.tool_calls:
-                        function_name = tool_call.function.name
-                        function_args = json.loads(tool_call.function.arguments)
-
-                        print(f"[MCP] Calling tool: {function_name}")
-                        print(f"[MCP] Arguments: {json.dumps(function_args, indent=2)}")
-
-                        # Capture pipeline information if this is an aggregation
-                        if function_name == "aggregate_collection":
-                            pipeline_info["collection_name"] = function_args.get(
-                                "collection"
-                            )
-                            pipeline_info["pipeline"] = function_args.get("pipeline")
-                            pipeline_info["reason"] = (
-                                f"Used MCP aggregation on collection: {function_args.get('collection')}"
-                            )
-                        elif function_name == "find_documents":
-                            pipeline_info["collection_name"] = function_args.get(
-                                "collection"
-                            )
-                            # Convert find to pipeline format for consistency
-                            find_filter = function_args.get("filter", {})
-                            find_limit = function_args.get("limit", 10)
-                            pipeline_info["pipeline"] = [
-                                {"$match": find_filter},
-                                {"$limit": find_limit},
-                            ]
-                            pipeline_info["reason"] = (
-                                f"Used MCP find on collection: {function_args.get('collection')}"
-                            )
-
-                        # Call the MCP tool
-                        result = await self.session.call_tool(
-                            function_name, function_args
+                    # Parse every tool call first, then run them concurrently
+                    tool_calls = [
+                        _parse_tool_call(tool_call)
+                        for tool_call in response_message.tool_calls
+                    ]
+                    pipeline_info["tool_calls"] += len(tool_calls)
+                    tool_results = await self._call_tools(tool_calls, deadline, comment)
+
+                    # Add tool results to conversation in the order they were requested
+                    for tool_call, tool_result in zip(tool_calls, tool_results):
+                        _capture_documents(
+                            pipeline_info, tool_call["query_metadata"], tool_result
                         )
-
-                        # Extract text content from result
-                        tool_result = result.content[0].text if result.content else "{}"
-
-                        # Add tool result to conversation
                         messages.append(
                             {
                                 "role": "tool",
-                                "tool_call_id": tool_call.id,
-                                "name": function_name,
+                                "tool_call_id": tool_call["id"],
+                                "name": tool_call["name"],
                                 "content": tool_result,
                             }
                         )
@@ -237,184 +432,131 @@ class MCPMongoClient:
             raise
 
     async def query_with_mcp_streaming(
-        self, user_query: Union[str, list[Message]], max_iterations: int = 10
+        self,
+        user_query: Union[str, list[Message]],
+        max_iterations: int = 10,
+        deadline: Optional[Deadline] = None,
+        comment: Optional[str] = None,
     ):
         """
         Query MongoDB using MCP and stream the final OpenAI response.
 
         This method executes tool calls and streams both the thinking process
         and the final response synthesis to provide real-time feedback to users.
+        Every iteration streams its completion: tool calls are assembled from their deltas before
+        they run, while the content of the answer is forwarded as soon as it is generated. Whether an
+        iteration answers or calls tools is decided by its first delta (see _StreamedMessage), so
+        text that the model writes alongside its tool calls is never sent as content.
 
         Args:
             user_query: The user's natural language query (string) or full chat context (list of Messages)
             max_iterations: Maximum number of tool call iterations to prevent infinite loops
+            deadline: When only its margin is left, the loop stops and the model answers from the
+                data gathered so far
+            comment: Tags the MongoDB operations of the tool calls, e.g. "query:<query_id>"
 
         Yields:
             dict: Chunks containing:
                 - {"type": "thinking", "data": {"iteration": int, "tool": str, "args": dict, "collection": str, "pipeline": list}} - Tool execution info
-                - {"type": "content", "data": str} - Text chunks from the streaming response
-                - {"type": "metadata", "data": dict} - Pipeline metadata at the end
+                - {"type": "content", "data": str} - Text deltas of the response as they are generated
+                - {"type": "metadata", "data": dict} - Pipeline metadata and documents at the end
         """
         # Track pipeline information
         pipeline_info = {
             "pipeline": None,
             "collection_name": None,
             "reason": "",
+            "documents": [],
+            "iterations": 0,
+            "tool_calls": 0,
         }
 
         try:
-            # List available tools from MCP server
-            print("[MCP] Listing available tools...")
-            tools_list = await self.session.list_tools()
-            print(f"[MCP] Found {len(tools_list.tools)} tools")
-
-            # Convert MCP tools to OpenAI function calling format
-            openai_tools = []
-            for tool in tools_list.tools:
-                openai_tools.append(
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": tool.name,
-                            "description": tool.description,
-                            "parameters": tool.inputSchema,
-                        },
-                    }
-                )
-
-            # Initialize conversation with system prompt
-            messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a helpful assistant with access to a MongoDB database. "
-                        "The database contains Reddit data including threads, queries, and other collections. "
-                        "Use the available tools to explore and query the database:\n"
-                        "1. Start by listing collections if you're unsure what data is available\n"
-                        "2. Get the schema of a collection to understand its structure\n"
-                        "3. Use aggregation or find operations to query the data\n"
-                        "4. IMPORTANT: Whenever you find documents with a 'created_utc' field, use the 'get_human_readable_datetime' tool to convert the timestamp to a human-readable format\n"
-                        "When presenting results, format them in a clear, readable way. "
-                        "If you find relevant data, include key details and summarize findings. "
-                        "Always convert UTC timestamps to human-readable dates for better user experience."
-                    ),
-                },
-            ]
+            openai_tools = await self.get_openai_tools()
 
-            # Add user query - either as a string or convert Message list to OpenAI format
-            if isinstance(user_query, str):
-                messages.append({"role": "user", "content": user_query})
-            else:
-                # Convert Message objects to OpenAI message format
-                for msg in user_query:
-                    messages.append({"role": msg.role.value, "content": msg.content})
+            # Start from the prebuilt system prompt and only append the user turns
+            messages = _build_messages(user_query, self._message_prelude)
 
             # Agentic loop - let OpenAI decide which tools to use
             iteration = 0
             while iteration < max_iterations:
                 iteration += 1
+                pipeline_info["iterations"] = iteration
 
                 print(f"[MCP] Iteration {iteration}/{max_iterations}")
 
-                response = await self.openai_client.chat.completions.create(
-                    model=os.getenv("OPENAI_MODEL_MINI"),
-                    messages=messages,
-                    tools=openai_tools,
-                    tool_choice="auto",
+                stream = await self._create_agent_completion(
+                    messages, openai_tools, deadline, stream=True
                 )
+                if stream is None:
+                    async for content in self._synthesise_streaming(
+                        messages, openai_tools, pipeline_info, deadline
+                    ):
+                        yield {"type": "content", "data": content}
+                    yield {"type": "metadata", "data": pipeline_info}
+                    return
 
-                response_message = response.choices[0].message
+                streamed_message = _StreamedMessage()
+                async with closing_stream(stream):
+                    async for chunk in stream:
+                        content = streamed_message.add(chunk)
+                        if content:
+                            yield {"type": "content", "data": content}
+                response_message = streamed_message.to_message()
 
                 # Check if OpenAI wants to use tools
                 if response_message.tool_calls:
                     # Add assistant's message to conversation
                     messages.append(response_message)
 
-                    # Execute each tool call
-                    for tool_call in response_message.tool_calls:
-                        function_name = tool_call.function.name
-                        function_args = json.loads(tool_call.function.arguments)
-
-                        print(f"[MCP] Calling tool: {function_name}")
-                        print(f"[MCP] Arguments: {json.dumps(function_args, indent=2)}")
+                    # Parse every tool call first, then run them concurrently
+                    tool_calls = [
+                        _parse_tool_call(tool_call)
+                        for tool_call in response_message.tool_calls
+                    ]
 
-                        # Prepare thinking event data
+                    # Stream thinking process to user (with collection/pipeline if available)
+                    for tool_call in tool_calls:
                         thinking_data = {
                             "iteration": iteration,
-                            "tool": function_name,
-                            "args": function_args,
+                            "tool": tool_call["name"],
+                            "args": tool_call["args"],
                         }
-
-                        # Add collection and pipeline info for query operations
-                        if function_name == "aggregate_collection":
-                            thinking_data["collection"] = function_args.get(
-                                "collection"
-                            )
-                            thinking_data["pipeline"] = function_args.get("pipeline")
-
-                            # Also capture for metadata
-                            pipeline_info["collection_name"] = function_args.get(
-                                "collection"
-                            )
-                            pipeline_info["pipeline"] = function_args.get("pipeline")
-                            pipeline_info["reason"] = (
-                                f"Used MCP aggregation on collection: {function_args.get('collection')}"
-                            )
-                        elif function_name == "find_documents":
-                            thinking_data["collection"] = function_args.get(
-                                "collection"
-                            )
-                            find_filter = function_args.get("filter", {})
-                            find_limit = function_args.get("limit", 10)
-                            thinking_data["pipeline"] = [
-                                {"$match": find_filter},
-                                {"$limit": find_limit},
+                        query_metadata = tool_call["query_metadata"]
+                        if query_metadata is not None:
+                            thinking_data["collection"] = query_metadata[
+                                "collection_name"
                             ]
-
-                            # Also capture for metadata
-                            pipeline_info["collection_name"] = function_args.get(
-                                "collection"
-                            )
-                            pipeline_info["pipeline"] = thinking_data["pipeline"]
-                            pipeline_info["reason"] = (
-                                f"Used MCP find on collection: {function_args.get('collection')}"
-                            )
-
-                        # Stream thinking process to user (with collection/pipeline if available)
+                            thinking_data["pipeline"] = query_metadata["pipeline"]
                         yield {
                             "type": "thinking",
                             "data": thinking_data,
                         }
 
-                        # Call the MCP tool
-                        result = await self.session.call_tool(
-                            function_name, function_args
-                        )
-
-                        # Extract text content from result
-                        tool_result = result.content[0].text if result.content else "{}"
+                    pipeline_info["tool_calls"] += len(tool_calls)
+                    tool_results = await self._call_tools(tool_calls, deadline, comment)
 
-                        # Add tool result to conversation
+                    # Add tool results to conversation in the order they were requested
+                    for tool_call, tool_result in zip(tool_calls, tool_results):
+                        _capture_documents(
+                            pipeline_info, tool_call["query_metadata"], tool_result
+                        )
                         messages.append(
                             {
                                 "role": "tool",
-                                "tool_call_id": tool_call.id,
-                                "name": function_name,
+                                "tool_call_id": tool_call["id"],
+                                "name": tool_call["name"],
                                 "content": tool_result,
                             }
                         )
                 else:
-                    # No more tool calls
+                    # No more tool calls, and the answer has been streamed already
                     print(f"[MCP] Tool execution completed in {iteration} iterations.")
-
-                    # The final response is already in response_message.content
-                    final_content = response_message.content or "No response generated"
-
-                    # Stream it as a single content chunk
-                    yield {
-                        "type": "content",
-                        "data": final_content,
-                    }
+                    if not response_message.content:
+                        yield {
+                            "type": "content",
+                            "data": "No response generated",
+                        }
 
                     # Send metadata at the end
                     yield {"type": "metadata", "data": pipeline_info}
@@ -436,32 +578,146 @@ class MCPMongoClient:
             raise
 
 
-async def get_mcp_client() -> MCPMongoClient:
+class _StreamedMessage:
     """
-    Get or create the global MCP client instance.
-    This avoids creating a new subprocess for every query.
+    Assembles the deltas of a streamed completion into the message that was streamed.
+    The first delta with content or tool calls decides whether the completion is an answer, whose
+    content is forwarded, or a step of the agent, whose content is only kept in the message.
     """
-    global _global_client
 
-    async with _client_lock:
-        if _global_client is None:
-            print("[MCP] Creating new global MCP client instance...")
-            _global_client = MCPMongoClient()
-            await _global_client._initialize()
-            print("[MCP] Global MCP client initialized successfully")
-        return _global_client
+    def __init__(self):
+        self._content: list[str] = []
+        # index of the tool call -> its id, name and arguments so far
+        self._tool_calls: dict[int, dict] = {}
+        self.is_answer: Optional[bool] = None
+
+    def add(self, chunk) -> Optional[str]:
+        """Add a chunk of the stream, returning its content delta (if any) to be forwarded."""
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        if self.is_answer is None and (delta.content or delta.tool_calls):
+            self.is_answer = not delta.tool_calls
+        for tool_call in delta.tool_calls or []:
+            accumulated = self._tool_calls.setdefault(
+                tool_call.index, {"id": None, "name": "", "arguments": ""}
+            )
+            if tool_call.id:
+                accumulated["id"] = tool_call.id
+            # the arguments (a JSON string) are split across many deltas
+            if tool_call.function is not None:
+                accumulated["name"] += tool_call.function.name or ""
+                accumulated["arguments"] += tool_call.function.arguments or ""
+        if delta.content:
+            self._content.append(delta.content)
+            if self.is_answer:
+                return delta.content
+        return None
+
+    def to_message(self) -> ChatCompletionMessage:
+        tool_calls = [
+            ChatCompletionMessageToolCall(
+                id=tool_call["id"],
+                type="function",
+                function=Function(
+                    name=tool_call["name"], arguments=tool_call["arguments"]
+                ),
+            )
+            for _, tool_call in sorted(self._tool_calls.items())
+        ]
+        return ChatCompletionMessage(
+            role="assistant",
+            content="".join(self._content) or None,
+            tool_calls=tool_calls or None,
+        )
+
+
+def is_connection_error(e: BaseException) -> bool:
+    """Whether an exception means that the MCP server subprocess is gone."""
+    if isinstance(e, McpError):
+        return e.error.code == CONNECTION_CLOSED
+    return isinstance(e, (anyio.ClosedResourceError, anyio.BrokenResourceError))
+
+
+def _build_messages(
+    user_query: Union[str, list[Message]], prelude: tuple[dict, ...]
+) -> list[dict]:
+    """Prepend the system prompt to the user query - either a string or a list of Messages."""
+    if isinstance(user_query, str):
+        return [*prelude, {"role": "user", "content": user_query}]
+    # Convert Message objects to OpenAI message format
+    return [
+        *prelude,
+        *({"role": msg.role.value, "content": msg.content} for msg in user_query),
+    ]
+
+
+def _parse_tool_call(tool_call) -> dict:
+    """Decode the arguments of an OpenAI tool call, recording an error instead of raising if they are invalid."""
+    function_name = tool_call.function.name
+    try:
+        function_args = json.loads(tool_call.function.arguments)
+        error = None
+    except json.JSONDecodeError as e:
+        function_args = {}
+        error = f"Invalid JSON arguments for {function_name}: {str(e)}"
+
+    return {
+        "id": tool_call.id,
+        "name": function_name,
+        "args": function_args,
+        "error": error,
+        # Capture pipeline information if this is an aggregation
+        "query_metadata": (
+            _get_query_metadata(function_name, function_args) if error is None else None
+        ),
+    }
+
+
+def _get_query_metadata(function_name: str, function_args: dict) -> Optional[dict]:
+    """Return the collection, pipeline and reason of a data-bearing tool call, or None for other tools."""
+    if function_name == "aggregate_collection":
+        return {
+            "collection_name": function_args.get("collection"),
+            "pipeline": function_args.get("pipeline"),
+            "reason": f"Used MCP aggregation on collection: {function_args.get('collection')}",
+        }
+    if function_name == "find_documents":
+        # Convert find to pipeline format for consistency
+        find_filter = function_args.get("filter", {})
+        find_limit = function_args.get("limit", 10)
+        return {
+            "collection_name": function_args.get("collection"),
+            "pipeline": [
+                {"$match": find_filter},
+                {"$limit": find_limit},
+            ],
+            "reason": f"Used MCP find on collection: {function_args.get('collection')}",
+        }
+    return None
 
 
-async def cleanup_mcp_client():
+def _capture_documents(
+    pipeline_info: dict, query_metadata: Optional[dict], tool_result: str
+):
     """
-    Clean up the global MCP client instance.
-    Should be called on application shutdown.
+    Keep the documents of a data-bearing tool call together with its pipeline metadata,
+    so that the caller does not have to run the pipeline again to list its sources.
+    Failed calls (which return an error object instead of a list) are ignored.
     """
-    global _global_client
-
-    async with _client_lock:
-        if _global_client is not None:
-            print("[MCP] Cleaning up global MCP client...")
-            await _global_client.__aexit__(None, None, None)
-            _global_client = None
-            print("[MCP] Global MCP client cleaned up")
+    if query_metadata is None:
+        return
+    try:
+        documents = json.loads(tool_result)
+    except json.JSONDecodeError:
+        return
+    if not isinstance(documents, list):
+        return
+
+    pipeline_info.update(query_metadata)
+    # drop the marker that the server appends when documents were left out to fit its size budget
+    pipeline_info["documents"] = [
+        document
+        for document in documents
+        if not (isinstance(document, dict) and OMITTED_DOCUMENTS_KEY in document)
+    ]
@@ -10,43 +10,195 @@ import mcp.server.stdio
 import mcp.types as types
 from pymongo import MongoClient
 import os
-import json
+import sys
+import time
+import pathlib
+import threading
 from dotenv import load_dotenv
 from bson import ObjectId
-from tools.datetime_tools import get_human_readable_datetime
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+from typing import Callable, Optional
+
+if not __package__:
+    # run as a script by the stdio transport, so make the app package importable
+    sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[2]))
+
+from app.db.pipeline_cache import prepare_pipeline, run_cached_pipeline
+from app.db.pipeline_guard import (
+    PIPELINE_MAX_TIME_MS,
+    PipelineTooExpensiveError,
+    to_cost_error,
+)
+from app.mcp.tools.datetime_tools import (
+    add_human_readable_datetimes,
+    get_human_readable_datetime,
+)
+from app.mcp.tools.result_encoder import encode_documents, encode_json, truncate_text
 
 load_dotenv()
 
 app = Server("mongodb-mcp-server")
 
-# MongoDB connection
-mongodb_uri = os.environ.get("MONGODB_URI")
-mongo_db_name = os.environ.get("MONGO_DB_NAME")
+# add a readable GMT+8 companion to every epoch field in query results, instead of
+# offering the get_human_readable_datetime tool that costs the agent an extra iteration
+HUMANISE_TIMESTAMPS = (
+    os.environ.get("MCP_HUMANISE_TIMESTAMPS", "false").lower() == "true"
+)
+# how long collection names, schema summaries and document counts are served from memory
+METADATA_CACHE_TTL_SECONDS = int(os.environ.get("MCP_METADATA_CACHE_TTL", 300))
+# number of documents sampled to summarise the schema of a collection
+SCHEMA_SAMPLE_SIZE = int(os.environ.get("MCP_SCHEMA_SAMPLE_SIZE", 100))
+# maximum number of distinct example values reported per field
+SCHEMA_MAX_EXAMPLES = 3
+SCHEMA_MAX_EXAMPLE_LENGTH = 80
 
-if not mongodb_uri or not mongo_db_name:
-    raise ValueError(
-        "MONGODB_URI and MONGO_DB_NAME must be set in environment variables"
-    )
+# MongoDB connection, created on first use unless the in-process transport shares the app's database
+db: Optional[Database] = None
+
+
+def use_database(database: Database):
+    """Serve tool calls from an existing database handle, e.g. the app's connection pool."""
+    global db
+    db = database
+    metadata_cache.clear()
+
+
+def get_db() -> Database:
+    global db
+
+    if db is None:
+        mongodb_uri = os.environ.get("MONGODB_URI")
+        mongo_db_name = os.environ.get("MONGO_DB_NAME")
 
-client: MongoClient = MongoClient(mongodb_uri)
-db = client[mongo_db_name]
+        if not mongodb_uri or not mongo_db_name:
+            raise ValueError(
+                "MONGODB_URI and MONGO_DB_NAME must be set in environment variables"
+            )
+
+        client: MongoClient = MongoClient(mongodb_uri)
+        db = client[mongo_db_name]
+    return db
+
+
+class MetadataCache:
+    """
+    Collection names, schema summaries and document counts, refreshed every METADATA_CACHE_TTL_SECONDS.
+
+    Tool calls run in worker threads, so each entry is loaded by one thread at a time
+    while the others wait for its result instead of querying MongoDB themselves.
+    """
+
+    def __init__(self, ttl_seconds: int = METADATA_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        # key -> (loaded_at, value)
+        self._entries: dict[str, tuple[float, object]] = {}
+        self._lock = threading.Lock()
+        self._key_locks: dict[str, threading.Lock] = {}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def collection_names(self, db: Database, refresh: bool = False) -> list[str]:
+        if refresh:
+            self._entries.pop("collections", None)
+        return self._get("collections", lambda: sorted(db.list_collection_names()))
+
+    def has_collection(self, db: Database, collection_name: str) -> bool:
+        # list the collections again before reporting that one does not exist, in case it is new
+        return collection_name in self.collection_names(
+            db
+        ) or collection_name in self.collection_names(db, refresh=True)
+
+    def schema(self, db: Database, collection_name: str) -> dict:
+        return self._get(
+            f"schema:{collection_name}",
+            lambda: summarise_schema(db[collection_name]),
+        )
+
+    def _get(self, key: str, load: Callable[[], object]):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl_seconds:
+            return entry[1]
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another thread may have loaded the entry while this one was waiting
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl_seconds:
+                return entry[1]
+            value = load()
+            self._entries[key] = (time.time(), value)
+            return value
+
+
+metadata_cache = MetadataCache()
+
+
+def summarise_schema(collection) -> dict:
+    """
+    Summarise the fields of a random sample of documents (scoped to sgexams): the types seen,
+    the share of documents that have the field and a few example values.
+    The document count may be up to METADATA_CACHE_TTL_SECONDS old.
+    """
+    sample = list(
+        collection.aggregate(
+            [
+                {"$match": {"subreddit": "sgexams"}},
+                {"$sample": {"size": SCHEMA_SAMPLE_SIZE}},
+                # Exclude embedding field from schema sample
+                {"$project": {"selftext_embedding": 0}},
+            ]
+        )
+    )
 
+    if not sample:
+        return {
+            "collection": collection.name,
+            "message": "No documents found in collection",
+            "document_count": 0,
+        }
 
-def serialize_bson(obj):
-    """Convert BSON types to JSON-serializable types."""
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    elif isinstance(obj, dict):
-        return {k: serialize_bson(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [serialize_bson(item) for item in obj]
-    return obj
+    fields = {}
+    for document in sample:
+        for field, value in document.items():
+            summary = fields.setdefault(
+                field, {"types": [], "presence": 0, "examples": []}
+            )
+            summary["presence"] += 1
+            type_name = type(value).__name__
+            if type_name not in summary["types"]:
+                summary["types"].append(type_name)
+            if isinstance(value, str):
+                value = value[:SCHEMA_MAX_EXAMPLE_LENGTH]
+            elif not isinstance(value, (int, float, bool, ObjectId)):
+                # only keep scalar examples to keep the summary small
+                continue
+            if (
+                len(summary["examples"]) < SCHEMA_MAX_EXAMPLES
+                and value not in summary["examples"]
+            ):
+                summary["examples"].append(value)
+
+    for summary in fields.values():
+        summary["presence"] = round(summary["presence"] / len(sample), 2)
+
+    return {
+        "collection": collection.name,
+        "sample_fields": list(fields.keys()),
+        "sample_document": truncate_text(sample[0]),
+        "fields": fields,
+        "sample_size": len(sample),
+        "document_count": collection.count_documents({"subreddit": "sgexams"}),
+    }
 
 
 @app.list_tools()
 async def list_tools() -> list[types.Tool]:
     """List available MongoDB tools."""
-    return [
+    tools = [
         types.Tool(
             name="list_collections",
             description=(
@@ -63,7 +215,9 @@ async def list_tools() -> list[types.Tool]:
             description=(
                 "Execute a MongoDB aggregation pipeline on any collection. "
                 "Use this to perform complex queries like filtering, sorting, grouping, "
-                "and computing statistics. Returns matching documents."
+                "and computing statistics. Returns matching documents. "
+                "Pipelines that would scan too much data return a 'Query too expensive' error; "
+                "retry with a more selective $match and an earlier $limit."
             ),
             inputSchema={
                 "type": "object",
@@ -157,17 +311,40 @@ async def list_tools() -> list[types.Tool]:
         ),
     ]
 
+    if HUMANISE_TIMESTAMPS:
+        # timestamps in query results are already readable
+        tools = [tool for tool in tools if tool.name != "get_human_readable_datetime"]
+    return tools
+
 
 @app.call_tool()
 async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
-    """Execute MongoDB operations."""
+    """
+    Execute MongoDB operations.
+
+    The server handles each request in its own task, so the blocking pymongo calls run in a
+    worker thread to let concurrent tool calls from the same session overlap.
+    The client may send a "comment" in the request's _meta, which tags the MongoDB operations of
+    the call so that they can be killed if its query is cancelled.
+    """
+    meta = app.request_context.meta
+    comment = getattr(meta, "comment", None) if meta is not None else None
+    return await asyncio.to_thread(_execute_tool, name, arguments, comment)
+
+
+def _execute_tool(
+    name: str, arguments: dict, comment: Optional[str] = None
+) -> list[types.TextContent]:
+    """Run a tool synchronously. This is called from a worker thread."""
     try:
+        db = get_db()
+
         if name == "list_collections":
             # List all collections in the database
-            collections = db.list_collection_names()
+            collections = metadata_cache.collection_names(db)
 
             collection_info = {
-                "database": mongo_db_name,
+                "database": db.name,
                 "collections": collections,
                 "count": len(collections),
             }
@@ -175,7 +352,7 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
             return [
                 types.TextContent(
                     type="text",
-                    text=json.dumps(collection_info, indent=2, ensure_ascii=False),
+                    text=encode_json(collection_info),
                 )
             ]
 
@@ -184,53 +361,37 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
             pipeline = arguments["pipeline"]
 
             # Validate collection exists
-            if collection_name not in db.list_collection_names():
+            if not metadata_cache.has_collection(db, collection_name):
                 return [
                     types.TextContent(
                         type="text",
-                        text=json.dumps(
+                        text=encode_json(
                             {
                                 "error": f"Collection '{collection_name}' not found",
-                                "available_collections": db.list_collection_names(),
-                            },
-                            indent=2,
+                                "available_collections": metadata_cache.collection_names(
+                                    db
+                                ),
+                            }
                         ),
                     )
                 ]
 
             collection = db[collection_name]
 
-            if collection_name == "thread":
-                # Exclude embedding and _id fields
-                pipeline.insert(0, {"$project": {"selftext_embedding": 0, "_id": 0}})
-
-            # Filter to sgexams subreddit
-            pipeline.insert(0, {"$match": {"subreddit": "sgexams"}})
-
-            # Cap $limit to 10
-            limit_index = next(
-                (i for i, stage in enumerate(pipeline) if "$limit" in stage), None
-            )
-            if limit_index is not None:
-                original_limit = pipeline[limit_index]["$limit"]
-                pipeline[limit_index]["$limit"] = min(10, original_limit)
-            else:
-                pipeline.append({"$limit": 10})
-
-            # "strength": 1 ensures only base characters are compared, ignoring case and diacritics
-            results = list(
-                collection.aggregate(
-                    pipeline, collation={"locale": "en", "strength": 1}
-                )
-            )
-
-            # Convert BSON types to JSON-serializable
-            results = serialize_bson(results)
+            # Filter to sgexams subreddit, exclude thread embeddings and cap $limit to 10,
+            # then serve the pipeline from the cache if it was run recently
+            pipeline = prepare_pipeline(collection_name, pipeline)
+            results = run_cached_pipeline(collection, pipeline, comment)
 
             return [
                 types.TextContent(
                     type="text",
-                    text=json.dumps(results, indent=2, ensure_ascii=False),
+                    # Compact and size-budgeted, as the result stays in the agent's context
+                    text=encode_documents(
+                        add_human_readable_datetimes(results)
+                        if HUMANISE_TIMESTAMPS
+                        else results
+                    ),
                 )
             ]
 
@@ -240,16 +401,17 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
             limit = arguments.get("limit", 10)
 
             # Validate collection exists
-            if collection_name not in db.list_collection_names():
+            if not metadata_cache.has_collection(db, collection_name):
                 return [
                     types.TextContent(
                         type="text",
-                        text=json.dumps(
+                        text=encode_json(
                             {
                                 "error": f"Collection '{collection_name}' not found",
-                                "available_collections": db.list_collection_names(),
-                            },
-                            indent=2,
+                                "available_collections": metadata_cache.collection_names(
+                                    db
+                                ),
+                            }
                         ),
                     )
                 ]
@@ -266,19 +428,28 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
             if collection_name == "thread":
                 projection = {"selftext_embedding": 0, "_id": 0}
 
-            results = list(
-                collection.find(filter_query, projection)
-                .limit(limit)
-                .collation({"locale": "en", "strength": 1})
-            )
-
-            # Convert BSON types to JSON-serializable
-            results = serialize_bson(results)
+            try:
+                results = list(
+                    collection.find(filter_query, projection, comment=comment)
+                    .limit(limit)
+                    .collation({"locale": "en", "strength": 1})
+                    .max_time_ms(PIPELINE_MAX_TIME_MS)
+                )
+            except PyMongoError as e:
+                cost_error = to_cost_error(e)
+                if cost_error is None:
+                    raise
+                raise cost_error from e
 
             return [
                 types.TextContent(
                     type="text",
-                    text=json.dumps(results, indent=2, ensure_ascii=False),
+                    # Compact and size-budgeted, as the result stays in the agent's context
+                    text=encode_documents(
+                        add_human_readable_datetimes(results)
+                        if HUMANISE_TIMESTAMPS
+                        else results
+                    ),
                 )
             ]
 
@@ -286,47 +457,28 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
             collection_name = arguments["collection"]
 
             # Validate collection exists
-            if collection_name not in db.list_collection_names():
+            if not metadata_cache.has_collection(db, collection_name):
                 return [
                     types.TextContent(
                         type="text",
-                        text=json.dumps(
+                        text=encode_json(
                             {
                                 "error": f"Collection '{collection_name}' not found",
-                                "available_collections": db.list_collection_names(),
-                            },
-                            indent=2,
+                                "available_collections": metadata_cache.collection_names(
+                                    db
+                                ),
+                            }
                         ),
                     )
                 ]
 
-            # Get a sample document to show the schema (scoped to sgexams)
-            collection = db[collection_name]
-            sample = collection.find_one({"subreddit": "sgexams"})
-
-            if sample:
-                sample = serialize_bson(sample)
-                # Exclude embedding field from schema sample
-                sample.pop("selftext_embedding", None)
-                schema_info = {
-                    "collection": collection_name,
-                    "sample_fields": list(sample.keys()),
-                    "sample_document": sample,
-                    "document_count": collection.count_documents(
-                        {"subreddit": "sgexams"}
-                    ),
-                }
-            else:
-                schema_info = {
-                    "collection": collection_name,
-                    "message": "No documents found in collection",
-                    "document_count": 0,
-                }
+            # Summarise the schema from a sample of documents (scoped to sgexams)
+            schema_info = metadata_cache.schema(db, collection_name)
 
             return [
                 types.TextContent(
                     type="text",
-                    text=json.dumps(schema_info, indent=2, ensure_ascii=False),
+                    text=encode_json(schema_info),
                 )
             ]
 
@@ -345,7 +497,7 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
                 return [
                     types.TextContent(
                         type="text",
-                        text=json.dumps(result, indent=2, ensure_ascii=False),
+                        text=encode_json(result),
                     )
                 ]
             except Exception as conv_error:
@@ -356,13 +508,26 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
                 return [
                     types.TextContent(
                         type="text",
-                        text=json.dumps(error_msg, indent=2),
+                        text=encode_json(error_msg),
                     )
                 ]
 
         else:
             raise ValueError(f"Unknown tool: {name}")
 
+    except PipelineTooExpensiveError as e:
+        # tell the agent why, so that it retries with a cheaper query instead of giving up
+        # (stdout carries the protocol of the stdio transport, so log to stderr)
+        print(
+            f"[WARNING] Rejected expensive query on {arguments.get('collection')}: {e}",
+            file=sys.stderr,
+        )
+        return [
+            types.TextContent(
+                type="text",
+                text=encode_json(e.to_dict()),
+            )
+        ]
     except Exception as e:
         error_msg = {
             "error": str(e),
@@ -371,13 +536,15 @@ async def call_tool(name: str, arguments: dict) -> list[types.TextContent]:
         return [
             types.TextContent(
                 type="text",
-                text=json.dumps(error_msg, indent=2),
+                text=encode_json(error_msg),
             )
         ]
 
 
 async def main():
     """Run the MCP server."""
+    # fail fast if the database is not configured
+    get_db()
     async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
         await app.run(
             read_stream,
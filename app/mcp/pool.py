@@ -0,0 +1,221 @@
+"""
+MCP Client Pool
+
+Keeps several MCP server subprocesses alive so that concurrent NOSQL queries do not
+serialise behind a single stdio session.
+
+Each subprocess is owned by a long-running task that starts it, waits until it is asked
+to restart or stop, and starts it again if it crashes. Requests check out the least busy
+healthy session and wait (up to MCP_POOL_ACQUIRE_TIMEOUT seconds) when every session is full.
+"""
+
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from dotenv import load_dotenv
+from app.mcp.client import MCPMongoClient, is_connection_error
+
+load_dotenv()
+
+# number of MCP server subprocesses
+MCP_POOL_SIZE = int(os.environ.get("MCP_POOL_SIZE", 2))
+# number of queries that may share one session at the same time
+MCP_POOL_MAX_IN_FLIGHT = int(os.environ.get("MCP_POOL_MAX_IN_FLIGHT", 4))
+# how long a query may wait for a free session before giving up
+MCP_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("MCP_POOL_ACQUIRE_TIMEOUT", 30))
+# upper bound of the delay between attempts to respawn a subprocess that fails to start
+MCP_POOL_MAX_RESPAWN_DELAY = 30
+
+
+class MCPPoolTimeoutError(TimeoutError):
+    """Raised when no MCP session becomes available within the acquire timeout."""
+
+
+class _PoolSlot:
+    """A single MCP session and the task that owns its subprocess."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.client: Optional[MCPMongoClient] = None
+        self.in_flight = 0
+        self.restart = asyncio.Event()
+        # set once the first attempt to start the subprocess has finished, successfully or not
+        self.attempted = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def is_healthy(self) -> bool:
+        return self.client is not None and not self.restart.is_set()
+
+
+class MCPClientPool:
+    def __init__(
+        self,
+        size: int = MCP_POOL_SIZE,
+        max_in_flight: int = MCP_POOL_MAX_IN_FLIGHT,
+        acquire_timeout: float = MCP_POOL_ACQUIRE_TIMEOUT,
+    ):
+        self.size = max(1, size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.acquire_timeout = acquire_timeout
+        self._slots = [_PoolSlot(i) for i in range(self.size)]
+        self._condition = asyncio.Condition()
+        self._start_lock = asyncio.Lock()
+        self._is_started = False
+        self._is_closing = False
+        # rotates the starting slot so that ties between equally busy sessions are broken round-robin
+        self._next_slot = 0
+        self._waiting = 0
+        self._stats = {
+            "acquisitions": 0,
+            "timeouts": 0,
+            "respawns": 0,
+            "wait_s_total": 0.0,
+            "wait_s_max": 0.0,
+        }
+
+    async def start(self):
+        """Spawn every subprocess and wait for each of them to start (or fail to)."""
+        async with self._start_lock:
+            if self._is_started:
+                return
+            self._is_closing = False
+            print(f"[MCP] Starting pool of {self.size} MCP sessions...")
+            for slot in self._slots:
+                slot.task = asyncio.create_task(self._run_slot(slot))
+            await asyncio.gather(*(slot.attempted.wait() for slot in self._slots))
+            self._is_started = True
+            healthy = sum(slot.is_healthy for slot in self._slots)
+            print(f"[MCP] Pool started with {healthy}/{self.size} healthy sessions")
+
+    async def close(self):
+        """Stop every subprocess. Queries still holding a session will fail."""
+        async with self._start_lock:
+            if not self._is_started:
+                return
+            print("[MCP] Closing MCP pool...")
+            self._is_closing = True
+            for slot in self._slots:
+                slot.restart.set()
+            tasks = [slot.task for slot in self._slots if slot.task is not None]
+            _, pending = await asyncio.wait(tasks, timeout=10)
+            for task in pending:
+                task.cancel()
+            self._slots = [_PoolSlot(i) for i in range(self.size)]
+            self._is_started = False
+            print("[MCP] MCP pool closed")
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        Check out the least busy healthy session for the duration of the block.
+        If the block fails because the subprocess died, the session is respawned.
+        """
+        if not self._is_started:
+            await self.start()
+
+        slot = await self._checkout()
+        try:
+            yield slot.client
+        except Exception as e:
+            if is_connection_error(e):
+                print(f"[WARNING] MCP session {slot.index} lost its connection: {e}")
+                slot.restart.set()
+            raise
+        finally:
+            async with self._condition:
+                slot.in_flight -= 1
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        acquisitions = self._stats["acquisitions"]
+        return {
+            **self._stats,
+            "size": self.size,
+            "max_in_flight": self.max_in_flight,
+            "healthy": sum(slot.is_healthy for slot in self._slots),
+            "in_flight": sum(slot.in_flight for slot in self._slots),
+            "waiting": self._waiting,
+            "wait_s_avg": (
+                self._stats["wait_s_total"] / acquisitions if acquisitions else 0.0
+            ),
+        }
+
+    async def _checkout(self) -> _PoolSlot:
+        wait_start = time.time()
+        async with self._condition:
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(self._has_capacity),
+                    timeout=self.acquire_timeout,
+                )
+            except asyncio.TimeoutError:
+                self._stats["timeouts"] += 1
+                raise MCPPoolTimeoutError(
+                    f"No MCP session became available within {self.acquire_timeout}s"
+                )
+            finally:
+                self._waiting -= 1
+
+            slot = min(self._available_slots(), key=self._slot_order)
+            self._next_slot = (slot.index + 1) % self.size
+            slot.in_flight += 1
+
+        wait_time = time.time() - wait_start
+        self._stats["acquisitions"] += 1
+        self._stats["wait_s_total"] += wait_time
+        self._stats["wait_s_max"] = max(self._stats["wait_s_max"], wait_time)
+        if wait_time > 0.1:
+            print(f"[PERF] Waited {wait_time:.2f}s for MCP session {slot.index}")
+        return slot
+
+    def _available_slots(self) -> list[_PoolSlot]:
+        return [
+            slot
+            for slot in self._slots
+            if slot.is_healthy and slot.in_flight < self.max_in_flight
+        ]
+
+    def _has_capacity(self) -> bool:
+        return len(self._available_slots()) > 0
+
+    def _slot_order(self, slot: _PoolSlot) -> tuple[int, int]:
+        return (slot.in_flight, (slot.index - self._next_slot) % self.size)
+
+    async def _run_slot(self, slot: _PoolSlot):
+        """
+        Own the subprocess of a slot. The stdio transport must be entered and exited by the same
+        task, so the slot is started, stopped and respawned here rather than by the requests.
+        """
+        respawn_delay = 0
+        while not self._is_closing:
+            try:
+                async with MCPMongoClient() as client:
+                    slot.client = client
+                    if not self._is_closing:
+                        slot.restart.clear()
+                    respawn_delay = 0
+                    slot.attempted.set()
+                    async with self._condition:
+                        self._condition.notify_all()
+                    await slot.restart.wait()
+            except Exception as e:
+                print(f"[WARNING] MCP session {slot.index} failed: {e}")
+                respawn_delay = min(
+                    max(1, respawn_delay * 2), MCP_POOL_MAX_RESPAWN_DELAY
+                )
+            finally:
+                slot.client = None
+                slot.attempted.set()
+
+            if self._is_closing:
+                break
+            self._stats["respawns"] += 1
+            print(f"[MCP] Respawning MCP session {slot.index} in {respawn_delay}s...")
+            await asyncio.sleep(respawn_delay)
+
+
+mcp_pool = MCPClientPool()
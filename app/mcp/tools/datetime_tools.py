@@ -15,3 +15,28 @@ def get_human_readable_datetime(utc_timestamp: int):
     formatted_date = dt_gmt8.strftime("%b %d %Y, %I:%M%p")
 
     return formatted_date
+
+
+def add_human_readable_datetimes(obj):
+    """
+    Return a copy of obj in which every epoch field (a number in a field ending with "_utc",
+    e.g. "created_utc") is followed by a "<field>_readable" field in GMT+8.
+    """
+    if isinstance(obj, dict):
+        result = {}
+        for key, value in obj.items():
+            result[key] = add_human_readable_datetimes(value)
+            if (
+                key.endswith("_utc")
+                and isinstance(value, (int, float))
+                and not isinstance(value, bool)
+            ):
+                try:
+                    result[f"{key}_readable"] = get_human_readable_datetime(value)
+                except (OverflowError, OSError, ValueError):
+                    # not a valid timestamp, so leave the field as it is
+                    pass
+        return result
+    if isinstance(obj, list):
+        return [add_human_readable_datetimes(item) for item in obj]
+    return obj
@@ -0,0 +1,77 @@
+import os
+import json
+import datetime
+from bson import ObjectId, Decimal128
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# maximum size of the documents returned by one tool call (roughly 4 bytes per token)
+MCP_RESULT_MAX_BYTES = int(os.environ.get("MCP_RESULT_MAX_BYTES", 16000))
+# text fields (e.g. selftext, body) longer than this are cut off with a marker
+MCP_RESULT_MAX_TEXT_LENGTH = int(os.environ.get("MCP_RESULT_MAX_TEXT_LENGTH", 500))
+# key of the element appended to a result when documents were left out to fit the budget
+OMITTED_DOCUMENTS_KEY = "_omitted_documents"
+
+
+def _bson_default(obj):
+    # only called by the json encoder for values it cannot serialise itself
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    if isinstance(obj, bytes):
+        return obj.hex()
+    return str(obj)
+
+
+def encode_json(obj) -> str:
+    """Compact JSON that understands BSON types such as ObjectId and datetime."""
+    return json.dumps(
+        obj, default=_bson_default, ensure_ascii=False, separators=(",", ":")
+    )
+
+
+def truncate_text(obj, max_length: int = MCP_RESULT_MAX_TEXT_LENGTH):
+    """Return a copy of obj in which every string longer than max_length is cut off."""
+    if isinstance(obj, str):
+        if len(obj) <= max_length:
+            return obj
+        return f"{obj[:max_length]}... [truncated {len(obj) - max_length} chars]"
+    if isinstance(obj, dict):
+        return {key: truncate_text(value, max_length) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [truncate_text(item, max_length) for item in obj]
+    return obj
+
+
+def encode_documents(
+    documents: list,
+    max_bytes: int = MCP_RESULT_MAX_BYTES,
+    max_text_length: int = MCP_RESULT_MAX_TEXT_LENGTH,
+) -> str:
+    """
+    Encode query results as a compact JSON array that fits within max_bytes.
+
+    Long text fields are truncated first. If the documents still do not fit, the remaining ones
+    are replaced by a single {"_omitted_documents": n} element so that the model knows the
+    result is incomplete. The first document is always kept.
+    """
+    encoded = []
+    size = 2  # the enclosing brackets
+    for i, document in enumerate(documents):
+        part = encode_json(truncate_text(document, max_text_length))
+        part_size = len(part.encode("utf-8")) + 1  # the separating comma
+        if encoded and size + part_size > max_bytes:
+            omitted = {
+                OMITTED_DOCUMENTS_KEY: len(documents) - i,
+                "reason": f"result exceeded the {max_bytes} byte budget",
+            }
+            encoded.append(encode_json(omitted))
+            break
+        encoded.append(part)
+        size += part_size
+
+    return f"[{','.join(encoded)}]"
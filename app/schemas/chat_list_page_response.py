@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+from typing import List, Optional
+from app.schemas.chat_list_response import ChatListResponse
+
+
+class ChatListPageResponse(BaseModel):
+    chats: List[ChatListResponse]
+    # pass this as the "cursor" of the next request, or None if there are no older chats
+    next_cursor: Optional[str] = None
@@ -1,6 +1,6 @@
 from pydantic import Field, field_validator
 from bson import ObjectId
-from typing import Literal
+from typing import Literal, Optional
 from app.schemas.message import Message
 from app.schemas.role import BaseModelWithRoleEncoder
 from app.schemas.custom_object_id import CustomObjectId
@@ -11,6 +11,8 @@ class QueryPostResponse(BaseModelWithRoleEncoder):
     query_id: CustomObjectId = Field(default_factory=CustomObjectId)
     chat_id: CustomObjectId = Field(default_factory=CustomObjectId)
     user_vote: Literal[-1, 0, 1]
+    # set when the answer was degraded to meet the query deadline, see app/utils/deadline.py
+    degraded: Optional[str] = None
 
     model_config = {
         "arbitrary_types_allowed": True,
@@ -6,15 +6,15 @@ from fastapi import HTTPException
 from typing import Optional
 
 
-def chat_get(
+async def chat_get(
     db_conn: MongoDBConnection, chat_id: str, username: Optional[str]
 ) -> QueryGetResponse:
-    chat_obj = get_chat_by_id(db_conn, chat_id, username)
+    chat_obj = await get_chat_by_id(db_conn, chat_id, username)
     if chat_obj is None:
         raise HTTPException(status_code=404, detail="Chat does not exist")
 
     last_query = chat_obj["queries"][-1]
-    update_query_count(db_conn, last_query["_id"])
+    await update_query_count(db_conn, last_query["_id"])
     return QueryGetResponse(
         response=chat_obj["messages"],
         query_id=last_query["_id"],
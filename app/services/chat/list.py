@@ -1,12 +1,37 @@
 from app.db.conn import MongoDBConnection
-from app.db.get import get_user_chats
+from app.db.get import get_user_chats, CHATS_PER_PAGE
 from app.schemas.chat_list_response import ChatListResponse
-from typing import List
+from app.schemas.chat_list_page_response import ChatListPageResponse
+from app.utils.format_utils import encode_chat_cursor, decode_chat_cursor
+from fastapi import HTTPException
+from typing import List, Optional, Union
 
 
-def chat_list(
-    db_conn: MongoDBConnection, username: str, page: int
-) -> List[ChatListResponse]:
-    user_chats = get_user_chats(db_conn, username, page)
+async def chat_list(
+    db_conn: MongoDBConnection,
+    username: str,
+    page: int,
+    cursor: Optional[str] = None,
+) -> Union[List[ChatListResponse], ChatListPageResponse]:
+    if cursor is None:
+        # deprecated offset pagination, which returns a bare list
+        user_chats = await get_user_chats(db_conn, username, page)
+        return user_chats
 
-    return user_chats
+    # an empty cursor requests the first page
+    try:
+        after = decode_chat_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # fetch one more chat than a page holds to find out whether there is a next page
+    user_chats = await get_user_chats(
+        db_conn, username, after=after, limit=CHATS_PER_PAGE + 1
+    )
+    next_cursor = None
+    if len(user_chats) > CHATS_PER_PAGE:
+        user_chats = user_chats[:CHATS_PER_PAGE]
+        last_chat = user_chats[-1]
+        next_cursor = encode_chat_cursor(last_chat["created_utc"], last_chat["chat_id"])
+
+    return ChatListPageResponse(chats=user_chats, next_cursor=next_cursor)
@@ -5,19 +5,26 @@ This service handles queries using the Model Context Protocol (MCP).
 It allows OpenAI to autonomously query the MongoDB database using MCP tools.
 """
 
-from typing import Dict, Any, Union
-from app.mcp.client import get_mcp_client
+from typing import Dict, Any, Optional, Union
+from app.mcp.pool import mcp_pool
 from app.schemas.message import Message
+from app.utils.deadline import Deadline
 
 
-async def query_mcp(query: Union[str, list[Message]]) -> Dict[str, Any]:
+async def query_mcp(
+    query: Union[str, list[Message]],
+    deadline: Optional[Deadline] = None,
+    comment: Optional[str] = None,
+) -> Dict[str, Any]:
     """
     Execute a query using MCP with OpenAI function calling.
 
-    Uses a persistent MCP client to avoid subprocess creation overhead.
+    Uses a session from the persistent MCP client pool to avoid subprocess creation overhead.
 
     Args:
         query: The user's natural language query (string) or full chat context (list of Messages)
+        deadline: Cuts the agent loop short when only its margin is left (see MCPMongoClient.query_with_mcp)
+        comment: Tags the MongoDB operations of the agent's tool calls
 
     Returns:
         A dictionary containing:
@@ -25,7 +32,11 @@ async def query_mcp(query: Union[str, list[Message]]) -> Dict[str, Any]:
         - pipeline: The MongoDB aggregation pipeline used (if any)
         - collection_name: The collection that was queried (if any)
         - reason: The reasoning behind the query approach
+        - documents: The documents returned by the last successful data-bearing tool call
+        - degraded: "agent_cut_short" if the deadline cut the agent loop short
     """
-    mcp_client = await get_mcp_client()
-    result = await mcp_client.query_with_mcp(query)
+    async with mcp_pool.acquire() as mcp_client:
+        result = await mcp_client.query_with_mcp(
+            query, deadline=deadline, comment=comment
+        )
     return result
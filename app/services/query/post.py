@@ -1,26 +1,18 @@
-import time
 import json
-from copy import deepcopy
-from bson import ObjectId
-from typing import Optional
-from fastapi.concurrency import run_in_threadpool
-from app.utils.vector_search import vector_search
-from app.utils.openai_utils import (
-    query_router,
-    get_llm_response,
-    get_llm_response_streaming,
-)
-from app.utils.format_utils import normalise_query
-from pymongo.errors import OperationFailure
-from app.db.upsert import insert_query_document
+import time
+import asyncio
+from typing import Awaitable, Callable, Optional
 from app.db.conn import MongoDBConnection
-from app.db.get import get_response_from_pipeline, get_thread_metadata_and_top_comments
 from app.schemas.query_post_response import QueryPostResponse
 from app.schemas.message import Message
-from app.schemas.role import Role
-from app.schemas.route import Route
-from app.services.query.mcp import query_mcp
-from app.mcp.client import get_mcp_client
+from app.services.query.stages import QueryContext, run_query_stages
+from app.utils.cancellation import (
+    QUERY_DISCONNECT_POLL_INTERVAL,
+    QUERY_SHUTDOWN_TIMEOUT_SECONDS,
+)
+
+# queries that keep running after their stream has ended, e.g. to persist the query document
+_query_tasks: set[asyncio.Task] = set()
 
 
 async def query_post(
@@ -29,146 +21,20 @@ async def query_post(
     username: str,
     chat_id: Optional[str] = None,
 ) -> QueryPostResponse:
-    start_time = time.time()
-    query = normalise_query(query)
-    query_id = ObjectId()
-    query_doc = {
-        "_id": query_id,
-        # if chat_id is none, this is the first question in the conversation
-        # so we set the chat_id to the query_id of the first question
-        "chat_id": ObjectId(chat_id) if chat_id else query_id,
-        "updated_utc": int(time.time()),
-        "query": query[-1].content,
-    }
-    original_user_query = deepcopy(query)
-
-    is_error = False
-    num_tries = 0
-    MAX_TRIES = 3
-    while num_tries < MAX_TRIES:
-        try:
-            all_similar_threads = []
-
-            # Time the routing decision
-            route_start = time.time()
-            route = await query_router(original_user_query)
-            route_time = time.time() - route_start
-            print(f"[PERF] Route decision took {route_time:.2f}s - Route: {route}")
-
-            use_vector_search = route is Route.VECTOR
-            if not use_vector_search:
-                # Use MCP to query MongoDB
-                mcp_start = time.time()
-                mcp_result = await query_mcp(original_user_query)
-                mcp_time = time.time() - mcp_start
-                print(f"[PERF] MCP query took {mcp_time:.2f}s")
-
-                # Extract pipeline information for query_doc
-                if mcp_result.get("collection_name"):
-                    query_doc["collection_name"] = mcp_result["collection_name"]
-                if mcp_result.get("pipeline"):
-                    query_doc["pipeline"] = mcp_result["pipeline"]
-                if mcp_result.get("reason"):
-                    query_doc["reason"] = mcp_result["reason"]
-
-                # Update query content for LLM
-                query[-1].content = (
-                    f"""User Query:\n{query[-1].content}\n\nData from database:"""
-                )
-
-                print(
-                    f"pipeline: {mcp_result.get('pipeline')} reason: {mcp_result.get('reason')}"
-                )
-
-                # If MCP returned a pipeline, execute it to get similar threads
-                if mcp_result.get("pipeline") and mcp_result.get("collection_name"):
-                    mongodb_data = await run_in_threadpool(
-                        get_response_from_pipeline,
-                        db_conn,
-                        mcp_result["collection_name"],
-                        mcp_result["pipeline"],
-                    )
-                    if len(mongodb_data) > 0:
-                        _, similar_threads = await run_in_threadpool(
-                            get_thread_metadata_and_top_comments, db_conn, mongodb_data
-                        )
-                        if len(similar_threads) > 0:
-                            all_similar_threads.extend(similar_threads)
-                        query[-1].content += f"""\n{mongodb_data}"""
-
-                # Use the MCP response as the LLM response
-                response = mcp_result.get("response", "No response generated")
-            else:
-                vector_start = time.time()
-                thread_collection = db_conn.get_collection("thread")
+    ctx = QueryContext(db_conn, query, username, chat_id, is_streaming=False)
 
-                vector_search_result = await vector_search(
-                    original_user_query, thread_collection
-                )
-                vector_time = time.time() - vector_start
-                print(f"[PERF] Vector search took {vector_time:.2f}s")
-                # only store the 'id' and 'vector_search_score' field into query_doc
-                query_doc["vector_search_result"] = [
-                    {"id": result["id"], "score": result["vector_search_score"]}
-                    for result in vector_search_result
-                ]
-                search_result, similar_threads = await run_in_threadpool(
-                    get_thread_metadata_and_top_comments, db_conn, vector_search_result
-                )
-                if len(similar_threads) > 0:
-                    all_similar_threads.extend(similar_threads)
+    # the events are only needed by the streaming endpoint
+    async for _ in run_query_stages(ctx):
+        pass
 
-                query[-1].content += f"""\n{search_result}"""
-
-                # For vector search, use traditional LLM response
-                llm_start = time.time()
-                response = await get_llm_response(query)
-                llm_time = time.time() - llm_start
-                print(f"[PERF] LLM response generation took {llm_time:.2f}s")
-
-            # Add similar threads to response if available
-            if len(all_similar_threads) > 0:
-                # remove duplicates and sort by score in descending order
-                all_similar_threads = sorted(
-                    set(all_similar_threads), key=lambda x: x[1], reverse=True
-                )
-                all_similar_threads_formatted = "**Relevant posts**\n"
-                # el = a tuple of (formatted similar thread (str), score (int))
-                for i, el in enumerate(all_similar_threads):
-                    all_similar_threads_formatted += f"{i+1}. {el[0]}\n"
-                response += f"\n\n{all_similar_threads_formatted}"
-            query_with_response = query + [
-                Message(role=Role.ASSISTANT, content=response)
-            ]
-            query_doc["response"] = response
-
-            total_time = time.time() - start_time
-            print(f"[PERF] Total query_post execution time: {total_time:.2f}s")
-
-            # when a new query is made, the user's vote is guaranteed to be 0
-            return QueryPostResponse(
-                response=query_with_response,
-                query_id=query_doc["_id"],
-                chat_id=query_doc["chat_id"],
-                user_vote=0,
-            )
-        except Exception as e:
-            num_tries += 1
-            is_error = True
-            query_doc["error"] = str(e)
-            if isinstance(e, OperationFailure):
-                query_doc["error_type"] = "operation_failure"
-            else:
-                query_doc["error_type"] = "others"
-            if num_tries >= MAX_TRIES:
-                raise e
-        finally:
-            # only upsert the query document if the number of tries is exhausted or no error occurred
-            if num_tries >= MAX_TRIES or not is_error:
-                query_doc["is_error"] = is_error
-                await run_in_threadpool(
-                    insert_query_document, db_conn, query_doc, username
-                )
+    # when a new query is made, the user's vote is guaranteed to be 0
+    return QueryPostResponse(
+        response=ctx.get_messages_with_response(),
+        query_id=ctx.query_id,
+        chat_id=ctx.chat_id,
+        user_vote=0,
+        degraded=ctx.degraded,
+    )
 
 
 async def query_post_streaming(
@@ -176,6 +42,7 @@ async def query_post_streaming(
     query: list[Message],
     username: str,
     chat_id: Optional[str] = None,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
 ):
     """
     Streaming version of query_post for both NOSQL and VECTOR routes.
@@ -184,169 +51,101 @@ async def query_post_streaming(
     data: {"type": "route", "data": "nosql"}
     data: {"type": "thinking", "data": {"iteration": 1, "tool": "...", "args": {...}}}
     data: {"type": "content", "data": "chunk of text"}
-    data: {"type": "metadata", "data": {...}}
     data: {"type": "complete", "data": {...}}
+
+    The stages run in their own task. If `is_disconnected` reports that the client has gone, or the
+    stream is closed before the answer is complete, that task is cancelled (see
+    app/utils/cancellation.py).
     """
-    start_time = time.time()
-    query = normalise_query(query)
-    query_id = ObjectId()
-    query_doc = {
-        "_id": query_id,
-        "chat_id": ObjectId(chat_id) if chat_id else query_id,
-        "updated_utc": int(time.time()),
-        "query": query[-1].content,
-    }
-    original_user_query = deepcopy(query)
+    ctx = QueryContext(db_conn, query, username, chat_id, is_streaming=True)
+    events: asyncio.Queue = asyncio.Queue()
+    query_task = asyncio.create_task(_produce_events(ctx, events))
+    _query_tasks.add(query_task)
+    query_task.add_done_callback(_query_tasks.discard)
+    # the content sent to the client, which is persisted if the query is cancelled
+    streamed_content = []
+    next_event = None
+    last_disconnect_check = time.time()
 
     try:
-        # Time the routing decision
-        route_start = time.time()
-        route = await query_router(original_user_query)
-        route_time = time.time() - route_start
-        print(f"[PERF] Route decision took {route_time:.2f}s - Route: {route}")
-
-        # Send route information
-        yield f"data: {json.dumps({'type': 'route', 'data': route.value})}\n\n"
-
-        use_vector_search = route is Route.VECTOR
-
-        if not use_vector_search:
-            # Use MCP with streaming
-            mcp_start = time.time()
-            mcp_client = await get_mcp_client()
-
-            full_response = ""
-            pipeline_metadata = None
-
-            # Stream the MCP response
-            async for chunk in mcp_client.query_with_mcp_streaming(original_user_query):
-                if chunk["type"] == "thinking":
-                    # Stream thinking process to the client
-                    yield f"data: {json.dumps({'type': 'thinking', 'data': chunk['data']})}\n\n"
-                elif chunk["type"] == "content":
-                    # Stream content chunks to the client
-                    full_response += chunk["data"]
-                    yield f"data: {json.dumps({'type': 'content', 'data': chunk['data']})}\n\n"
-                elif chunk["type"] == "metadata":
-                    # Store metadata for later
-                    pipeline_metadata = chunk["data"]
-
-            mcp_time = time.time() - mcp_start
-            print(f"[PERF] MCP streaming query took {mcp_time:.2f}s")
-
-            # Store pipeline information in query_doc
-            if pipeline_metadata:
-                if pipeline_metadata.get("collection_name"):
-                    query_doc["collection_name"] = pipeline_metadata["collection_name"]
-                if pipeline_metadata.get("pipeline"):
-                    query_doc["pipeline"] = pipeline_metadata["pipeline"]
-                if pipeline_metadata.get("reason"):
-                    query_doc["reason"] = pipeline_metadata["reason"]
-
-            # Get similar threads if we have pipeline data
-            all_similar_threads = []
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.get())
+            # the pending get is reused, so that no event is lost when the wait times out
+            await asyncio.wait({next_event}, timeout=QUERY_DISCONNECT_POLL_INTERVAL)
             if (
-                pipeline_metadata
-                and pipeline_metadata.get("pipeline")
-                and pipeline_metadata.get("collection_name")
+                is_disconnected is not None
+                and time.time() - last_disconnect_check
+                >= QUERY_DISCONNECT_POLL_INTERVAL
             ):
-                mongodb_data = await run_in_threadpool(
-                    get_response_from_pipeline,
-                    db_conn,
-                    pipeline_metadata["collection_name"],
-                    pipeline_metadata["pipeline"],
-                )
-                if len(mongodb_data) > 0:
-                    _, similar_threads = await run_in_threadpool(
-                        get_thread_metadata_and_top_comments, db_conn, mongodb_data
-                    )
-                    if len(similar_threads) > 0:
-                        all_similar_threads.extend(similar_threads)
-
-            # Add similar threads to response if available
-            if len(all_similar_threads) > 0:
-                all_similar_threads = sorted(
-                    set(all_similar_threads), key=lambda x: x[1], reverse=True
-                )
-                all_similar_threads_formatted = "\n\n**Relevant posts**\n"
-                for i, el in enumerate(all_similar_threads):
-                    all_similar_threads_formatted += f"{i+1}. {el[0]}\n"
-
-                full_response += all_similar_threads_formatted
-                # Stream the similar threads
-                yield f"data: {json.dumps({'type': 'content', 'data': all_similar_threads_formatted})}\n\n"
-
-            query_doc["response"] = full_response
-
-        else:
-            # For vector search, stream the LLM response
-            vector_start = time.time()
-            thread_collection = db_conn.get_collection("thread")
-
-            vector_search_result = await vector_search(
-                original_user_query, thread_collection
-            )
-            vector_time = time.time() - vector_start
-            print(f"[PERF] Vector search took {vector_time:.2f}s")
-
-            query_doc["vector_search_result"] = [
-                {"id": result["id"], "score": result["vector_search_score"]}
-                for result in vector_search_result
-            ]
-            search_result, similar_threads = await run_in_threadpool(
-                get_thread_metadata_and_top_comments, db_conn, vector_search_result
-            )
-
-            all_similar_threads = []
-            if len(similar_threads) > 0:
-                all_similar_threads.extend(similar_threads)
-
-            query[-1].content += f"""\n{search_result}"""
-
-            # Stream the LLM response for vector search
-            llm_start = time.time()
-            response = ""
-            async for chunk in get_llm_response_streaming(query):
-                response += chunk
-                yield f"data: {json.dumps({'type': 'content', 'data': chunk})}\n\n"
-
-            llm_time = time.time() - llm_start
-            print(f"[PERF] LLM response streaming took {llm_time:.2f}s")
-
-            # Add similar threads
-            if len(all_similar_threads) > 0:
-                all_similar_threads = sorted(
-                    set(all_similar_threads), key=lambda x: x[1], reverse=True
-                )
-                all_similar_threads_formatted = "\n\n**Relevant posts**\n"
-                for i, el in enumerate(all_similar_threads):
-                    all_similar_threads_formatted += f"{i+1}. {el[0]}\n"
-                response += all_similar_threads_formatted
-                yield f"data: {json.dumps({'type': 'content', 'data': all_similar_threads_formatted})}\n\n"
-
-            query_doc["response"] = response
-
-        total_time = time.time() - start_time
-        print(f"[PERF] Total query_post_streaming execution time: {total_time:.2f}s")
-
-        # Send completion event with metadata
-        completion_data = {
-            "query_id": str(query_doc["_id"]),
-            "chat_id": str(query_doc["chat_id"]),
-            "user_vote": 0,
-        }
-        yield f"data: {json.dumps({'type': 'complete', 'data': completion_data})}\n\n"
-
+                last_disconnect_check = time.time()
+                if await is_disconnected():
+                    print(f"[INFO] Client disconnected from query {ctx.query_id}")
+                    return
+            if not next_event.done():
+                continue
+            event, next_event = next_event.result(), None
+
+            if event is None:
+                return
+            if isinstance(event, Exception):
+                raise event
+            if event["type"] == "content":
+                streamed_content.append(event["data"])
+            elif event["type"] == "complete":
+                # Send completion event with metadata
+                completion_data = {
+                    "query_id": str(ctx.query_id),
+                    "chat_id": str(ctx.chat_id),
+                    "user_vote": 0,
+                }
+                if ctx.cached_answer is not None:
+                    completion_data["is_cached"] = True
+                if ctx.degraded is not None:
+                    completion_data["degraded"] = ctx.degraded
+                event = {"type": "complete", "data": completion_data}
+            yield f"data: {json.dumps(event)}\n\n"
+            if event["type"] == "complete":
+                # the query document is persisted in the background
+                return
     except Exception as e:
         print(f"[ERROR] Streaming query failed: {str(e)}")
         import traceback
 
         traceback.print_exc()
-        query_doc["error"] = str(e)
-        query_doc["error_type"] = "streaming_error"
-        query_doc["is_error"] = True
         yield f"data: {json.dumps({'type': 'error', 'data': str(e)})}\n\n"
     finally:
-        # Save the query document
-        query_doc["is_error"] = query_doc.get("is_error", False)
-        await run_in_threadpool(insert_query_document, db_conn, query_doc, username)
+        if next_event is not None:
+            next_event.cancel()
+        # not awaited, as the stream may be closing because its own task was cancelled
+        if not query_task.done() and not ctx.is_succeeded:
+            ctx.query_doc.setdefault("response", "".join(streamed_content))
+            query_task.cancel()
+
+
+async def _produce_events(ctx: QueryContext, events: asyncio.Queue):
+    """Run the query stages, queueing their events, then any exception, then None."""
+    try:
+        async for event in run_query_stages(ctx):
+            events.put_nowait(event)
+    except Exception as e:
+        events.put_nowait(e)
+    finally:
+        events.put_nowait(None)
+
+
+async def wait_for_query_tasks(timeout: float = QUERY_SHUTDOWN_TIMEOUT_SECONDS):
+    """
+    Wait for the queries that are still running to finish, cancelling those that take longer than
+    `timeout` seconds. Either way, their query documents have been persisted when this returns.
+    """
+    if not _query_tasks:
+        return
+    _, pending = await asyncio.wait(set(_query_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    # a cancelled query still persists its query document
+    await asyncio.gather(*pending, return_exceptions=True)
+    print(
+        f"[INFO] Waited for running queries on shutdown, cancelled {len(pending)} of them"
+    )
@@ -0,0 +1,90 @@
+"""
+Speculative Retrieval
+
+Starts the vector search for a query while the router is still deciding on a route,
+so that the VECTOR route does not wait for a full LLM round-trip before retrieval begins.
+"""
+
+import os
+import time
+import asyncio
+from typing import Optional
+from dotenv import load_dotenv
+from app.db.conn import MongoDBConnection
+from app.schemas.message import Message
+from app.utils.vector_search import vector_search
+from app.utils.deadline import Deadline
+
+load_dotenv()
+
+SPECULATIVE_RETRIEVAL = (
+    os.environ.get("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+)
+
+
+class SpeculativeVectorSearch:
+    """A vector search that runs in the background until its result is claimed or discarded."""
+
+    def __init__(
+        self,
+        db_conn: MongoDBConnection,
+        query: list[Message],
+        deadline: Optional[Deadline] = None,
+        comment: Optional[str] = None,
+    ):
+        self.start_time = time.time()
+        self.duration: Optional[float] = None
+        self._task = asyncio.create_task(self._run(db_conn, query, deadline, comment))
+
+    async def _run(
+        self,
+        db_conn: MongoDBConnection,
+        query: list[Message],
+        deadline: Optional[Deadline],
+        comment: Optional[str],
+    ):
+        thread_collection = db_conn.get_async_collection("thread")
+        results = await vector_search(query, thread_collection, deadline, comment)
+        self.duration = time.time() - self.start_time
+        return results
+
+    async def result(self) -> tuple[list, dict]:
+        """
+        Wait for the vector search and return its results with its timings:
+        - vector_search: how long the search took in total
+        - speculative_saved: how much of it overlapped with routing (i.e. wall-clock time saved)
+        """
+        wait_start = time.time()
+        results = await self._task
+        wait_time = time.time() - wait_start
+        timings = {
+            "vector_search": self.duration,
+            "speculative_saved": max(0.0, self.duration - wait_time),
+        }
+        print(
+            f"[PERF] Speculative vector search took {self.duration:.2f}s, "
+            f"{timings['speculative_saved']:.2f}s of it overlapped with routing"
+        )
+        return results, timings
+
+    def discard(self):
+        """Cancel the vector search, e.g. because the router picked the NOSQL route."""
+        if not self._task.done():
+            self._task.cancel()
+            print(
+                f"[PERF] Discarded speculative vector search after {time.time() - self.start_time:.2f}s"
+            )
+        elif not self._task.cancelled():
+            # retrieve the exception (if any) so that asyncio does not log it as unhandled
+            self._task.exception()
+
+
+def start_speculative_vector_search(
+    db_conn: MongoDBConnection,
+    query: list[Message],
+    deadline: Optional[Deadline] = None,
+    comment: Optional[str] = None,
+) -> Optional[SpeculativeVectorSearch]:
+    if not SPECULATIVE_RETRIEVAL:
+        return None
+    return SpeculativeVectorSearch(db_conn, query, deadline, comment)
@@ -0,0 +1,486 @@
+"""
+Query Stages
+
+Answers a query in explicit stages, shared by query_post and query_post_streaming:
+- route: look the query up in the semantic cache, otherwise pick the NOSQL or VECTOR route
+- retrieve: run the MCP agent (NOSQL) or the vector search (VECTOR)
+- format: build the context messages and the list of relevant posts
+- generate: generate the answer (the MCP agent already did so for NOSQL) and append the relevant posts
+- persist: store the answer in the semantic cache and insert the query document
+
+Each stage has its own retry policy, and keeps its outputs on the QueryContext. A failing stage is
+retried on its own instead of rerunning the stages before it, e.g. a failed LLM call does not run the
+router and the MCP agent again. A streaming stage is not retried once it has sent content to the
+client, as the client would receive that content twice.
+
+Every query has a Deadline (see app/utils/deadline.py) that the stages pass to the calls they make.
+When the budget is nearly used up, the query degrades instead of failing: the MCP agent answers from
+the data it has gathered so far, or, if it has none, the query falls back to the VECTOR route.
+The query document and the response record the degradation in `degraded`.
+
+The MongoDB operations of a query are tagged with the comment "query:<query_id>". If the query is
+cancelled (see app/utils/cancellation.py), they are killed and the query document is persisted with
+is_cancelled and the stages that did not complete.
+"""
+
+import time
+import asyncio
+import inspect
+from copy import deepcopy
+from bson import ObjectId
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
+from pymongo.errors import OperationFailure
+from app.utils.vector_search import vector_search
+from app.utils.openai_utils import (
+    query_router,
+    get_llm_response,
+    get_llm_response_streaming,
+)
+from app.utils.format_utils import normalise_query
+from app.utils.deadline import Deadline, DeadlineExceededError, is_deadline_error
+from app.utils.cancellation import (
+    cancellation_stats,
+    get_operation_comment,
+    kill_operations,
+)
+from app.utils.semantic_cache import semantic_cache
+from app.db.upsert import insert_query_document
+from app.db.conn import MongoDBConnection
+from app.db.get import get_thread_metadata_and_top_comments
+from app.schemas.message import Message
+from app.schemas.role import Role
+from app.schemas.route import Route
+from app.services.query.mcp import query_mcp
+from app.services.query.speculative import (
+    SpeculativeVectorSearch,
+    start_speculative_vector_search,
+)
+from app.mcp.pool import mcp_pool
+
+
+class RetryPolicy:
+    def __init__(self, max_tries: int, delay: float = 0.0):
+        self.max_tries = max_tries
+        # delay before the first retry, doubled for every further retry
+        self.delay = delay
+
+
+STAGE_RETRY_POLICIES = {
+    "route": RetryPolicy(max_tries=3, delay=0.2),
+    # the MCP agent loop is the most expensive stage, so it is retried once
+    "retrieve": RetryPolicy(max_tries=2, delay=0.5),
+    "format": RetryPolicy(max_tries=1),
+    "generate": RetryPolicy(max_tries=3, delay=0.5),
+    "persist": RetryPolicy(max_tries=3, delay=0.2),
+}
+
+
+class QueryContext:
+    """The state of one query and the outputs of the stages that have completed."""
+
+    def __init__(
+        self,
+        db_conn: MongoDBConnection,
+        query: list[Message],
+        username: str,
+        chat_id: Optional[str],
+        is_streaming: bool,
+    ):
+        self.start_time = time.time()
+        self.db_conn = db_conn
+        self.username = username
+        self.is_streaming = is_streaming
+        self.query = normalise_query(query)
+        self.original_user_query = deepcopy(self.query)
+        self.deadline = Deadline.for_query(is_streaming)
+        query_id = ObjectId()
+        self.query_doc = {
+            "_id": query_id,
+            # if chat_id is none, this is the first question in the conversation
+            # so we set the chat_id to the query_id of the first question
+            "chat_id": ObjectId(chat_id) if chat_id else query_id,
+            "updated_utc": int(time.time()),
+            "query": self.query[-1].content,
+        }
+        # per-stage wall-clock times in seconds, stored with the query document
+        self.timings = {}
+        self.query_doc["timings"] = self.timings
+        self.operation_comment = get_operation_comment(query_id)
+        self.completed_stages: set[str] = set()
+        self.is_succeeded = False
+        # the parts of the answer that have been sent to the client, persisted if it is cancelled
+        self.streamed_content: list[str] = []
+
+        # route
+        self.cached_answer: Optional[dict] = None
+        self.route: Optional[Route] = None
+        self.speculative_search: Optional[SpeculativeVectorSearch] = None
+        # retrieve
+        self.agent_result: Optional[dict] = None
+        self.vector_search_result: Optional[list] = None
+        # format
+        self.context_messages: Optional[list[Message]] = None
+        self.search_result = ""
+        self.similar_threads: list[tuple[str, int]] = []
+        # generate
+        self.response: Optional[str] = None
+        # persist
+        self.is_answer_stored = False
+
+    @property
+    def query_id(self) -> ObjectId:
+        return self.query_doc["_id"]
+
+    @property
+    def chat_id(self) -> ObjectId:
+        return self.query_doc["chat_id"]
+
+    @property
+    def has_sent_content(self) -> bool:
+        """Whether any part of the answer has been sent to the client, so it can no longer change."""
+        return bool(self.streamed_content)
+
+    @property
+    def degraded(self) -> Optional[str]:
+        """Why the answer was degraded to meet the deadline ("agent_cut_short" or "vector_fallback"), if it was."""
+        return self.query_doc.get("degraded")
+
+    def get_messages_with_response(self) -> list[Message]:
+        """The query (with the retrieved context, if any) followed by the answer."""
+        messages = (
+            self.original_user_query
+            if self.context_messages is None
+            else self.context_messages
+        )
+        return messages + [Message(role=Role.ASSISTANT, content=self.response)]
+
+
+# a stage either streams events to the client (an async generator) or only runs (a coroutine)
+Stage = Callable[[QueryContext], Union[AsyncIterator[dict], Awaitable[None]]]
+
+
+async def run_query_stages(ctx: QueryContext) -> AsyncIterator[dict]:
+    """
+    Answer a query, yielding the events that are streamed to the client:
+    {"type": "route" | "thinking" | "content", "data": ...}, then {"type": "complete"} once the
+    answer is ready. The query document is persisted after the last event (also when a stage fails),
+    so the caller must exhaust the iterator.
+    """
+    try:
+        async for event in _run_stage(ctx, "route", _route):
+            yield event
+
+        if ctx.cached_answer is not None:
+            ctx.response = ctx.cached_answer["response"]
+            ctx.query_doc["response"] = ctx.response
+            ctx.query_doc["cached_from"] = ctx.cached_answer["query_id"]
+            yield {"type": "content", "data": ctx.response}
+        else:
+            async for event in _run_route_stages(ctx):
+                yield event
+
+        ctx.is_succeeded = True
+        total_time = time.time() - ctx.start_time
+        ctx.timings["total"] = total_time
+        print(f"[PERF] Total query execution time: {total_time:.2f}s")
+        yield {"type": "complete"}
+    except asyncio.CancelledError:
+        await _cancel(ctx)
+        raise
+    except Exception as e:
+        ctx.query_doc["error"] = str(e)
+        if isinstance(e, OperationFailure):
+            ctx.query_doc["error_type"] = "operation_failure"
+        elif is_deadline_error(e):
+            ctx.query_doc["error_type"] = "deadline_exceeded"
+        elif ctx.is_streaming:
+            ctx.query_doc["error_type"] = "streaming_error"
+        else:
+            ctx.query_doc["error_type"] = "others"
+        raise
+    finally:
+        if ctx.speculative_search is not None:
+            ctx.speculative_search.discard()
+        # a retried stage that eventually succeeded does not make the query an error
+        ctx.query_doc["is_error"] = not ctx.is_succeeded
+        try:
+            async for _ in _run_stage(ctx, "persist", _persist):
+                pass
+        except Exception as e:
+            print(f"[WARNING] Failed to persist query {ctx.query_id}: {e}")
+
+
+async def _cancel(ctx: QueryContext):
+    """Kill the MongoDB operations of a cancelled query and record the work that was skipped."""
+    ctx.query_doc["is_cancelled"] = True
+    ctx.query_doc["error_type"] = "cancelled"
+    # e.g. when the query is cancelled on shutdown rather than by its stream
+    ctx.query_doc.setdefault("response", "".join(ctx.streamed_content))
+    if ctx.cached_answer is not None:
+        stages = []
+    else:
+        stages = _NOSQL_STAGES if ctx.route is Route.NOSQL else _VECTOR_STAGES
+    ctx.query_doc["cancelled_stages"] = [
+        name
+        for name in ["route", *(name for name, _ in stages)]
+        if name not in ctx.completed_stages
+    ]
+    try:
+        operations_killed = await kill_operations(ctx.db_conn, ctx.operation_comment)
+    except Exception as e:
+        # e.g. the database user may not run $currentOp, so the operations run until maxTimeMS
+        print(f"[WARNING] Failed to kill the operations of query {ctx.query_id}: {e}")
+        operations_killed = 0
+    elapsed = time.time() - ctx.start_time
+    cancellation_stats.record_cancelled(
+        len(ctx.query_doc["cancelled_stages"]), operations_killed, elapsed
+    )
+    print(
+        f"[INFO] Query {ctx.query_id} cancelled after {elapsed:.2f}s, "
+        f"skipping {ctx.query_doc['cancelled_stages']} and killing {operations_killed} operations"
+    )
+
+
+async def _run_route_stages(ctx: QueryContext) -> AsyncIterator[dict]:
+    """Run the stages of the chosen route, falling back to VECTOR if the MCP agent runs out of time."""
+    if ctx.route is Route.NOSQL:
+        try:
+            for name, stage in _NOSQL_STAGES:
+                async for event in _run_stage(ctx, name, stage):
+                    yield event
+            return
+        except Exception as e:
+            # once the agent has (started to) answer, there is nothing left to fall back for
+            if (
+                not is_deadline_error(e)
+                or "retrieve" in ctx.completed_stages
+                or ctx.has_sent_content
+            ):
+                raise
+            print(
+                f"[WARNING] MCP agent ran out of time, falling back to vector search: {e}"
+            )
+        ctx.query_doc["degraded"] = "vector_fallback"
+        ctx.query_doc.pop("failed_stage", None)
+        ctx.route = Route.VECTOR
+        yield {"type": "route", "data": ctx.route.value}
+
+    for name, stage in _VECTOR_STAGES:
+        async for event in _run_stage(ctx, name, stage):
+            yield event
+
+
+async def _run_stage(ctx: QueryContext, name: str, stage: Stage) -> AsyncIterator[dict]:
+    """Run a stage unless it has completed already, retrying it according to its policy."""
+    if name in ctx.completed_stages:
+        return
+    policy = STAGE_RETRY_POLICIES[name]
+    for attempt in range(1, policy.max_tries + 1):
+        has_sent_content = False
+        try:
+            if inspect.isasyncgenfunction(stage):
+                async for event in stage(ctx):
+                    if event["type"] == "content":
+                        has_sent_content = True
+                        ctx.streamed_content.append(event["data"])
+                    yield event
+            else:
+                await stage(ctx)
+            ctx.completed_stages.add(name)
+            return
+        except Exception as e:
+            # a stage that ran out of time would only run out of time again
+            if attempt == policy.max_tries or has_sent_content or is_deadline_error(e):
+                print(f"[ERROR] Stage {name} failed after {attempt} attempt(s): {e}")
+                ctx.query_doc["failed_stage"] = name
+                raise
+            ctx.query_doc.setdefault("stage_retries", {})[name] = attempt
+            print(
+                f"[WARNING] Stage {name} failed (attempt {attempt}/{policy.max_tries}), retrying: {e}"
+            )
+            await asyncio.sleep(policy.delay * 2 ** (attempt - 1))
+
+
+async def _route(ctx: QueryContext) -> AsyncIterator[dict]:
+    cached_answer = await semantic_cache.lookup(ctx.db_conn, ctx.original_user_query)
+    if cached_answer is not None:
+        ctx.cached_answer = cached_answer
+        yield {"type": "route", "data": cached_answer["route"]}
+        return
+
+    if ctx.speculative_search is None:
+        # start retrieving for the VECTOR route while the router decides
+        ctx.speculative_search = start_speculative_vector_search(
+            ctx.db_conn, ctx.original_user_query, ctx.deadline, ctx.operation_comment
+        )
+
+    # Time the routing decision
+    route_start = time.time()
+    ctx.route = await query_router(ctx.original_user_query, ctx.deadline)
+    route_time = time.time() - route_start
+    ctx.timings["route"] = route_time
+    print(f"[PERF] Route decision took {route_time:.2f}s - Route: {ctx.route}")
+
+    if ctx.route is not Route.VECTOR and ctx.speculative_search is not None:
+        ctx.speculative_search.discard()
+        ctx.speculative_search = None
+    yield {"type": "route", "data": ctx.route.value}
+
+
+async def _retrieve_with_mcp(ctx: QueryContext) -> AsyncIterator[dict]:
+    if ctx.deadline.is_nearly_expired():
+        # the margin is only enough for the VECTOR route
+        raise DeadlineExceededError("Too little time left for the MCP agent")
+    mcp_start = time.time()
+    if ctx.is_streaming:
+        response = ""
+        metadata = {}
+        async with mcp_pool.acquire() as mcp_client:
+            async for chunk in mcp_client.query_with_mcp_streaming(
+                ctx.original_user_query,
+                deadline=ctx.deadline,
+                comment=ctx.operation_comment,
+            ):
+                if chunk["type"] == "metadata":
+                    metadata = chunk["data"]
+                    continue
+                if chunk["type"] == "content":
+                    response += chunk["data"]
+                # stream the thinking process and the answer to the client
+                yield chunk
+        ctx.agent_result = {**metadata, "response": response}
+    else:
+        ctx.agent_result = await query_mcp(
+            ctx.original_user_query, ctx.deadline, ctx.operation_comment
+        )
+    mcp_time = time.time() - mcp_start
+    ctx.timings["mcp"] = mcp_time
+    print(f"[PERF] MCP query took {mcp_time:.2f}s")
+
+    # Extract pipeline information for query_doc
+    for key in ["collection_name", "pipeline", "reason", "degraded"]:
+        if ctx.agent_result.get(key):
+            ctx.query_doc[key] = ctx.agent_result[key]
+    print(
+        f"pipeline: {ctx.agent_result.get('pipeline')} reason: {ctx.agent_result.get('reason')}"
+    )
+
+
+async def _retrieve_with_vector_search(ctx: QueryContext):
+    if ctx.speculative_search is not None:
+        # claim the speculative search once, so that a retry searches again
+        speculative_search, ctx.speculative_search = ctx.speculative_search, None
+        ctx.vector_search_result, vector_timings = await speculative_search.result()
+        ctx.timings.update(vector_timings)
+    else:
+        vector_start = time.time()
+        thread_collection = ctx.db_conn.get_async_collection("thread")
+        ctx.vector_search_result = await vector_search(
+            ctx.original_user_query,
+            thread_collection,
+            ctx.deadline,
+            ctx.operation_comment,
+        )
+        vector_time = time.time() - vector_start
+        ctx.timings["vector_search"] = vector_time
+        print(f"[PERF] Vector search took {vector_time:.2f}s")
+
+    # only store the 'id' and 'vector_search_score' field into query_doc
+    ctx.query_doc["vector_search_result"] = [
+        {"id": result["id"], "score": result["vector_search_score"]}
+        for result in ctx.vector_search_result
+    ]
+
+
+async def _format_mcp_context(ctx: QueryContext):
+    context_messages = deepcopy(ctx.original_user_query)
+    context_messages[-1].content = (
+        f"""User Query:\n{context_messages[-1].content}\n\nData from database:"""
+    )
+    # reuse the documents that the MCP agent already retrieved to list similar threads
+    mongodb_data = ctx.agent_result.get("documents", [])
+    if len(mongodb_data) > 0:
+        _, ctx.similar_threads = get_thread_metadata_and_top_comments(
+            ctx.db_conn, mongodb_data
+        )
+        context_messages[-1].content += f"""\n{mongodb_data}"""
+    ctx.context_messages = context_messages
+
+
+async def _format_vector_context(ctx: QueryContext):
+    ctx.search_result, ctx.similar_threads = get_thread_metadata_and_top_comments(
+        ctx.db_conn, ctx.vector_search_result
+    )
+    context_messages = deepcopy(ctx.original_user_query)
+    context_messages[-1].content += f"""\n{ctx.search_result}"""
+    ctx.context_messages = context_messages
+
+
+async def _generate_from_agent(ctx: QueryContext) -> AsyncIterator[dict]:
+    # the MCP agent already generated (and streamed) its answer while retrieving
+    ctx.response = ctx.agent_result.get("response", "No response generated")
+    async for event in _append_relevant_posts(ctx):
+        yield event
+
+
+async def _generate_with_llm(ctx: QueryContext) -> AsyncIterator[dict]:
+    llm_start = time.time()
+    if ctx.is_streaming:
+        response = ""
+        async for chunk in get_llm_response_streaming(
+            ctx.context_messages, ctx.deadline
+        ):
+            response += chunk
+            yield {"type": "content", "data": chunk}
+    else:
+        response = await get_llm_response(ctx.context_messages, ctx.deadline)
+    ctx.response = response
+    llm_time = time.time() - llm_start
+    ctx.timings["llm"] = llm_time
+    print(f"[PERF] LLM response generation took {llm_time:.2f}s")
+
+    async for event in _append_relevant_posts(ctx):
+        yield event
+
+
+async def _append_relevant_posts(ctx: QueryContext) -> AsyncIterator[dict]:
+    if len(ctx.similar_threads) > 0:
+        # remove duplicates and sort by score in descending order
+        similar_threads = sorted(
+            set(ctx.similar_threads), key=lambda x: x[1], reverse=True
+        )
+        similar_threads_formatted = "\n\n**Relevant posts**\n"
+        # el = a tuple of (formatted similar thread (str), score (int))
+        for i, el in enumerate(similar_threads):
+            similar_threads_formatted += f"{i+1}. {el[0]}\n"
+        ctx.response += similar_threads_formatted
+        yield {"type": "content", "data": similar_threads_formatted}
+    ctx.query_doc["response"] = ctx.response
+
+
+async def _persist(ctx: QueryContext):
+    # a degraded answer is not cached, so that similar queries get a full answer again
+    if (
+        ctx.is_succeeded
+        and ctx.cached_answer is None
+        and ctx.degraded is None
+        and not ctx.is_answer_stored
+    ):
+        await semantic_cache.store(
+            ctx.db_conn, ctx.original_user_query, ctx.route, ctx.response, ctx.query_id
+        )
+        # not stored again if inserting the query document below is retried
+        ctx.is_answer_stored = True
+    await insert_query_document(ctx.db_conn, ctx.query_doc, ctx.username)
+
+
+_NOSQL_STAGES: list[tuple[str, Stage]] = [
+    ("retrieve", _retrieve_with_mcp),
+    ("format", _format_mcp_context),
+    ("generate", _generate_from_agent),
+]
+_VECTOR_STAGES: list[tuple[str, Stage]] = [
+    ("retrieve", _retrieve_with_vector_search),
+    ("format", _format_vector_context),
+    ("generate", _generate_with_llm),
+]
@@ -1,10 +1,17 @@
 from app.db.upsert import update_query_vote
 from app.db.conn import MongoDBConnection
+from app.db.write_buffer import write_buffer
+from app.utils.semantic_cache import semantic_cache
 
 
-def vote_put(db_conn: MongoDBConnection, query_id: str, vote: int, username: str):
-    result = update_query_vote(db_conn, query_id, vote, username)
-    if result:
+async def vote_put(db_conn: MongoDBConnection, query_id: str, vote: int, username: str):
+    result = await update_query_vote(db_conn, query_id, vote, username)
+    if vote < 0:
+        # a downvoted answer should never be served to paraphrased queries
+        await semantic_cache.invalidate(db_conn, query_id)
+    if write_buffer.is_running:
+        print("Vote queued in the write-behind buffer")
+    elif result:
         if result.matched_count > 0:
             if result.modified_count > 0:
                 print("Document updated successfully")
@@ -0,0 +1,95 @@
+"""
+Query Cancellation
+
+When a client closes the connection of POST /queries/stream, the query is cancelled instead of being
+answered for nobody:
+- query_post_streaming checks for the disconnect every QUERY_DISCONNECT_POLL_INTERVAL seconds and
+  cancels the task that runs the query stages
+- the OpenAI stream that is being read is closed, so that OpenAI stops generating
+- the MongoDB operations of the query, which are tagged with the comment "query:<query_id>", are
+  killed with killOp
+- the query document is still persisted with the content streamed so far, marked as is_cancelled
+- on shutdown, queries that are still running get QUERY_SHUTDOWN_TIMEOUT_SECONDS to finish and are
+  then cancelled, before the persistence queue and the write buffer close
+"""
+
+import os
+from dotenv import load_dotenv
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+from app.db.conn import MongoDBConnection
+
+load_dotenv()
+
+QUERY_DISCONNECT_POLL_INTERVAL = float(
+    os.environ.get("QUERY_DISCONNECT_POLL_INTERVAL", 0.5)
+)
+# how long shutdown waits for running queries before cancelling them
+QUERY_SHUTDOWN_TIMEOUT_SECONDS = float(
+    os.environ.get("QUERY_SHUTDOWN_TIMEOUT_SECONDS", 10)
+)
+
+
+def get_operation_comment(query_id: ObjectId) -> str:
+    """The comment that tags the MongoDB operations run for a query."""
+    return f"query:{query_id}"
+
+
+async def kill_operations(db_conn: MongoDBConnection, comment: str) -> int:
+    """Kill the running MongoDB operations tagged with a comment, returning how many were killed."""
+    admin_db = db_conn.async_client.admin
+    cursor = await admin_db.aggregate(
+        [
+            {"$currentOp": {}},
+            {
+                "$match": {
+                    "$or": [
+                        {"command.comment": comment},
+                        # getMore commands of a tagged cursor
+                        {"cursor.originatingCommand.comment": comment},
+                    ]
+                }
+            },
+            {"$project": {"opid": 1}},
+        ]
+    )
+    killed = 0
+    for operation in await cursor.to_list():
+        try:
+            await admin_db.command("killOp", op=operation["opid"])
+            killed += 1
+        except PyMongoError as e:
+            # e.g. the operation finished in the meantime
+            print(f"[WARNING] Failed to kill operation {operation['opid']}: {e}")
+    return killed
+
+
+class CancellationStats:
+    """Counts cancelled queries and the work that was saved by cancelling them."""
+
+    def __init__(self):
+        self._stats = {
+            "cancelled": 0,
+            # stages that were interrupted or never ran
+            "stages_skipped": 0,
+            "operations_killed": 0,
+            "llm_streams_closed": 0,
+            "seconds_before_cancel": 0.0,
+        }
+
+    def record_cancelled(
+        self, stages_skipped: int, operations_killed: int, elapsed: float
+    ):
+        self._stats["cancelled"] += 1
+        self._stats["stages_skipped"] += stages_skipped
+        self._stats["operations_killed"] += operations_killed
+        self._stats["seconds_before_cancel"] += elapsed
+
+    def record_closed_stream(self):
+        self._stats["llm_streams_closed"] += 1
+
+    def stats(self) -> dict:
+        return dict(self._stats)
+
+
+cancellation_stats = CancellationStats()
@@ -0,0 +1,92 @@
+"""
+Query Deadlines
+
+Every query gets a latency budget: QUERY_DEADLINE_SECONDS for POST /queries and
+QUERY_STREAM_DEADLINE_SECONDS for POST /queries/stream (0 disables it). The Deadline is passed
+through the router, the MCP agent, the vector search and the LLM calls, which bound their waits by
+the time that is left. The last QUERY_DEADLINE_MARGIN_SECONDS of the budget are reserved for a
+degraded answer, i.e. the MCP agent stops querying the database when only the margin is left.
+"""
+
+import os
+import time
+import asyncio
+from typing import Awaitable, Optional, TypeVar
+from dotenv import load_dotenv
+from openai import APITimeoutError
+from pymongo.errors import ExecutionTimeout
+
+load_dotenv()
+
+QUERY_DEADLINE_SECONDS = float(os.environ.get("QUERY_DEADLINE_SECONDS", 60))
+QUERY_STREAM_DEADLINE_SECONDS = float(
+    os.environ.get("QUERY_STREAM_DEADLINE_SECONDS", 90)
+)
+QUERY_DEADLINE_MARGIN_SECONDS = float(
+    os.environ.get("QUERY_DEADLINE_MARGIN_SECONDS", 10)
+)
+
+T = TypeVar("T")
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float, margin: float = QUERY_DEADLINE_MARGIN_SECONDS):
+        # a budget of 0 (or less) means that there is no deadline
+        self.expires_at = time.monotonic() + seconds if seconds > 0 else None
+        self.margin = margin
+
+    @classmethod
+    def for_query(cls, is_streaming: bool) -> "Deadline":
+        return cls(
+            QUERY_STREAM_DEADLINE_SECONDS if is_streaming else QUERY_DEADLINE_SECONDS
+        )
+
+    def remaining(self, reserve: float = 0.0) -> Optional[float]:
+        """Seconds left until `reserve` seconds before the deadline, or None if there is no deadline."""
+        if self.expires_at is None:
+            return None
+        return self.expires_at - reserve - time.monotonic()
+
+    def is_nearly_expired(self) -> bool:
+        """Whether only the margin reserved for a degraded answer is left."""
+        remaining = self.remaining(self.margin)
+        return remaining is not None and remaining <= 0
+
+    def max_time_ms(self) -> Optional[int]:
+        """The time left as a MongoDB maxTimeMS, or None if there is no deadline."""
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        return max(1, int(remaining * 1000))
+
+
+def is_deadline_error(e: BaseException) -> bool:
+    """Whether an exception means that a call ran out of time."""
+    return isinstance(
+        e, (DeadlineExceededError, TimeoutError, APITimeoutError, ExecutionTimeout)
+    )
+
+
+async def with_deadline(
+    aw: Awaitable[T], deadline: Optional[Deadline], reserve: float = 0.0
+) -> T:
+    """
+    Await `aw`, raising DeadlineExceededError if it is still running `reserve` seconds before the
+    deadline. This also bounds the retries that the OpenAI client makes on its own.
+    """
+    remaining = deadline.remaining(reserve) if deadline is not None else None
+    if remaining is None:
+        return await aw
+    if remaining <= 0:
+        # close the coroutine, so that it is not reported as never awaited
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise DeadlineExceededError("Query deadline exceeded")
+    try:
+        return await asyncio.wait_for(aw, remaining)
+    except TimeoutError:
+        raise DeadlineExceededError("Query deadline exceeded") from None
@@ -0,0 +1,170 @@
+import os
+import re
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+from dotenv import load_dotenv
+from pymongo import ASCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+from app.db.conn import MongoDBConnection
+
+load_dotenv()
+
+# maximum number of embeddings kept in memory before the least recently used one is evicted
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 2048))
+# "memory" keeps the cache in-process only, "mongo" additionally persists it to a TTL collection
+EMBEDDING_CACHE_BACKEND = os.environ.get("EMBEDDING_CACHE_BACKEND", "memory").lower()
+EMBEDDING_CACHE_TTL_SECONDS = int(
+    os.environ.get("EMBEDDING_CACHE_TTL_SECONDS", 30 * 24 * 60 * 60)
+)
+EMBEDDING_CACHE_COLLECTION = "embedding_cache"
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for query embeddings.
+
+    The first tier is an in-memory LRU bounded by EMBEDDING_CACHE_MAX_ENTRIES.
+    The optional second tier is a MongoDB collection with a TTL index, which survives restarts
+    and is shared by all workers.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        backend: str = EMBEDDING_CACHE_BACKEND,
+        ttl_seconds: int = EMBEDDING_CACHE_TTL_SECONDS,
+    ):
+        self.max_entries = max_entries
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        # key -> {"embedding": list[float], "latency": float, "tokens": int}
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._collection: Optional[AsyncCollection] = None
+        self._stats = {
+            "memory_hits": 0,
+            "persistent_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "latency_saved_s": 0.0,
+            "tokens_saved": 0,
+            "miss_latency_s": 0.0,
+        }
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        # lowercase and collapse whitespace within each line, but keep the line breaks
+        # that separate the messages of a conversation
+        normalised = re.sub(r"[^\S\n]+", " ", text.strip().lower())
+        digest = hashlib.sha256(normalised.encode("utf-8")).hexdigest()
+        return f"{model}:{digest}"
+
+    async def get(self, model: str, text: str) -> Optional[list[float]]:
+        key = self.make_key(model, text)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self._record_hit("memory_hits", entry)
+            return entry["embedding"]
+
+        if self.backend == "mongo":
+            try:
+                doc = await self._find_persisted(key)
+            except Exception as e:
+                print(f"[WARNING] Embedding cache lookup failed: {e}")
+                doc = None
+            if doc is not None:
+                entry = {
+                    "embedding": doc["embedding"],
+                    "latency": doc.get("latency", 0.0),
+                    "tokens": doc.get("tokens", 0),
+                }
+                self._put_in_memory(key, entry)
+                self._record_hit("persistent_hits", entry)
+                return entry["embedding"]
+
+        self._stats["misses"] += 1
+        return None
+
+    async def set(
+        self,
+        model: str,
+        text: str,
+        embedding: list[float],
+        latency: float = 0.0,
+        tokens: int = 0,
+    ):
+        key = self.make_key(model, text)
+        entry = {"embedding": embedding, "latency": latency, "tokens": tokens}
+        self._put_in_memory(key, entry)
+        self._stats["miss_latency_s"] += latency
+
+        if self.backend == "mongo":
+            try:
+                await self._persist(key, model, entry)
+            except Exception as e:
+                # the cache is best-effort, so a failed write should never fail the query
+                print(f"[WARNING] Embedding cache write failed: {e}")
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        hits = self._stats["memory_hits"] + self._stats["persistent_hits"]
+        lookups = hits + self._stats["misses"]
+        return {
+            **self._stats,
+            "backend": self.backend,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _record_hit(self, counter: str, entry: dict):
+        self._stats[counter] += 1
+        self._stats["latency_saved_s"] += entry["latency"]
+        self._stats["tokens_saved"] += entry["tokens"]
+
+    def _put_in_memory(self, key: str, entry: dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    async def _get_collection(self) -> AsyncCollection:
+        if self._collection is None:
+            collection = MongoDBConnection().get_async_collection(
+                EMBEDDING_CACHE_COLLECTION
+            )
+            # create_index is a no-op if an identical index already exists
+            await collection.create_index(
+                [("created_at", ASCENDING)], expireAfterSeconds=self.ttl_seconds
+            )
+            self._collection = collection
+        return self._collection
+
+    async def _find_persisted(self, key: str) -> Optional[dict]:
+        collection = await self._get_collection()
+        return await collection.find_one({"_id": key})
+
+    async def _persist(self, key: str, model: str, entry: dict):
+        collection = await self._get_collection()
+        await collection.update_one(
+            {"_id": key},
+            {
+                "$set": {
+                    "model": model,
+                    "embedding": entry["embedding"],
+                    "latency": entry["latency"],
+                    "tokens": entry["tokens"],
+                    "created_at": datetime.now(timezone.utc),
+                }
+            },
+            upsert=True,
+        )
+
+
+embedding_cache = EmbeddingCache()
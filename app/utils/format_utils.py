@@ -1,4 +1,6 @@
 import re
+import base64
+from bson import ObjectId
 from app.schemas.message import Message
 
 
@@ -6,3 +8,17 @@ def normalise_query(query: list[Message]):
     for i in range(len(query)):
         query[i].content = re.sub(r"\s+", " ", query[i].content.strip().lower())
     return query
+
+
+def encode_chat_cursor(created_utc: int, chat_id: ObjectId) -> str:
+    """Encode the position of a chat in the chat list as an opaque continuation token."""
+    return base64.urlsafe_b64encode(f"{created_utc}:{chat_id}".encode()).decode()
+
+
+def decode_chat_cursor(cursor: str) -> tuple[int, ObjectId]:
+    """Decode a token from encode_chat_cursor. Raises ValueError if it is malformed."""
+    try:
+        created_utc, chat_id = base64.urlsafe_b64decode(cursor).decode().split(":")
+        return int(created_utc), ObjectId(chat_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
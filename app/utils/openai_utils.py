@@ -1,13 +1,22 @@
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, AsyncStream
 import os
 import app.constants as constants
 import json
 import re
 import sympy
+from typing import Optional
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from app.schemas.mongo_pipeline_response import MongoPipelineResponse
 from app.schemas.message import Message
 from app.schemas.query_router_response import QueryRouterResponse, Route
+from app.utils.route_classifier import (
+    ROUTE_CLASSIFIER_MODE,
+    ROUTE_CLASSIFIER_THRESHOLD,
+    classify_route,
+)
+from app.utils.deadline import Deadline, with_deadline
+from app.utils.cancellation import cancellation_stats
 
 
 load_dotenv()
@@ -15,17 +24,39 @@ load_dotenv()
 client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
 
-async def query_router(user_query: list[Message]) -> Route:
+async def query_router(
+    user_query: list[Message], deadline: Optional[Deadline] = None
+) -> Route:
+    if ROUTE_CLASSIFIER_MODE == "local":
+        prediction = await with_deadline(classify_route(user_query), deadline)
+        if prediction is not None:
+            route, confidence = prediction
+            if confidence >= ROUTE_CLASSIFIER_THRESHOLD:
+                print(f"[INFO] Local router picked {route} ({confidence:.2f})")
+                return route
+            print(
+                f"[INFO] Local router unsure ({route}, {confidence:.2f}), falling back to LLM"
+            )
+
+    return await query_router_llm(user_query, deadline)
+
+
+async def query_router_llm(
+    user_query: list[Message], deadline: Optional[Deadline] = None
+) -> Route:
     messages = [
         {"role": "system", "content": constants.SYSTEM_PROMPT_QUERY_ROUTER},
     ] + user_query
 
-    completion = await client.beta.chat.completions.parse(
-        model=os.environ.get("OPENAI_MODEL_STANDARD"),
-        messages=messages,
-        response_format=QueryRouterResponse,
-        temperature=0.2,
-        top_p=0.2,
+    completion = await with_deadline(
+        client.beta.chat.completions.parse(
+            model=os.environ.get("OPENAI_MODEL_STANDARD"),
+            messages=messages,
+            response_format=QueryRouterResponse,
+            temperature=0.2,
+            top_p=0.2,
+        ),
+        deadline,
     )
     parsed_obj = completion.choices[0].message.parsed
     return parsed_obj.route
@@ -61,36 +92,62 @@ async def get_mongo_pipeline(user_query: list[Message]) -> MongoPipelineResponse
         raise e
 
 
-async def get_llm_response(prompt: list[Message]):
+async def get_llm_response(prompt: list[Message], deadline: Optional[Deadline] = None):
     messages = [
         {"role": "system", "content": constants.SYSTEM_PROMPT},
     ] + prompt
-    completion = await client.chat.completions.create(
-        model=os.environ.get("OPENAI_MODEL_MINI"), messages=messages
+    completion = await with_deadline(
+        client.chat.completions.create(
+            model=os.environ.get("OPENAI_MODEL_MINI"), messages=messages
+        ),
+        deadline,
     )
 
     return completion.choices[0].message.content
 
 
-async def get_llm_response_streaming(prompt: list[Message]):
+async def get_llm_response_streaming(
+    prompt: list[Message], deadline: Optional[Deadline] = None
+):
     """
     Stream the LLM response for vector search route.
 
     Yields text chunks as they're generated by OpenAI.
+    The deadline bounds the wait for the stream to start, as cutting off an answer that is already
+    being streamed would leave the client with half an answer.
     """
     messages = [
         {"role": "system", "content": constants.SYSTEM_PROMPT},
     ] + prompt
 
-    stream = await client.chat.completions.create(
-        model=os.environ.get("OPENAI_MODEL_MINI"),
-        messages=messages,
-        stream=True,
+    stream = await with_deadline(
+        client.chat.completions.create(
+            model=os.environ.get("OPENAI_MODEL_MINI"),
+            messages=messages,
+            stream=True,
+        ),
+        deadline,
     )
 
-    async for chunk in stream:
-        if chunk.choices[0].delta.content:
-            yield chunk.choices[0].delta.content
+    async with closing_stream(stream):
+        async for chunk in stream:
+            if chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+@asynccontextmanager
+async def closing_stream(stream: AsyncStream):
+    """
+    Close an OpenAI stream that was not read to the end when the block exits, e.g. because the query
+    was cancelled, so that OpenAI stops generating the rest of the answer.
+    """
+    try:
+        yield stream
+    finally:
+        # a stream that was read to the end has closed its response already
+        if not stream.response.is_closed:
+            await stream.close()
+            cancellation_stats.record_closed_stream()
 
 
 def _format_braces(json_string):
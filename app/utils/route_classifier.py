@@ -0,0 +1,114 @@
+import os
+import pathlib
+import numpy as np
+from typing import Optional
+from dotenv import load_dotenv
+from app.schemas.message import Message
+from app.schemas.route import Route
+from app.utils.vector_search import get_embedding, get_query_text
+
+load_dotenv()
+
+# "llm" always asks the LLM, "local" only asks the LLM when the local classifier is unsure
+ROUTE_CLASSIFIER_MODE = os.environ.get("ROUTE_CLASSIFIER_MODE", "llm").lower()
+ROUTE_CLASSIFIER_PATH = os.environ.get(
+    "ROUTE_CLASSIFIER_PATH",
+    str(pathlib.Path(__file__).parent.parent / "models" / "route_classifier.npz"),
+)
+# minimum confidence needed to skip the LLM router
+ROUTE_CLASSIFIER_THRESHOLD = float(os.environ.get("ROUTE_CLASSIFIER_THRESHOLD", 0.8))
+
+
+class RouteClassifier:
+    """
+    Nearest-centroid classifier over normalised query embeddings.
+
+    The confidence of a prediction is the softmax of the cosine similarities to each centroid,
+    scaled by a temperature that is stored with the centroids.
+    """
+
+    def __init__(self, centroids: np.ndarray, routes: list[Route], temperature: float):
+        self.centroids = centroids
+        self.routes = routes
+        self.temperature = temperature
+
+    @classmethod
+    def train(
+        cls,
+        embeddings: list[list[float]],
+        labels: list[Route],
+        temperature: float = 0.05,
+    ) -> "RouteClassifier":
+        vectors = _normalise(np.asarray(embeddings, dtype=np.float32))
+        labels = np.asarray([label.value for label in labels])
+        routes = [route for route in Route if np.any(labels == route.value)]
+        if len(routes) < 2:
+            raise ValueError("Training data must contain examples of every route")
+
+        centroids = np.stack(
+            [vectors[labels == route.value].mean(axis=0) for route in routes]
+        )
+        return cls(_normalise(centroids), routes, temperature)
+
+    @classmethod
+    def load(cls, path: str = ROUTE_CLASSIFIER_PATH) -> "RouteClassifier":
+        artifact = np.load(path)
+        routes = [Route(route) for route in artifact["routes"]]
+        return cls(artifact["centroids"], routes, float(artifact["temperature"]))
+
+    def save(self, path: str = ROUTE_CLASSIFIER_PATH):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            path,
+            centroids=self.centroids,
+            routes=np.asarray([route.value for route in self.routes]),
+            temperature=np.float32(self.temperature),
+        )
+
+    def predict(self, embedding: list[float]) -> tuple[Route, float]:
+        vector = _normalise(np.asarray(embedding, dtype=np.float32))
+        similarities = self.centroids @ vector
+        logits = similarities / self.temperature
+        # subtract the max logit for numerical stability
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.routes[best], float(probabilities[best])
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+_classifier: Optional[RouteClassifier] = None
+_is_load_attempted = False
+
+
+def get_route_classifier() -> Optional[RouteClassifier]:
+    """Load the classifier once, returning None if no trained artifact exists."""
+    global _classifier, _is_load_attempted
+
+    if not _is_load_attempted:
+        _is_load_attempted = True
+        try:
+            _classifier = RouteClassifier.load()
+            print(f"[INFO] Loaded route classifier from {ROUTE_CLASSIFIER_PATH}")
+        except Exception as e:
+            print(f"[WARNING] Route classifier unavailable, using LLM router: {e}")
+    return _classifier
+
+
+async def classify_route(user_query: list[Message]) -> Optional[tuple[Route, float]]:
+    """
+    Return the locally predicted route and its confidence, or None if the classifier is unavailable.
+    The embedding is shared with the vector search through the embedding cache.
+    """
+    classifier = get_route_classifier()
+    if classifier is None:
+        return None
+
+    query_embedding = await get_embedding(get_query_text(user_query))
+    if query_embedding is None:
+        return None
+    return classifier.predict(query_embedding)
@@ -0,0 +1,187 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from bson import ObjectId
+from dotenv import load_dotenv
+from app.db.conn import MongoDBConnection
+from app.db.get import get_query_cached_from, get_semantic_cache_match
+from app.db.upsert import (
+    create_semantic_cache_index,
+    insert_semantic_cache_entry,
+    delete_semantic_cache_entries,
+)
+from app.schemas.message import Message
+from app.schemas.route import Route
+from app.utils.vector_search import get_embedding, get_query_text
+
+load_dotenv()
+
+SEMANTIC_CACHE_ENABLED = (
+    os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+)
+# minimum cosine similarity between the new query and a cached query for a hit
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+# routes whose answers may be served from the cache, e.g. "vector" to only cache vector answers
+SEMANTIC_CACHE_ROUTES = [
+    route.strip()
+    for route in os.environ.get("SEMANTIC_CACHE_ROUTES", "nosql,vector").split(",")
+    if route.strip()
+]
+# NOSQL answers are often time-sensitive (e.g. "top posts this week"), so they expire sooner
+SEMANTIC_CACHE_TTL_SECONDS = {
+    Route.NOSQL: int(os.environ.get("SEMANTIC_CACHE_TTL_NOSQL", 60 * 60)),
+    Route.VECTOR: int(os.environ.get("SEMANTIC_CACHE_TTL_VECTOR", 24 * 60 * 60)),
+}
+
+
+class SemanticCache:
+    """
+    Serves previous answers to paraphrased questions.
+
+    Only standalone questions (i.e. the first message of a chat) are cached because
+    follow-up questions depend on the rest of the conversation.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SEMANTIC_CACHE_ENABLED,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        routes: list[str] = SEMANTIC_CACHE_ROUTES,
+        ttl_seconds: dict = SEMANTIC_CACHE_TTL_SECONDS,
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.routes = routes
+        self.ttl_seconds = ttl_seconds
+        self._is_index_created = False
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    def is_cacheable(self, query: list[Message]) -> bool:
+        return self.enabled and len(self.routes) > 0 and len(query) == 1
+
+    async def lookup(
+        self, db_conn: MongoDBConnection, query: list[Message]
+    ) -> Optional[dict]:
+        """
+        Return the cached answer for a paraphrase of this query, or None.
+        The returned dictionary contains "query_id", "route", "response" and "score".
+        """
+        if not self.is_cacheable(query):
+            return None
+
+        try:
+            query_embedding = await get_embedding(get_query_text(query))
+            # Atlas normalises cosine similarity to a score in [0, 1] using (1 + cosine) / 2
+            min_score = (1 + self.threshold) / 2
+            match = await get_semantic_cache_match(
+                db_conn, query_embedding, self.routes, min_score
+            )
+        except Exception as e:
+            # a broken cache should never fail the query
+            print(f"[WARNING] Semantic cache lookup failed: {e}")
+            match = None
+
+        if match is None:
+            self._stats["misses"] += 1
+            return None
+
+        self._stats["hits"] += 1
+        print(
+            f"[INFO] Semantic cache hit (score: {match['score']:.3f}) from query {match['query_id']}"
+        )
+        return match
+
+    async def store(
+        self,
+        db_conn: MongoDBConnection,
+        query: list[Message],
+        route: Route,
+        response: str,
+        query_id: ObjectId,
+    ):
+        """Cache a successful answer so that paraphrases of the query can reuse it."""
+        if not self.is_cacheable(query) or route.value not in self.routes:
+            return
+
+        try:
+            # this is an embedding cache hit as the query was already embedded during lookup
+            query_embedding = await get_embedding(get_query_text(query))
+            now = datetime.now(timezone.utc)
+            entry = {
+                "query_id": query_id,
+                "query": query[-1].content,
+                "route": route.value,
+                "embedding": query_embedding,
+                "response": response,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl_seconds[route]),
+            }
+            if not self._is_index_created:
+                await create_semantic_cache_index(db_conn)
+                self._is_index_created = True
+            await insert_semantic_cache_entry(db_conn, entry)
+            self._stats["stores"] += 1
+        except Exception as e:
+            print(f"[WARNING] Semantic cache store failed: {e}")
+
+    async def invalidate(self, db_conn: MongoDBConnection, query_id: str) -> int:
+        """
+        Remove the cached answer of a query, e.g. after it has been downvoted.
+        If the query was answered from the cache, the entry that it was served from is removed too.
+        """
+        query_ids = [ObjectId(query_id)]
+        cached_from = await get_query_cached_from(db_conn, query_id)
+        if cached_from is not None:
+            query_ids.append(cached_from)
+        deleted_count = await delete_semantic_cache_entries(
+            db_conn, {"query_id": {"$in": query_ids}}
+        )
+        self._stats["invalidations"] += deleted_count
+        return deleted_count
+
+    async def clear(
+        self, db_conn: MongoDBConnection, route: Optional[Route] = None
+    ) -> int:
+        """Remove all cached answers, or only those of the given route."""
+        filter = {} if route is None else {"route": route.value}
+        deleted_count = await delete_semantic_cache_entries(db_conn, filter)
+        self._stats["invalidations"] += deleted_count
+        return deleted_count
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "enabled": self.enabled,
+            "routes": self.routes,
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+        }
+
+
+semantic_cache = SemanticCache()
+
+
+async def _main(args):
+    db_conn = MongoDBConnection()
+    try:
+        if args.query_id:
+            deleted_count = await semantic_cache.invalidate(db_conn, args.query_id)
+        else:
+            route = Route(args.route) if args.route else None
+            deleted_count = await semantic_cache.clear(db_conn, route)
+        print(f"Deleted {deleted_count} cached answers")
+    finally:
+        await db_conn.close_async()
+        db_conn.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Invalidate cached answers")
+    parser.add_argument(
+        "--route", choices=[route.value for route in Route], default=None
+    )
+    parser.add_argument("--query-id", default=None)
+    asyncio.run(_main(parser.parse_args()))
@@ -1,9 +1,13 @@
 import os
+import time
+import asyncio
+from typing import Optional
 from dotenv import load_dotenv
 from app.schemas.message import Message
-from pymongo.collection import Collection
+from pymongo.asynchronous.collection import AsyncCollection
 from openai import AsyncOpenAI
-from fastapi.concurrency import run_in_threadpool
+from app.utils.embedding_cache import embedding_cache
+from app.utils.deadline import Deadline, with_deadline
 
 load_dotenv()
 
@@ -11,24 +15,35 @@ client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
 EMBEDDING_MODEL = "text-embedding-3-small"
 
+# embedding requests that are still in flight, keyed like the embedding cache
+# this lets concurrent callers (e.g. the local router and a speculative vector search) share one request
+_inflight_embeddings: dict[str, asyncio.Task] = {}
+
 
 # TODO: Perhaps, before doing a vector search, we first filter for those with at least x number of upvotes?
 # TODO: Alternatively, do vector search first THEN filter for upvotes?
-async def vector_search(user_query: list[Message], collection: Collection):
+async def vector_search(
+    user_query: list[Message],
+    collection: AsyncCollection,
+    deadline: Optional[Deadline] = None,
+    comment: Optional[str] = None,
+):
     """
     Perform a vector search in the MongoDB collection based on the user query.
 
     Args:
     user_query (str): The user's query string.
     collection (MongoCollection): The MongoDB collection to search.
+    deadline (Deadline): Bounds the embedding request and the search, if given.
+    comment (str): Tags the search, so that it can be killed if the query is cancelled.
 
     Returns:
     list: A list of matching documents.
     """
     # print(f"user_query: {user_query}")
-    user_query_str = "\n".join([msg.content for msg in user_query])
+    user_query_str = get_query_text(user_query)
     # Generate embedding for the user query
-    query_embedding = await _get_embedding(user_query_str)
+    query_embedding = await with_deadline(get_embedding(user_query_str), deadline)
 
     if query_embedding is None:
         return "Invalid query or embedding generation failed."
@@ -62,21 +77,63 @@ async def vector_search(user_query: list[Message], collection: Collection):
     ]
 
     # Execute the search
-    results = await run_in_threadpool(lambda: list(collection.aggregate(pipeline)))
+    max_time_ms = deadline.max_time_ms() if deadline is not None else None
+    cursor = await collection.aggregate(
+        pipeline,
+        comment=comment,
+        **({"maxTimeMS": max_time_ms} if max_time_ms is not None else {}),
+    )
+    results = await cursor.to_list()
     return results
 
 
-async def _get_embedding(text):
+def get_query_text(user_query: list[Message]) -> str:
+    """Join a conversation into the text that is embedded for it."""
+    return "\n".join([msg.content for msg in user_query])
+
+
+async def get_embedding(text):
     """Generate an embedding for the given text using OpenAI's API."""
 
     # Check for valid input
     if not text or not isinstance(text, str):
         return None
 
+    cached_embedding = await embedding_cache.get(EMBEDDING_MODEL, text)
+    if cached_embedding is not None:
+        return cached_embedding
+
+    key = embedding_cache.make_key(EMBEDDING_MODEL, text)
+    task = _inflight_embeddings.get(key)
+    if task is None:
+        task = asyncio.create_task(_create_embedding(text))
+        _inflight_embeddings[key] = task
+        task.add_done_callback(lambda t: _forget_embedding_task(key, t))
+
+    # shield the shared request so that cancelling one caller does not cancel it for the others
+    return await asyncio.shield(task)
+
+
+def _forget_embedding_task(key: str, task: asyncio.Task):
+    _inflight_embeddings.pop(key, None)
+    # mark the exception as retrieved in case every caller was cancelled before it was raised
+    if not task.cancelled():
+        task.exception()
+
+
+async def _create_embedding(text: str):
     try:
         # Call OpenAI API to get the embedding
+        start_time = time.time()
         response = await client.embeddings.create(input=text, model=EMBEDDING_MODEL)
         embedding = response.data[0].embedding
+        await embedding_cache.set(
+            EMBEDDING_MODEL,
+            text,
+            embedding,
+            latency=time.time() - start_time,
+            tokens=response.usage.total_tokens if response.usage else 0,
+        )
         return embedding
     except Exception as e:
         raise e
@@ -0,0 +1,114 @@
+"""
+Compare the throughput of the data layer when queries run on the synchronous client through
+run_in_threadpool (the previous approach) against the asyncio-native client.
+
+Seeds a throwaway database on a local mongod with chats for a few users, then runs the same
+get_user_chats pipeline with increasing concurrency.
+
+Usage: python test/benchmark_db.py [--uri mongodb://localhost:27017] [--requests 2000]
+"""
+
+import sys
+import os
+import time
+import asyncio
+import argparse
+from bson import ObjectId
+from pymongo import MongoClient, AsyncMongoClient
+from fastapi.concurrency import run_in_threadpool
+
+# add parent path to sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.db.get import get_user_chats_pipeline
+from app.db.indexes import INDEX_MANIFEST, is_deleted_backfill
+
+DB_NAME = "reddit_llm_benchmark"
+USERNAMES = [f"user_{i}" for i in range(20)]
+
+
+def seed(client: MongoClient, chats_per_user: int, queries_per_chat: int):
+    query_collection = client[DB_NAME]["query"]
+    query_collection.drop()
+    now = int(time.time())
+    docs = []
+    for username in USERNAMES:
+        for chat in range(chats_per_user):
+            chat_id = ObjectId()
+            for i in range(queries_per_chat):
+                docs.append(
+                    {
+                        "chat_id": chat_id,
+                        "username": username,
+                        "query": f"question {i} of chat {chat}",
+                        "response": "answer " * 50,
+                        "created_utc": now - chat * 600 - i,
+                        "is_error": False,
+                        "is_deleted": False,
+                    }
+                )
+    query_collection.insert_many(docs)
+    # the partial indexes that get_user_chats_pipeline uses in production
+    query_collection.create_indexes(INDEX_MANIFEST["query"])
+    # every seeded document has is_deleted, so chats are read as after the backfill
+    is_deleted_backfill.is_confirmed = True
+
+
+async def run_sync(client: MongoClient, num_requests: int, concurrency: int) -> float:
+    query_collection = client[DB_NAME]["query"]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(i: int):
+        pipeline = get_user_chats_pipeline(USERNAMES[i % len(USERNAMES)])
+        async with semaphore:
+            await run_in_threadpool(lambda: list(query_collection.aggregate(pipeline)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(i) for i in range(num_requests)])
+    return num_requests / (time.perf_counter() - start)
+
+
+async def run_async(
+    client: AsyncMongoClient, num_requests: int, concurrency: int
+) -> float:
+    query_collection = client[DB_NAME]["query"]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(i: int):
+        pipeline = get_user_chats_pipeline(USERNAMES[i % len(USERNAMES)])
+        async with semaphore:
+            cursor = await query_collection.aggregate(pipeline)
+            await cursor.to_list()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(i) for i in range(num_requests)])
+    return num_requests / (time.perf_counter() - start)
+
+
+async def main(args):
+    # use the same pool sizes as MongoDBConnection
+    sync_client = MongoClient(args.uri, maxPoolSize=10, minPoolSize=5)
+    async_client = AsyncMongoClient(args.uri, maxPoolSize=50, minPoolSize=5)
+    try:
+        seed(sync_client, args.chats_per_user, args.queries_per_chat)
+        # warm up both connection pools
+        await run_sync(sync_client, 50, 10)
+        await run_async(async_client, 50, 10)
+
+        print(f"{'concurrency':>11} {'threadpool req/s':>17} {'async req/s':>12}")
+        for concurrency in [1, 10, 50, 100, 200]:
+            sync_rate = await run_sync(sync_client, args.requests, concurrency)
+            async_rate = await run_async(async_client, args.requests, concurrency)
+            print(f"{concurrency:>11} {sync_rate:>17.0f} {async_rate:>12.0f}")
+    finally:
+        sync_client.drop_database(DB_NAME)
+        sync_client.close()
+        await async_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--chats-per-user", type=int, default=200)
+    parser.add_argument("--queries-per-chat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
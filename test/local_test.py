@@ -1,5 +1,6 @@
 import sys
 import os
+import asyncio
 
 # add parent path to sys path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -10,20 +11,28 @@ from app.schemas.message import Message
 from app.schemas.role import Role
 from app.db.get import get_response_from_pipeline
 
-try:
-    user_query = "What are the key challenges that youths face?"
-    user_query = "What are the top 5 posts since 1st September 2024?\nCurrent time in seconds since epoch: 1726302088"
-    user_query = "What is the average number of comments on a thread?"
-    message = [Message(content=user_query, role=Role.USER)]
-    db_conn = MongoDBConnection()
-    pipeline = get_mongo_pipeline(message)
-    print(f"pipeline: {pipeline}")
-    response = get_response_from_pipeline(db_conn, "thread", pipeline.pipeline)
-    # response = query_post(db_conn, message, "PLACEHOLDER", "66efd4752fed95286650b9a3")
-    print(f"response: {response} type: {type(response)}")
-except Exception as e:
-    raise e
-finally:
-    db_conn.close()
+
+async def main():
+    try:
+        user_query = "What are the key challenges that youths face?"
+        user_query = "What are the top 5 posts since 1st September 2024?\nCurrent time in seconds since epoch: 1726302088"
+        user_query = "What is the average number of comments on a thread?"
+        message = [Message(content=user_query, role=Role.USER)]
+        db_conn = MongoDBConnection()
+        pipeline = await get_mongo_pipeline(message)
+        print(f"pipeline: {pipeline}")
+        response = await get_response_from_pipeline(
+            db_conn, "thread", pipeline.pipeline
+        )
+        # response = await query_post(db_conn, message, "PLACEHOLDER", "66efd4752fed95286650b9a3")
+        print(f"response: {response} type: {type(response)}")
+    except Exception as e:
+        raise e
+    finally:
+        await db_conn.close_async()
+        db_conn.close()
+
+
+asyncio.run(main())
 
 # {"$project": {"selftext_embedding": 0, "_id": 0}}
@@ -0,0 +1,73 @@
+"""
+Measure the per-tool-call overhead of the stdio and in-process MCP transports.
+
+For each transport, starts an MCPMongoClient, warms it up and then times the same tool call
+sequentially. The default tool (get_human_readable_datetime) does not touch MongoDB, so its
+latency is almost entirely transport overhead. Pass --tool list_collections to include a
+database round-trip.
+
+Usage: python test/mcp/benchmark_transport.py [--calls 500] [--tool list_collections]
+"""
+
+import sys
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+# add parent path to sys path
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+from app.mcp.client import MCPMongoClient
+
+TOOL_ARGUMENTS = {
+    "get_human_readable_datetime": {"utc_timestamp": 1725106500},
+    "list_collections": {},
+}
+
+
+async def benchmark(transport: str, tool: str, num_calls: int) -> dict:
+    start = time.perf_counter()
+    async with MCPMongoClient(transport=transport) as client:
+        startup = time.perf_counter() - start
+
+        # warm up the session (and the connection pool, for tools that query MongoDB)
+        for _ in range(10):
+            await client.session.call_tool(tool, TOOL_ARGUMENTS[tool])
+
+        latencies = []
+        for _ in range(num_calls):
+            call_start = time.perf_counter()
+            await client.session.call_tool(tool, TOOL_ARGUMENTS[tool])
+            latencies.append((time.perf_counter() - call_start) * 1000)
+
+    latencies.sort()
+    return {
+        "startup_ms": startup * 1000,
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95)],
+    }
+
+
+async def main(args):
+    print(
+        f"{'transport':>10} {'startup ms':>11} {'mean ms':>8} {'p50 ms':>7} {'p95 ms':>7}"
+    )
+    for transport in ["stdio", "inprocess"]:
+        result = await benchmark(transport, args.tool, args.calls)
+        print(
+            f"{transport:>10} {result['startup_ms']:>11.1f} {result['mean_ms']:>8.2f} "
+            f"{result['p50_ms']:>7.2f} {result['p95_ms']:>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument(
+        "--tool", choices=list(TOOL_ARGUMENTS), default="get_human_readable_datetime"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,82 @@
+"""
+Replay the NOSQL test queries through the MCP agent with and without server-side timestamp
+humanisation (MCP_HUMANISE_TIMESTAMPS), and count the agent iterations and tool calls each needs.
+
+The queries are the promptfoo test cases in test/data.csv that are answered by a pipeline.
+Each mode starts its own MCP server subprocess, which reads MCP_HUMANISE_TIMESTAMPS on startup.
+
+Usage: python test/mcp/replay_iterations.py [--limit 20]
+"""
+
+import sys
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+# Get the current file's directory
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# Get the parent directory of the current directory
+parent_dir = os.path.dirname(current_dir)
+# Get the parent directory of the parent directory (which should contain 'app')
+grandparent_dir = os.path.dirname(parent_dir)
+# Add the grandparent directory to sys.path
+sys.path.append(grandparent_dir)
+sys.path.append(os.path.join(parent_dir, "query_router"))
+from train_classifier import load_promptfoo_examples
+from app.mcp.client import MCPMongoClient
+from app.schemas.route import Route
+
+
+async def replay(queries: list[str], humanise: bool) -> list[dict]:
+    os.environ["MCP_HUMANISE_TIMESTAMPS"] = "true" if humanise else "false"
+    results = []
+    # the subprocess inherits the environment, so the server picks up the mode
+    async with MCPMongoClient(transport="stdio") as client:
+        for query in queries:
+            start = time.perf_counter()
+            result = await client.query_with_mcp(query)
+            results.append(
+                {
+                    "iterations": result["iterations"],
+                    "tool_calls": result["tool_calls"],
+                    "latency": time.perf_counter() - start,
+                }
+            )
+    return results
+
+
+async def main(args):
+    queries = [
+        query for query, route in load_promptfoo_examples() if route is Route.NOSQL
+    ][: args.limit]
+    print(f"Replaying {len(queries)} NOSQL test queries")
+
+    summaries = {}
+    for humanise in [False, True]:
+        results = await replay(queries, humanise)
+        summaries[humanise] = {
+            key: sum(result[key] for result in results)
+            for key in ["iterations", "tool_calls"]
+        }
+        summaries[humanise]["median_latency"] = statistics.median(
+            result["latency"] for result in results
+        )
+
+    print(
+        f"{'humanise':>9} {'iterations':>11} {'tool calls':>11} {'median latency (s)':>19}"
+    )
+    for humanise, summary in summaries.items():
+        print(
+            f"{str(humanise):>9} {summary['iterations']:>11} {summary['tool_calls']:>11} "
+            f"{summary['median_latency']:>19.2f}"
+        )
+    saved = summaries[False]["iterations"] - summaries[True]["iterations"]
+    print(f"Iterations saved: {saved} ({saved / max(1, len(queries)):.2f} per query)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--limit", type=int, default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""
+Compare the accuracy and latency of the LLM router against the local route classifier.
+
+The promptfoo test cases (test/data.csv) are used as the labelled evaluation set. For an unbiased
+comparison, train the classifier without them first:
+    python test/query_router/train_classifier.py --sources history
+
+Usage: python test/query_router/compare.py [--threshold 0.8]
+"""
+
+import sys
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+# Get the current file's directory
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# Get the parent directory of the current directory
+parent_dir = os.path.dirname(current_dir)
+# Get the parent directory of the parent directory (which should contain 'app')
+grandparent_dir = os.path.dirname(parent_dir)
+# Add the grandparent directory to sys.path
+sys.path.append(grandparent_dir)
+sys.path.append(current_dir)
+from train_classifier import load_promptfoo_examples
+from app.schemas.message import Message
+from app.schemas.role import Role
+from app.utils.format_utils import normalise_query
+from app.utils.openai_utils import query_router_llm
+from app.utils.route_classifier import ROUTE_CLASSIFIER_THRESHOLD, classify_route
+from app.utils.embedding_cache import embedding_cache
+
+
+def _summarise(name: str, correct: int, total: int, latencies: list[float]):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+    print(
+        f"{name:<8} accuracy: {correct}/{total} ({correct / total:.1%})  "
+        f"mean: {statistics.mean(latencies) * 1000:.0f}ms  "
+        f"p50: {statistics.median(latencies) * 1000:.0f}ms  p95: {p95 * 1000:.0f}ms"
+    )
+
+
+async def main(args):
+    examples = load_promptfoo_examples()
+    results = {"llm": [], "local": [], "hybrid": []}
+    num_fallbacks = 0
+
+    for query, expected in examples:
+        messages = normalise_query([Message(content=query, role=Role.USER)])
+
+        start = time.perf_counter()
+        llm_route = await query_router_llm(messages)
+        llm_latency = time.perf_counter() - start
+
+        # clear the embedding cache so that the local latency includes the embedding call
+        embedding_cache.clear()
+        start = time.perf_counter()
+        prediction = await classify_route(messages)
+        local_latency = time.perf_counter() - start
+        if prediction is None:
+            raise RuntimeError("No route classifier found. Train one first.")
+        local_route, confidence = prediction
+
+        if confidence >= args.threshold:
+            hybrid_route, hybrid_latency = local_route, local_latency
+        else:
+            num_fallbacks += 1
+            hybrid_route, hybrid_latency = llm_route, local_latency + llm_latency
+
+        results["llm"].append((llm_route is expected, llm_latency))
+        results["local"].append((local_route is expected, local_latency))
+        results["hybrid"].append((hybrid_route is expected, hybrid_latency))
+
+        print(
+            f"expected: {expected.value:<6} llm: {llm_route.value:<6} "
+            f"local: {local_route.value:<6} ({confidence:.2f})  {query[:60]}"
+        )
+
+    print()
+    for name, outcomes in results.items():
+        _summarise(
+            name,
+            sum(1 for is_correct, _ in outcomes if is_correct),
+            len(outcomes),
+            [latency for _, latency in outcomes],
+        )
+    print(
+        f"hybrid fell back to the LLM for {num_fallbacks}/{len(examples)} queries "
+        f"at threshold {args.threshold}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threshold", type=float, default=ROUTE_CLASSIFIER_THRESHOLD)
+    asyncio.run(main(parser.parse_args()))
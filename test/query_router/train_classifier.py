@@ -0,0 +1,113 @@
+"""
+Train the local route classifier used when ROUTE_CLASSIFIER_MODE=local.
+
+Examples are taken from the promptfoo test cases (test/data.csv) and from historical query documents,
+where documents with a "pipeline" were answered by the NOSQL route and documents with a
+"vector_search_result" were answered by the VECTOR route.
+
+Usage: python test/query_router/train_classifier.py [--sources promptfoo,history] [--history-limit 2000]
+"""
+
+import sys
+import os
+import csv
+import asyncio
+import argparse
+
+# Get the current file's directory
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# Get the parent directory of the current directory
+parent_dir = os.path.dirname(current_dir)
+# Get the parent directory of the parent directory (which should contain 'app')
+grandparent_dir = os.path.dirname(parent_dir)
+# Add the grandparent directory to sys.path
+sys.path.append(grandparent_dir)
+from app.db.conn import MongoDBConnection
+from app.schemas.route import Route
+from app.utils.format_utils import normalise_query
+from app.schemas.message import Message
+from app.schemas.role import Role
+from app.utils.route_classifier import RouteClassifier, ROUTE_CLASSIFIER_PATH
+from app.utils.vector_search import get_embedding
+
+DATA_PATH = os.path.join(parent_dir, "data.csv")
+
+
+def load_promptfoo_examples(path: str = DATA_PATH) -> list[tuple[str, Route]]:
+    examples = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            route = (
+                Route.NOSQL
+                if row["is_pipeline_generated"].upper() == "TRUE"
+                else Route.VECTOR
+            )
+            examples.append((row["query"], route))
+    return examples
+
+
+def load_historical_examples(
+    db_conn: MongoDBConnection, limit: int
+) -> list[tuple[str, Route]]:
+    query_collection = db_conn.get_collection("query")
+    docs = query_collection.find(
+        {
+            "is_error": False,
+            "$or": [
+                {"pipeline": {"$exists": True}},
+                {"vector_search_result": {"$exists": True}},
+            ],
+        },
+        {"query": 1, "pipeline": 1},
+    ).limit(limit)
+
+    return [
+        (doc["query"], Route.NOSQL if "pipeline" in doc else Route.VECTOR)
+        for doc in docs
+    ]
+
+
+async def embed_all(queries: list[str], concurrency: int = 8) -> list[list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def embed(query: str):
+        # embed the same normalised text that query_router sees at request time
+        message = normalise_query([Message(content=query, role=Role.USER)])[0]
+        async with semaphore:
+            return await get_embedding(message.content)
+
+    return await asyncio.gather(*[embed(query) for query in queries])
+
+
+async def main(args):
+    sources = args.sources.split(",")
+    examples = []
+    if "promptfoo" in sources:
+        examples.extend(load_promptfoo_examples())
+    if "history" in sources:
+        db_conn = MongoDBConnection()
+        try:
+            examples.extend(load_historical_examples(db_conn, args.history_limit))
+        finally:
+            db_conn.close()
+
+    for route in Route:
+        print(
+            f"{route.value}: {sum(1 for _, label in examples if label is route)} examples"
+        )
+
+    embeddings = await embed_all([query for query, _ in examples])
+    classifier = RouteClassifier.train(
+        embeddings, [label for _, label in examples], temperature=args.temperature
+    )
+    classifier.save(args.output)
+    print(f"Saved route classifier to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sources", default="promptfoo,history")
+    parser.add_argument("--history-limit", type=int, default=2000)
+    parser.add_argument("--temperature", type=float, default=0.05)
+    parser.add_argument("--output", default=ROUTE_CLASSIFIER_PATH)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,57 @@
+import sys
+import os
+
+# add parent path to sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.db.pipeline_cache import PipelineCache, is_volatile
+
+
+def _window_pipeline(sort_by: dict) -> list:
+    return [
+        {
+            "$setWindowFields": {
+                "partitionBy": "$topic",
+                "sortBy": sort_by,
+                "output": {"rank": {"$rank": {}}},
+            }
+        }
+    ]
+
+
+def test_key_ignores_the_order_of_object_keys():
+    assert PipelineCache.make_key(
+        "thread", [{"$match": {"topic": "exams", "score": {"$gt": 5}}}]
+    ) == PipelineCache.make_key(
+        "thread", [{"$match": {"score": {"$gt": 5}, "topic": "exams"}}]
+    )
+
+
+def test_key_keeps_the_order_of_sort_fields():
+    assert PipelineCache.make_key(
+        "thread", [{"$sort": {"score": -1, "created_utc": -1}}]
+    ) != PipelineCache.make_key("thread", [{"$sort": {"created_utc": -1, "score": -1}}])
+
+
+def test_key_keeps_the_order_of_window_sort_fields():
+    assert PipelineCache.make_key(
+        "thread", _window_pipeline({"score": -1, "created_utc": -1})
+    ) != PipelineCache.make_key(
+        "thread", _window_pipeline({"created_utc": -1, "score": -1})
+    )
+
+
+def test_key_keeps_the_order_of_top_n_sort_fields():
+    def pipeline(sort_by: dict) -> list:
+        top = {"$topN": {"n": 3, "sortBy": sort_by, "output": "$title"}}
+        return [{"$group": {"_id": "$topic", "top": top}}]
+
+    assert PipelineCache.make_key(
+        "thread", pipeline({"score": -1, "num_comments": -1})
+    ) != PipelineCache.make_key("thread", pipeline({"num_comments": -1, "score": -1}))
+
+
+def test_pipelines_that_depend_on_the_time_are_volatile():
+    since = {"$subtract": ["$$NOW", 7 * 24 * 60 * 60 * 1000]}
+    assert is_volatile([{"$match": {"$expr": {"$gt": ["$created", since]}}}])
+    assert is_volatile([{"$sample": {"size": 5}}])
+    assert not is_volatile(_window_pipeline({"score": -1}))
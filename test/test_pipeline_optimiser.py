@@ -0,0 +1,320 @@
+import sys
+import os
+import copy
+import pytest
+
+# add parent path to sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.db.pipeline_optimiser import optimise_pipeline
+
+# a small in-memory evaluator for the stages and operators used below, so that the results of a
+# pipeline can be compared before and after optimisation without a MongoDB server
+
+THREADS = [
+    {
+        "id": f"t{i}",
+        "topic": ["exams", "jc", "poly"][i % 3],
+        "score": (i * 7) % 11,
+        "selftext_embedding": [0.1 * i, 0.2],
+    }
+    for i in range(9)
+]
+COMMENTS = [
+    {"id": f"c{i}", "thread_id": f"t{i % 5}", "score": (i * 5) % 13} for i in range(20)
+]
+COLLECTIONS = {"thread": THREADS, "comment": COMMENTS}
+
+
+def _get(document, path):
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def _evaluate(expression, document):
+    if isinstance(expression, str):
+        if expression.startswith(("$$ROOT", "$$CURRENT")):
+            _, _, path = expression.partition(".")
+            return _get(document, path) if path else document
+        if expression.startswith("$"):
+            return _get(document, expression[1:])
+        return expression
+    if isinstance(expression, list):
+        return [_evaluate(item, document) for item in expression]
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator, arguments = next(iter(expression.items()))
+        if operator == "$first":
+            array = _evaluate(arguments, document)
+            return array[0] if array else None
+        if operator == "$size":
+            return len(_evaluate(arguments, document))
+        if operator == "$slice":
+            array, *positions = _evaluate(arguments, document)
+            if len(positions) == 1:
+                return array[: positions[0]]
+            return array[positions[0] : positions[0] + positions[1]]
+        if operator == "$arrayElemAt":
+            array, position = _evaluate(arguments, document)
+            return array[position] if position < len(array) else None
+    if isinstance(expression, dict):
+        return {key: _evaluate(item, document) for key, item in expression.items()}
+    return expression
+
+
+def _matches(query, document):
+    for field, condition in query.items():
+        value = _get(document, field)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator == "$gt" and not (value is not None and value > operand):
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _run(documents, pipeline):
+    documents = copy.deepcopy(documents)
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            documents = [document for document in documents if _matches(spec, document)]
+        elif name == "$sort":
+            for field, direction in reversed(list(spec.items())):
+                documents.sort(key=lambda d: _get(d, field), reverse=direction < 0)
+        elif name == "$limit":
+            documents = documents[:spec]
+        elif name == "$lookup":
+            for document in documents:
+                joined = [
+                    other
+                    for other in COLLECTIONS[spec["from"]]
+                    if _get(other, spec["foreignField"])
+                    == _get(document, spec["localField"])
+                ]
+                document[spec["as"]] = _run(joined, spec.get("pipeline", []))
+        elif name == "$unwind":
+            path = spec.lstrip("$")
+            documents = [
+                {**document, path: item}
+                for document in documents
+                for item in (_get(document, path) or [])
+            ]
+        elif name in ("$addFields", "$set"):
+            for document in documents:
+                document.update(
+                    {key: _evaluate(item, document) for key, item in spec.items()}
+                )
+        elif name == "$unset":
+            for document in documents:
+                for field in [spec] if isinstance(spec, str) else spec:
+                    document.pop(field, None)
+        elif name == "$project":
+            if any(value not in (0, False) for value in spec.values()):
+                documents = [
+                    {
+                        key: (
+                            _get(document, key)
+                            if item in (1, True)
+                            else _evaluate(item, document)
+                        )
+                        for key, item in spec.items()
+                    }
+                    for document in documents
+                ]
+            else:
+                for document in documents:
+                    for field in spec:
+                        document.pop(field, None)
+        elif name == "$group":
+            groups = {}
+            for document in documents:
+                key = _evaluate(spec["_id"], document)
+                group = groups.setdefault(repr(key), {"_id": key})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    operator, expression = next(iter(accumulator.items()))
+                    value = _evaluate(expression, document)
+                    if operator == "$push":
+                        group.setdefault(field, []).append(value)
+                    elif operator == "$first":
+                        group.setdefault(field, value)
+            documents = list(groups.values())
+        else:
+            raise NotImplementedError(name)
+    return documents
+
+
+def _lookup(**extra) -> dict:
+    return {
+        "$lookup": {
+            "from": "comment",
+            "localField": "id",
+            "foreignField": "thread_id",
+            "as": "comments",
+            **extra,
+        }
+    }
+
+
+EQUIVALENT_PIPELINES = {
+    "match after lookup": [_lookup(), {"$match": {"topic": "exams"}}],
+    "sort and limit after lookup": [
+        _lookup(),
+        {"$sort": {"score": -1}},
+        {"$limit": 2},
+    ],
+    "first comment": [
+        _lookup(),
+        {"$project": {"id": 1, "top": {"$first": "$comments"}}},
+    ],
+    "sliced comments": [
+        _lookup(),
+        {"$addFields": {"some": {"$slice": ["$comments", 1, 2]}}},
+        {"$unset": "comments"},
+    ],
+    "element of comments": [
+        _lookup(),
+        {"$set": {"third": {"$arrayElemAt": ["$comments", 2]}}},
+        {"$project": {"comments": 0}},
+    ],
+    "counted comments": [
+        _lookup(),
+        {"$project": {"n": {"$size": "$comments"}}},
+    ],
+    "unwound comments": [
+        _lookup(),
+        {"$unwind": "$comments"},
+        {"$match": {"comments.score": {"$gt": 6}}},
+    ],
+    "grouped roots": [
+        _lookup(),
+        {"$group": {"_id": "$topic", "docs": {"$push": "$$ROOT"}}},
+    ],
+    "projected root": [_lookup(), {"$project": {"doc": "$$ROOT"}}],
+    "match after projected id": [
+        {"$project": {"_id": 1}},
+        {"$match": {"score": {"$gt": 5}}},
+    ],
+    "projected current": [_lookup(), {"$project": {"n": "$$CURRENT.comments"}}],
+    "match on joined field": [
+        _lookup(),
+        {"$addFields": {"first": {"$first": "$comments"}}},
+        {"$match": {"first.score": {"$gt": 3}}},
+        {"$unset": "comments"},
+    ],
+    "joined threads": [
+        {
+            "$lookup": {
+                "from": "thread",
+                "localField": "thread_id",
+                "foreignField": "id",
+                "as": "thread",
+            }
+        },
+        {"$match": {"score": {"$gt": 4}}},
+        {"$sort": {"score": 1}},
+        {"$limit": 3},
+    ],
+}
+
+
+def _without_embeddings(documents):
+    """The optimiser drops joined embeddings by design, so they are left out of the comparison."""
+    for document in documents:
+        for value in document.values():
+            for joined in value if isinstance(value, list) else []:
+                if isinstance(joined, dict):
+                    joined.pop("selftext_embedding", None)
+    return documents
+
+
+@pytest.mark.parametrize("name", EQUIVALENT_PIPELINES)
+def test_optimised_pipeline_returns_the_same_documents(name):
+    pipeline = EQUIVALENT_PIPELINES[name]
+    collection = COMMENTS if name == "joined threads" else THREADS
+    expected = _without_embeddings(_run(collection, pipeline))
+    assert (
+        _without_embeddings(_run(collection, optimise_pipeline(pipeline))) == expected
+    )
+
+
+def test_optimise_pipeline_does_not_modify_its_argument():
+    pipeline = [_lookup(), {"$match": {"topic": "exams"}}]
+    original = copy.deepcopy(pipeline)
+    optimise_pipeline(pipeline)
+    assert pipeline == original
+
+
+def test_match_moves_before_lookup():
+    optimised = optimise_pipeline([_lookup(), {"$match": {"topic": "exams"}}])
+    assert optimised == [{"$match": {"topic": "exams"}}, _lookup()]
+
+
+def test_match_on_joined_field_stays_after_lookup():
+    pipeline = [_lookup(), {"$match": {"comments.score": {"$gt": 3}}}]
+    assert optimise_pipeline(pipeline) == pipeline
+
+
+@pytest.mark.parametrize(
+    "projection", [{"_id": 1}, {"_id": True}, {"title": 1, "_id": 0}]
+)
+def test_match_stays_after_inclusion_projection(projection):
+    pipeline = [{"$project": projection}, {"$match": {"score": {"$gt": 5}}}]
+    assert optimise_pipeline(pipeline) == pipeline
+
+
+def test_match_moves_before_exclusion_projection():
+    optimised = optimise_pipeline(
+        [{"$project": {"_id": 0, "topic": 0}}, {"$match": {"score": {"$gt": 5}}}]
+    )
+    assert optimised == [
+        {"$match": {"score": {"$gt": 5}}},
+        {"$project": {"_id": 0, "topic": 0}},
+    ]
+
+
+def test_sort_and_limit_move_before_lookup():
+    optimised = optimise_pipeline([_lookup(), {"$sort": {"score": -1}}, {"$limit": 2}])
+    assert optimised == [{"$sort": {"score": -1}}, {"$limit": 2}, _lookup()]
+
+
+def test_lookup_of_threads_excludes_embeddings():
+    optimised = optimise_pipeline(EQUIVALENT_PIPELINES["joined threads"])
+    lookup = next(stage for stage in optimised if "$lookup" in stage)
+    assert lookup["$lookup"]["pipeline"] == [{"$project": {"selftext_embedding": 0}}]
+
+
+@pytest.mark.parametrize(
+    "name, bound",
+    [("first comment", 1), ("sliced comments", 3), ("element of comments", 3)],
+)
+def test_lookup_read_through_a_prefix_is_bounded(name, bound):
+    optimised = optimise_pipeline(EQUIVALENT_PIPELINES[name])
+    assert optimised[0] == _lookup(pipeline=[{"$limit": bound}])
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "counted comments",
+        "unwound comments",
+        "grouped roots",
+        "projected root",
+        "projected current",
+    ],
+)
+def test_lookup_read_in_full_is_not_bounded(name):
+    optimised = optimise_pipeline(EQUIVALENT_PIPELINES[name])
+    assert optimised[0] == _lookup()
+
+
+def test_malformed_pipeline_is_left_as_is():
+    pipeline = [{"$match": {"topic": "exams"}, "$limit": 1}, _lookup()]
+    assert optimise_pipeline(pipeline) == pipeline